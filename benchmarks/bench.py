@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "model")
+sys.path.insert(0, MODEL_DIR)
+
+import synthetic
+import standin
+
+# fond.py imports cdsapi, so the stand-in must be installed before the model's modules are imported
+standin.install_cdsapi()
+
+import emission
+import datex2
+import fond
+import model
+import mapcache
+from workdir import SIRANE_EXECUTABLE
+
+"""
+End-to-end benchmarks of the model, on synthetic networks from 1k to 1M segments.
+
+For each scale, a synthetic network and its segment maps are generated in a temporary directory
+(see synthetic.py), along with a config.ini and a sirane/ directory with a stub SIRANE. The feeds are served
+by a local HTTP stand-in, and the CAMS forecast is written by a stand-in CDS client (see standin.py),
+so that only the model's own work is measured.
+
+Benchmarks, at each scale:
+- emission.main: download and parse the traffic feeds, compute the emissions, write emis_lin.dat
+- datex2.parse_xml_file: parse a DataTR file with one measurement per Tipi site
+- emission.write_emislin: write the emissions of every network segment
+- fond.extract_cams_data: extract the background concentrations at a point of a CAMS grid of up to `scale` cells
+- model.main: a whole run, with the stub SIRANE
+
+Each benchmark is called once cold (eg. the segment maps are compiled, the Tipi index is walked),
+then `--repeat` times warm. The results are written as JSON, with the wall time of the cold run,
+the minimum and median wall and CPU times of the warm runs, and for model.main the wall time of each stage
+of the last run (see metrics.py).
+"""
+
+DEFAULT_SCALES = [1000, 10000, 100000, 1000000]
+DEFAULT_REPEAT = 3
+DEFAULT_RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+
+LATITUDE, LONGITUDE = 47.2184, -1.5536
+
+CONFIG_TEMPLATE = """[GENERAL]
+latitude = {latitude}
+longitude = {longitude}
+cache_dir = {root}/cache
+
+[model]
+run_log = {root}/sirane/run_log.jsonl
+
+[meteo]
+api_key = benchmark
+
+[fond]
+cdsapircfile = {root}/atmosphere.cdsapirc
+
+[tipitrafic]
+username = benchmark
+password = benchmark
+
+[emission]
+nm_segment_map = {nm_segment_map}
+d2_segment_map = {d2_segment_map}
+network_segment_length = {network_segment_length}
+"""
+
+DONNEES_DAT = """Date de debut = 01/01/2021 00:00:00
+Date de fin = 01/01/2021 00:00:00
+Nombre de modulations lineiques = 1
+"""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def time_call(func):
+    """Returns the (wall, CPU) time of &func() in seconds"""
+    wall, cpu = time.perf_counter(), time.process_time()
+    func()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def benchmark(func, repeat, quiet):
+    """Call &func once cold, then $repeat times, and returns the statistics of the calls"""
+    devnull = open(os.devnull, 'w') if quiet else None
+    try:
+        with contextlib.ExitStack() as stack:
+            if quiet:
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+                stack.enter_context(contextlib.redirect_stderr(devnull))
+            cold, _cpu = time_call(func)
+            runs = [ time_call(func) for _ in range(repeat) ]
+    finally:
+        if devnull is not None:
+            devnull.close()
+
+    result = {'cold_seconds': cold}
+    if runs:
+        result.update({
+            'min_seconds': min(x[0] for x in runs),
+            'median_seconds': median([ x[0] for x in runs ]),
+            'cpu_min_seconds': min(x[1] for x in runs),
+            'cpu_median_seconds': median([ x[1] for x in runs ]),
+            'runs': len(runs),
+        })
+    return result
+
+
+def prepare(root, scale):
+    """
+    Write the files of a model run on a network of $scale segments in the directory $root:
+    the network files, config.ini, and sirane/ with its INPUT directory and the stub SIRANE.
+    Returns the filename of config.ini.
+    """
+    network = synthetic.write_network(os.path.join(root, "network"), scale)
+
+    input_dir = os.path.join(root, "sirane", "INPUT")
+    for directory in ["METEO", "FOND", "EMISSIONS/EMIS_LIN"]:
+        os.makedirs(os.path.join(input_dir, directory), exist_ok = True)
+    with open(os.path.join(input_dir, "Donnees.dat"), 'w') as f:
+        f.write(DONNEES_DAT)
+    standin.write_sirane_stub(os.path.join(root, "sirane", SIRANE_EXECUTABLE))
+
+    configfile = os.path.join(root, "config.ini")
+    with open(configfile, 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(root = root, latitude = LATITUDE, longitude = LONGITUDE, **network))
+    return configfile
+
+
+def clear_caches(root):
+    """Forget the compiled segment maps, the forecasts and the Tipi index cache"""
+    mapcache._loaded.clear()
+    shutil.rmtree(os.path.join(root, "cache"), ignore_errors = True)
+
+
+def run_scale(scale, stand_in, repeat, quiet, workdir):
+    """Run the benchmarks on a network of $scale segments, and returns their results"""
+    root = os.path.join(workdir, str(scale))
+    os.makedirs(root)
+    configfile = prepare(root, scale)
+    stand_in.set_scale(scale)
+
+    results = {
+        'scale': scale,
+        'nm_ids': synthetic.nm_count(scale),
+        'd2_sites': synthetic.d2_count(scale),
+        'benchmarks': {},
+    }
+    benchmarks = results['benchmarks']
+
+    def emission_main():
+        emission.main(configfile = configfile, outputfile = os.path.join(root, "emis_lin.dat"))
+
+    clear_caches(root)
+    benchmarks['emission.main'] = benchmark(emission_main, repeat, quiet)
+
+    xml_filename = os.path.join(root, "datex2.xml")
+    now = datetime.now(timezone.utc)
+    with open(xml_filename, 'wb') as f:
+        f.write(synthetic.datex2_payload(scale, now))
+    benchmarks['datex2.parse_xml_file'] = benchmark(lambda: datex2.parse_xml_file(xml_filename), repeat, quiet)
+
+    emis_data = synthetic.random_emislin(scale)
+    def write_emislin():
+        with open(os.path.join(root, "emis_lin.dat"), 'w') as f:
+            emission.write_emislin(emis_data, scale, f)
+    benchmarks['emission.write_emislin'] = benchmark(write_emislin, repeat, quiet)
+    del emis_data
+
+    cells = min(scale, synthetic.CAMS_EUROPE_CELLS)
+    area = [LATITUDE + 0.1, LONGITUDE - 0.1, LATITUDE - 0.1, LONGITUDE + 0.1]
+    netcdf_filename = synthetic.write_cams_forecast(os.path.join(root, "cams.nc"), now, area, cells = cells)
+    benchmarks['fond.extract_cams_data'] = benchmark(
+        lambda: fond.extract_cams_data(netcdf_filename, LATITUDE, LONGITUDE), repeat, quiet)
+    benchmarks['fond.extract_cams_data']['grid_cells'] = cells
+    os.unlink(netcdf_filename)
+
+    # model.py works with paths relative to the current directory (sirane/)
+    clear_caches(root)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        benchmarks['model.main'] = benchmark(lambda: model.main(configfile = configfile), repeat, quiet)
+    finally:
+        os.chdir(cwd)
+    with open(os.path.join(root, "sirane", "run_log.jsonl")) as f:
+        last_run = json.loads(f.readlines()[-1])
+    benchmarks['model.main']['stages'] = dict( (x['stage'], x['wall_seconds']) for x in last_run['stages'] )
+
+    results['files'] = dict( (name, os.path.getsize(os.path.join(root, "network", name)))
+                             for name in sorted(os.listdir(os.path.join(root, "network"))) )
+    shutil.rmtree(root)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = BENCHMARKS_DIR,
+                                       stderr = subprocess.DEVNULL, universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results, previous = None, file = sys.stderr):
+    """Print the median wall time of each benchmark and scale, and its ratio to the $previous results if any"""
+    before = {}
+    if previous is not None:
+        for scale_results in previous['scales']:
+            for name, x in scale_results['benchmarks'].items():
+                before[(scale_results['scale'], name)] = x.get('median_seconds', x['cold_seconds'])
+
+    print("%-26s %9s %12s %12s %8s" % ("benchmark", "scale", "cold (s)", "median (s)", "ratio"), file = file)
+    for scale_results in results['scales']:
+        scale = scale_results['scale']
+        for name, x in scale_results['benchmarks'].items():
+            value = x.get('median_seconds', x['cold_seconds'])
+            ratio = ""
+            if before.get((scale, name)):
+                ratio = "%.2f" % (value / before[(scale, name)])
+            print("%-26s %9d %12.4f %12.4f %8s" % (name, scale, x['cold_seconds'], value, ratio), file = file)
+
+
+def main(scales = None, repeat = None, output = None, compare = None, verbose = False):
+    if scales is None:
+        scales = DEFAULT_SCALES
+    if repeat is None:
+        repeat = DEFAULT_REPEAT
+
+    started = datetime.now(timezone.utc)
+    if output is None:
+        output = os.path.join(DEFAULT_RESULTS_DIR, "bench_%s.json" % started.strftime("%Y-%m-%dT%H-%M-%SZ"))
+
+    results = {
+        'started': started.isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'scales': [],
+    }
+
+    workdir = tempfile.mkdtemp(prefix = "captation-bench-")
+    try:
+        with standin.StandIn() as stand_in:
+            stand_in.redirect()
+            for scale in scales:
+                print("Benchmarking %d segments…" % scale, file = sys.stderr)
+                results['scales'].append(run_scale(scale, stand_in, repeat, not verbose, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent = 1)
+    print("Results written to %s" % output, file = sys.stderr)
+
+    previous = None
+    if compare is not None:
+        with open(compare) as f:
+            previous = json.load(f)
+    print_summary(results, previous)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type = lambda s: [ int(x) for x in s.split(",") ],
+                        help = "Comma-separated numbers of network segments (default %s)" % ",".join(map(str, DEFAULT_SCALES)))
+    parser.add_argument("--repeat", type = int, help = "Number of warm runs of each benchmark (default %d)" % DEFAULT_REPEAT)
+    parser.add_argument("--output", help = "JSON results file (default benchmarks/results/bench_<time>.json)")
+    parser.add_argument("--compare", help = "Previous JSON results file to compare the median times with")
+    parser.add_argument("--verbose", action = "store_true", help = "Show the output of the model")
+    args = parser.parse_args()
+
+    main(scales = args.scales, repeat = args.repeat, output = args.output, compare = args.compare, verbose = args.verbose)
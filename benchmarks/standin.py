@@ -0,0 +1,162 @@
+import os
+import sys
+import types
+import threading
+import socketserver
+import http.server
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from urllib.parse import urlsplit, parse_qs
+
+import synthetic
+
+"""
+Local stand-ins for the services the model depends on, so that a benchmark only measures the model itself:
+
+- StandIn is an HTTP server on 127.0.0.1 which serves synthetic OpenWeatherMap, Opendatasoft (Nantes Métropole)
+  and Tipi (DATEX2 index pages and DataTR files) payloads. redirect() points the module URL constants of
+  meteo.py, trafic_nm.py and datex2.py to it.
+- install_cdsapi() replaces the CDS API client used by fond.py with one that writes a synthetic forecast
+  instead of queuing a request on the Copernicus servers.
+- write_sirane_stub() writes a SIRANE executable which only reads its inputs and writes its log.
+
+The payloads are generated once per scale (see StandIn.set_scale), so serving them costs next to nothing.
+"""
+
+OWM_PATH = "/owm/onecall"
+NM_PATH = "/nm/download/"
+TIPI_PATH = "/tipi/"
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # The model fetches its feeds concurrently
+    daemon_threads = True
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        payload = self.server.standin.route(url.path, parse_qs(url.query))
+        if payload is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        content_type, body = payload
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        last_modified = self.server.standin.last_modified.get(url.path)
+        if last_modified is not None:
+            self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandIn:
+    """
+    The local HTTP server, started on a free port. Use it as a context manager:
+
+        with StandIn() as standin:
+            standin.set_scale(10000)
+            standin.redirect()
+            ...
+    """
+    def __init__(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.standin = self
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, name = "standin", daemon = True)
+        self.payloads = {}
+        # Paths mapping to their Last-Modified header
+        self.last_modified = {}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_scale(self, scale, now = None):
+        """Generate the payloads of the feeds for a network of $scale segments, at the time $now (UTC)"""
+        if now is None:
+            now = datetime.now(timezone.utc)
+        file_time = synthetic.tipi_file_time(now)
+        folder = file_time.strftime("%Y-%m-%d_%H/")
+        previous = file_time - timedelta(seconds = synthetic.TIPI_PERIOD)
+        files = [ synthetic.tipi_filename(t) for t in (previous, file_time) if t.strftime("%Y-%m-%d_%H/") == folder ]
+        datex2 = synthetic.datex2_payload(scale, now)
+
+        self.payloads = {
+            OWM_PATH: ("application/json", synthetic.owm_payload(now)),
+            NM_PATH: ("text/csv; charset=utf-8", synthetic.nm_payload(scale, now, fields = ["cha_id"])),
+            NM_PATH + "?all": ("text/csv; charset=utf-8", synthetic.nm_payload(scale, now)),
+            TIPI_PATH: ("text/html", synthetic.tipi_index_page([folder])),
+            TIPI_PATH + folder: ("text/html", synthetic.tipi_index_page(files)),
+        }
+        # The Tipi files are published at their timestamp. The previous one is also served when it is in the previous folder
+        self.last_modified = {}
+        for t in (previous, file_time):
+            path = TIPI_PATH + t.strftime("%Y-%m-%d_%H/") + synthetic.tipi_filename(t)
+            self.payloads[path] = ("text/xml", datex2)
+            self.last_modified[path] = format_datetime(t.replace(tzinfo = timezone.utc), usegmt = True)
+
+    def route(self, path, query):
+        if path == NM_PATH and 'fields' not in query:
+            path += "?all"
+        return self.payloads.get(path)
+
+    def redirect(self):
+        """Point the URL constants of the model's fetchers to the stand-in"""
+        import meteo
+        import trafic_nm
+        import datex2
+        meteo.OWM_URL = self.base_url + OWM_PATH
+        trafic_nm.DOWNLOAD_URL = self.base_url + NM_PATH
+        datex2.NANTES_URL = self.base_url + TIPI_PATH
+
+
+class Client:
+    """Stand-in for cdsapi.Client: the requested forecast is written right away, with synthetic values"""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def retrieve(self, name, request, target = None):
+        date = datetime.strptime(request['date'].split("/")[0], "%Y-%m-%d")
+        upto = max(int(x) for x in request['leadtime_hour'])
+        synthetic.write_cams_forecast(target, date, request['area'], upto)
+        return target
+
+
+def install_cdsapi():
+    """
+    Make `import cdsapi` return the stand-in module, whether or not the real one is installed.
+    Call this before fond.py is imported.
+    """
+    module = types.ModuleType("cdsapi")
+    module.Client = Client
+    sys.modules['cdsapi'] = module
+    return module
+
+
+SIRANE_STUB = """#!/bin/sh
+# Stand-in for SIRANE: read the inputs like SIRANE would, and write the log
+cat "$1" INPUT/METEO/Meteo.dat INPUT/FOND/Concentration_Fond.dat INPUT/EMISSIONS/EMIS_LIN/emis_lin.dat > /dev/null || exit 1
+mkdir -p RESULT
+echo "Pas de temps 1/1" > "$2"
+"""
+
+
+def write_sirane_stub(filename):
+    """Write the SIRANE stand-in to $filename, and make it executable"""
+    with open(filename, 'w') as f:
+        f.write(SIRANE_STUB)
+    os.chmod(filename, 0o755)
+    return filename
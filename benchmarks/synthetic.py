@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import math
+import random
+import struct
+import argparse
+from array import array
+from datetime import datetime, timedelta
+
+"""
+Generators of synthetic inputs for the benchmarks, at any scale.
+
+A network of $scale segments is fed by $scale / 10 Nantes Métropole traffic ids (each one mapped to ~10 consecutive
+network segments) and $scale / 100 Tipi measurement sites (each one mapped to ~2 segments of a quarter of the network),
+which is roughly the density of the real Nantes network. Everything is generated from a seed, so that two runs
+of the benchmarks process the same data.
+
+The payloads are the ones of the real feeds, with only the fields the model reads:
+- the network lengths file and the segment map files (see docs/config.md)
+- OpenWeatherMap's One Call JSON
+- Nantes Métropole's traffic csv (Opendatasoft export)
+- Tipi's DATEX2 DataTR xml, and the index pages of its folders
+- a CAMS forecast in the netcdf 3 format
+"""
+
+DEFAULT_SEED = 42
+
+# Real CAMS Europe domain at 0.1°, the size of the largest forecast grid
+CAMS_EUROPE_CELLS = 700 * 420
+CAMS_RESOLUTION = 0.1
+
+DATEX2_NS = "http://datex2.eu/schema/2/2_0"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+TIPI_PREFIX = "TraficBreizhNantes_1_DataTR_"
+# Number of seconds between two Tipi files
+TIPI_PERIOD = 360
+
+NM_LABELS = ["Identifiant", "Nom du tronçon", "Horodatage", "Débit", "Vitesse"]
+
+
+def nm_count(scale):
+    """Number of Nantes Métropole traffic ids for a network of $scale segments"""
+    return max(10, scale // 10)
+
+
+def d2_count(scale):
+    """Number of Tipi measurement sites for a network of $scale segments"""
+    return max(5, scale // 100)
+
+
+def d2_site_id(i):
+    return "MWB%d.G1" % i
+
+
+# === Network and mapfiles ===
+
+def write_network_lengths(filename, scale, seed = DEFAULT_SEED):
+    """Write a network lengths file with $scale segments of 10 to 500 meters"""
+    rng = random.Random(seed)
+    with open(filename, 'w', newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "length"])
+        for i in range(scale):
+            writer.writerow([i, round(rng.uniform(10, 500), 1)])
+
+
+def write_nm_mapfile(filename, scale):
+    """Write the segment map file of the Nantes Métropole traffic ids, see nm_count()"""
+    count = nm_count(scale)
+    with open(filename, 'w', newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["network_id", "traffic_id"])
+        for i in range(scale):
+            writer.writerow([i, i * count // scale])
+
+
+def write_d2_mapfile(filename, scale):
+    """Write the segment map file of the Tipi measurement sites, see d2_count()"""
+    count = d2_count(scale)
+    with open(filename, 'w', newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["network_id", "traffic_id"])
+        # The sites are on the main roads, ie. a quarter of the network
+        for i in range(0, scale, 4):
+            writer.writerow([i, d2_site_id((i // 4) % count)])
+
+
+def write_network(directory, scale, seed = DEFAULT_SEED):
+    """
+    Write the network lengths file and the two segment map files of a network of $scale segments to $directory.
+    Returns a dictionary with the keys 'network_segment_length', 'nm_segment_map' and 'd2_segment_map' (as in config.ini)
+    mapping to the filenames.
+    """
+    os.makedirs(directory, exist_ok = True)
+    files = {
+        'network_segment_length': os.path.join(directory, "network_lengths.csv"),
+        'nm_segment_map': os.path.join(directory, "nm_mapfile.csv"),
+        'd2_segment_map': os.path.join(directory, "d2_mapfile.csv"),
+    }
+    write_network_lengths(files['network_segment_length'], scale, seed)
+    write_nm_mapfile(files['nm_segment_map'], scale)
+    write_d2_mapfile(files['d2_segment_map'], scale)
+    return files
+
+
+def random_emislin(scale, seed = DEFAULT_SEED):
+    """Returns SiraneEmisLin data (see emission.py) for every segment of a network of $scale segments"""
+    rng = random.Random(seed)
+    return dict( (str(i), [rng.uniform(0, 1e-3), rng.uniform(0, 1e-4), rng.uniform(0, 1e-4)]) for i in range(scale) )
+
+
+# === Feeds ===
+
+def owm_payload(now, hours = 48, seed = DEFAULT_SEED):
+    """Returns the JSON of OpenWeatherMap's One Call API (hourly forecast) from the hour of $now, as bytes"""
+    rng = random.Random(seed)
+    start = int(now.replace(minute = 0, second = 0, microsecond = 0).timestamp())
+    hourly = []
+    for h in range(hours):
+        hour = {
+            'dt': start + h * 3600,
+            'temp': round(rng.uniform(270, 300), 2),
+            'wind_speed': round(rng.uniform(0, 12), 2),
+            'wind_deg': rng.randrange(0, 360),
+            'clouds': rng.randrange(0, 101),
+        }
+        if rng.random() < 0.2:
+            hour['rain'] = {'1h': round(rng.uniform(0, 3), 2)}
+        hourly.append(hour)
+    return json.dumps({'lat': 47.2, 'lon': -1.55, 'timezone_offset': 0, 'hourly': hourly}).encode()
+
+
+def nm_payload(scale, now, fields = None, seed = DEFAULT_SEED):
+    """
+    Returns Nantes Métropole's traffic csv (as exported by Opendatasoft, with a BOM) as bytes.
+    $fields is the list of the selected field names, or None for every column.
+    """
+    rng = random.Random(seed)
+    time_s = now.strftime("%Y-%m-%dT%H:%M:00+00:00")
+    lines = [";".join(NM_LABELS if fields is None else ["Identifiant", "Horodatage", "Débit", "Vitesse"])]
+    for i in range(nm_count(scale)):
+        rate = rng.choice([-1, 0]) if rng.random() < 0.02 else rng.randrange(0, 2000)
+        speed = -1 if rng.random() < 0.02 else rng.randrange(5, 110)
+        if fields is None:
+            lines.append("%d;Tronçon %d;%s;%s;%s" % (i, i, time_s, "" if rate == -1 else rate, "" if speed == -1 else speed))
+        else:
+            lines.append("%d;%s;%s;%s" % (i, time_s, "" if rate == -1 else rate, "" if speed == -1 else speed))
+    return ("\ufeff" + "\r\n".join(lines) + "\r\n").encode()
+
+
+def tipi_file_time(now):
+    """Returns the time of the latest Tipi file published at $now (UTC, naive)"""
+    now = now.replace(tzinfo = None, microsecond = 0)
+    epoch = datetime(1970, 1, 1)
+    seconds = int((now - epoch).total_seconds()) // TIPI_PERIOD * TIPI_PERIOD
+    return epoch + timedelta(seconds = seconds)
+
+
+def tipi_filename(file_time):
+    return TIPI_PREFIX + file_time.strftime("%Y%m%d_%H%M%S") + ".xml"
+
+
+def tipi_index_page(names):
+    """Returns an Apache-like index page listing $names, as bytes"""
+    links = "\n".join('<a href="%s">%s</a>' % (name, name) for name in names)
+    return ("<html><body><pre>\n%s\n</pre></body></html>\n" % links).encode()
+
+
+def datex2_payload(scale, now, seed = DEFAULT_SEED):
+    """Returns Tipi's DATEX2 DataTR xml, with one siteMeasurements element per site (see d2_count), as bytes"""
+    rng = random.Random(seed)
+    time_s = now.strftime("%Y-%m-%dT%H:%M:00+00:00")
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<d2LogicalModel xmlns="%s" xmlns:xsi="%s" modelBaseVersion="2">' % (DATEX2_NS, XSI_NS),
+        '<payloadPublication xsi:type="MeasuredDataPublication" lang="fr">',
+        '<publicationTime>%s</publicationTime>' % time_s,
+    ]
+    for i in range(d2_count(scale)):
+        inputs = rng.randrange(1, 60)
+        flow = rng.randrange(0, 120)
+        values = [
+            ("TrafficFlow", "vehicleFlow", "vehicleFlowRate", flow),
+            ("TrafficConcentration", "occupancy", "percentage", rng.randrange(0, 30)),
+        ]
+        # Some sites don't report their speed
+        if rng.random() > 0.05:
+            values.append(("TrafficSpeed", "averageVehicleSpeed", "speed", rng.randrange(10, 110)))
+        parts.append('<siteMeasurements>')
+        parts.append('<measurementSiteReference targetClass="MeasurementSiteRecord" id="%s" version="1"/>' % d2_site_id(i))
+        parts.append('<measurementTimeDefault>%s</measurementTimeDefault>' % time_s)
+        for index, (datatype, value_tag, number_tag, value) in enumerate(values):
+            parts.append(
+                '<measuredValue index="%d"><measuredValue><basicData xsi:type="%s">'
+                '<measurementOrCalculationTime>%s</measurementOrCalculationTime>'
+                '<%s numberOfInputValuesUsed="%d"><%s>%s</%s></%s>'
+                '</basicData></measuredValue></measuredValue>' % (
+                    index + 1, datatype, time_s, value_tag, inputs, number_tag, value, number_tag, value_tag))
+        parts.append('</siteMeasurements>')
+    parts.append('</payloadPublication></d2LogicalModel>\n')
+    return "".join(parts).encode()
+
+
+# === CAMS forecast ===
+
+def netcdf_name(name):
+    data = name.encode()
+    return struct.pack(">i", len(data)) + data + b"\0" * ((4 - len(data) % 4) % 4)
+
+
+def netcdf_attributes(attributes):
+    if not attributes:
+        return struct.pack(">ii", 0, 0)
+    parts = [struct.pack(">ii", 0x0C, len(attributes))]
+    for name, value in attributes.items():
+        parts.append(netcdf_name(name))
+        if isinstance(value, str):
+            data = value.encode()
+            parts.append(struct.pack(">ii", 2, len(data)))
+        else:
+            data = struct.pack(">%df" % len(value), *value)
+            parts.append(struct.pack(">ii", 5, len(value)))
+        parts.append(data + b"\0" * ((4 - len(data) % 4) % 4))
+    return b"".join(parts)
+
+
+def write_netcdf(filename, dimensions, variables):
+    """
+    Write a netcdf 3 (classic format) file, with float variables and no record dimension.
+
+    $dimensions is a list of (name, length) tuples.
+    $variables is a list of (name, dimension names, attributes, values) tuples, where the attributes
+    are a dictionary of names mapping to strings or lists of floats, and the values are an iterable
+    of array('f') chunks in row-major order.
+    """
+    dimids = dict( (name, i) for i, (name, _length) in enumerate(dimensions) )
+    lengths = dict(dimensions)
+
+    def header(begins):
+        parts = [b"CDF\x01", struct.pack(">i", 0)]
+        parts.append(struct.pack(">ii", 0x0A, len(dimensions)))
+        for name, length in dimensions:
+            parts.append(netcdf_name(name) + struct.pack(">i", length))
+        parts.append(netcdf_attributes({}))
+        parts.append(struct.pack(">ii", 0x0B, len(variables)))
+        for (name, dims, attributes, _values), begin in zip(variables, begins):
+            parts.append(netcdf_name(name))
+            parts.append(struct.pack(">i%di" % len(dims), len(dims), *[ dimids[d] for d in dims ]))
+            parts.append(netcdf_attributes(attributes))
+            parts.append(struct.pack(">iii", 5, size(dims), begin))
+        return b"".join(parts)
+
+    def size(dims):
+        n = 4
+        for d in dims:
+            n *= lengths[d]
+        return n
+
+    # The header's size doesn't depend on the offsets
+    begin = len(header([0] * len(variables)))
+    begins = []
+    for _name, dims, _attributes, _values in variables:
+        begins.append(begin)
+        begin += size(dims)
+
+    with open(filename, 'wb') as f:
+        f.write(header(begins))
+        for _name, _dims, _attributes, values in variables:
+            for chunk in values:
+                if sys.byteorder == 'little':
+                    chunk = array('f', chunk)
+                    chunk.byteswap()
+                chunk.tofile(f)
+
+
+def cams_grid(area, cells = None):
+    """
+    Returns the (latitudes, longitudes) of a CAMS grid at 0.1° covering $area ([north, west, south, east]),
+    or of a square grid of about $cells cells centered on $area.
+    """
+    north, west, south, east = area
+    if cells is None:
+        rows = int(round((north - south) / CAMS_RESOLUTION)) + 1
+        cols = int(round((east - west) / CAMS_RESOLUTION)) + 1
+    else:
+        rows = cols = max(2, int(math.sqrt(cells)))
+        north = (north + south) / 2 + (rows - 1) * CAMS_RESOLUTION / 2
+        west = (west + east) / 2 - (cols - 1) * CAMS_RESOLUTION / 2
+    # Latitudes go from north to south, like in the CAMS files
+    lats = [ round(north - i * CAMS_RESOLUTION, 2) for i in range(rows) ]
+    lons = [ round(west + j * CAMS_RESOLUTION, 2) for j in range(cols) ]
+    return lats, lons
+
+
+def write_cams_forecast(filename, date, area, upto = 24, cells = None):
+    """
+    Write a CAMS forecast of NO2, O3, PM10 and PM2.5 for $date from 00:00 to $upto hours, as downloaded by fond.py.
+    See cams_grid() for $area and $cells.
+    """
+    lats, lons = cams_grid(area, cells)
+    hours = upto + 1
+    plane = len(lats) * len(lons)
+    # One base field per species, shifted a little at each hour
+    species = [("no2_conc", 12.0), ("o3_conc", 40.0), ("pm10_conc", 20.0), ("pm2p5_conc", 15.0)]
+
+    def series(base):
+        field = array('f', ( base + (i % 97) / 10 for i in range(plane) ))
+        for hour in range(hours):
+            yield array('f', ( x + hour / 10 for x in field ))
+
+    variables = [
+        ("time", ["time"], {'long_name': "FORECAST time from %s" % date.strftime("%Y%m%d"), 'units': "hours"},
+         [array('f', range(hours))]),
+        ("level", ["level"], {'units': "m"}, [array('f', [0])]),
+        ("latitude", ["latitude"], {'units': "degrees_north"}, [array('f', lats)]),
+        ("longitude", ["longitude"], {'units': "degrees_east"}, [array('f', lons)]),
+    ]
+    for name, base in species:
+        variables.append((name, ["time", "level", "latitude", "longitude"], {'units': "µg/m3"}, series(base)))
+
+    write_netcdf(filename, [("time", hours), ("level", 1), ("latitude", len(lats)), ("longitude", len(lons))], variables)
+    return filename
+
+
+if __name__ == "__main__":
+    # Write a synthetic network and its mapfiles, eg. to try the model on a large network
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scale", type = int, help = "Number of network segments")
+    parser.add_argument("directory")
+    parser.add_argument("--seed", type = int, default = DEFAULT_SEED)
+    args = parser.parse_args()
+
+    for key, filename in sorted(write_network(args.directory, args.scale, args.seed).items()):
+        print("%s = %s" % (key, filename))
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import math
+import glob
+import shutil
+import hashlib
+import tempfile
+import zipfile
+import argparse
+import configparser
+from datetime import datetime, timedelta, timezone
+
+import cdsapi
+
+import netcdf3
+import capture
+from fond import nearest_index, print_sirane_fond_input
+from meteo import print_sirane_meteo_input
+from mapcache import DEFAULT_CACHE_DIR
+
+"""
+Inputs of past hours, for `model.py --backfill START END`.
+
+The live model uses forecasts (OpenWeatherMap, CAMS forecast) and the traffic of the current hour.
+To simulate a past period, we use instead:
+- meteo: the ERA5 reanalysis (single levels) from the Copernicus Climate Data Store
+- background concentrations: the CAMS European air quality reanalysis from the Atmosphere Data Store
+- traffic: the feeds recorded at that time (see capture.py), or else the traffic profile
+
+Both reanalyses are downloaded one month at a time, and kept in the cache directory. The ERA5 netcdf
+files are read with netcdf3.py (their values are packed as shorts, see Variable.unpack), so the downloads
+must be netcdf 3 files, which the current CDS doesn't deliver anymore (see netcdf_kind).
+
+MintData (see meteo.py and fond.py) is used for both the meteo and the background concentrations.
+"""
+
+ERA5_DATASET = 'reanalysis-era5-single-levels'
+ERA5_VARIABLES = [
+    # NB order matters, see read_era5
+    '10m_u_component_of_wind', '10m_v_component_of_wind', '2m_temperature',
+    'total_cloud_cover', 'total_precipitation',
+]
+ERA5_NETCDF_VARIABLES = ['u10', 'v10', 't2m', 'tcc', 'tp']
+ERA5_RESOLUTION = 0.25
+# ERA5 is published about 5 days behind real time, a month is only final once it's that far behind
+ERA5_DELAY = timedelta(days = 6)
+
+CAMS_REANALYSIS_DATASET = 'cams-europe-air-quality-reanalyses'
+# 'validated_reanalysis' is published about a year later, 'interim_reanalysis' a few months later
+DEFAULT_CAMS_REANALYSIS_TYPE = 'validated_reanalysis'
+CAMS_REANALYSIS_VARIABLES = ['nitrogen_dioxide', 'ozone', 'particulate_matter_10um', 'particulate_matter_2.5um']
+# Names of the species in the reanalysis files, in the order of MintData
+CAMS_REANALYSIS_SPECIES = ['no2', 'o3', 'pm10', 'pm2p5']
+
+DEFAULT_ERA5_CDSAPIRC = 'climate.cdsapirc'
+DEFAULT_CHUNK_DAYS = 7
+
+# The recorded traffic of an hour is the last one recorded before the end of that hour, if it isn't older than this
+TRAFFIC_MAX_AGE = timedelta(hours = 1)
+
+CF_UNITS = {
+    'seconds': 1,
+    'minutes': 60,
+    'hours': 3600,
+    'days': 86400,
+}
+CF_DATE_FORMATS = ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+
+# === Dates ===
+
+def parse_date(date_s):
+    """Parse a date of the command line, eg. `2020-12-01`, into a naive UTC datetime"""
+    return datetime.strptime(date_s, "%Y-%m-%d")
+
+
+def split_chunks(start, end, days = None):
+    """
+    Split the hours from $start to $end (excluded) into chunks of $days days.
+    Returns a list of (chunk start, chunk end) tuples, with the chunk end excluded.
+    """
+    if days is None:
+        days = DEFAULT_CHUNK_DAYS
+    chunks = []
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(end, chunk_start + timedelta(days = days))
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return chunks
+
+
+def hours_between(start, end):
+    """Returns the list of the hours from $start to $end (excluded)"""
+    count = int((end - start).total_seconds() // 3600)
+    return [ start + timedelta(hours = h) for h in range(count) ]
+
+
+def months_between(start, end):
+    """Returns the list of the (year, month) of the hours from $start to $end (excluded)"""
+    months = []
+    year, month = start.year, start.month
+    while datetime(year, month, 1) < end:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def month_end(year, month):
+    return datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+
+
+def slice_hours(data, start, end):
+    """Keep the MintData rows from $start to $end (excluded), sorted, with one row per hour"""
+    rows = dict( (d[0], d) for d in data if start <= d[0] < end )
+    return [ rows[t] for t in sorted(rows) ]
+
+
+def missing_hours(data, start, end):
+    """Returns the hours from $start to $end (excluded) which aren't in the MintData"""
+    present = set( d[0] for d in data )
+    return [ t for t in hours_between(start, end) if t not in present ]
+
+
+# === Netcdf ===
+
+def cf_times(variable):
+    """Returns the values of the CF time $variable (eg. units `hours since 1900-01-01 00:00:00.0`) as naive UTC datetimes"""
+    units = variable.attributes.get('units', "")
+    unit, _, origin = units.partition(" since ")
+    if unit not in CF_UNITS or not origin:
+        raise ValueError("Unsupported time units '%s' for %s" % (units, variable.name))
+    origin = origin.strip().rstrip("Z").replace(" UTC", "")
+    for fmt in CF_DATE_FORMATS:
+        try:
+            epoch = datetime.strptime(origin, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        raise ValueError("Unsupported time origin '%s' for %s" % (origin, variable.name))
+    factor = CF_UNITS[unit]
+    return [ epoch + timedelta(seconds = round(x * factor)) for x in variable.read() ]
+
+
+def netcdf_kind(filename):
+    """
+    Returns None if $filename is a netcdf 3 file, which is all netcdf3.py reads, or else a description of it.
+
+    NB The CDS and ADS which replaced the legacy ones in 2024 deliver netcdf 4 (HDF5) files, and can't be asked
+    for netcdf 3 ones, so their downloads have to be converted by hand (eg. `nccopy -k classic`).
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic[:3] == b"CDF" and magic[3:] in (b"\x01", b"\x02"):
+        return None
+    return "a netcdf 4 (HDF5) file" if magic == netcdf3.HDF5_MAGIC else "not a netcdf file"
+
+
+def time_variable(nc):
+    # The files of the new CDS (once converted to netcdf 3, see netcdf_kind) name it valid_time
+    for name in ('time', 'valid_time'):
+        if name in nc.variables:
+            return nc.variables[name]
+    raise ValueError("No time variable")
+
+
+def grid_index(nc, lat, lon):
+    """Returns the (latitude, longitude) index of the grid cell closest to ($lat, $lon)"""
+    lats = nc.variables['latitude'].read()
+    lons = nc.variables['longitude'].read()
+    # Longitudes may be in [0, 360[
+    if max(lons) > 180:
+        lon = lon % 360
+    return nearest_index(lats, lat), nearest_index(lons, lon)
+
+
+def point_series(variable, i, j):
+    """Returns the unpacked time series of the (time, [level,] latitude, longitude) $variable at the cell (i, j)"""
+    index = (0, i, j) if len(variable.shape) == 4 else (i, j)
+    return variable.read_series(index, unpack = True)
+
+
+# === Meteo (ERA5) ===
+
+def era5_area(lat, lon):
+    """Returns the [north, west, south, east] area of the ERA5 cells around ($lat, $lon)"""
+    return [lat + ERA5_RESOLUTION, lon - ERA5_RESOLUTION, lat - ERA5_RESOLUTION, lon + ERA5_RESOLUTION]
+
+
+def area_key(area):
+    return hashlib.sha1(repr([ round(x, 4) for x in area ]).encode()).hexdigest()[:12]
+
+
+def download_era5_month(year, month, area, filename):
+    """Download the hourly ERA5 variables of a month in $area to the netcdf file $filename"""
+    days = (month_end(year, month) - datetime(year, month, 1)).days
+    request = {
+        'product_type': 'reanalysis',
+        'format': 'netcdf',
+        'variable': ERA5_VARIABLES,
+        'year': str(year),
+        'month': "%02d" % month,
+        'day': [ "%02d" % d for d in range(1, days + 1) ],
+        'time': [ "%02d:00" % h for h in range(24) ],
+        'area': area,
+    }
+    c = cdsapi.Client()
+    c.retrieve(ERA5_DATASET, request, filename)
+    return filename
+
+
+def get_era5_month(cache_dir, year, month, area, cdsapircfile):
+    """
+    Returns the filename of the ERA5 month in the cache, downloading it if it isn't there,
+    or if it was downloaded before the whole month was published (see ERA5_DELAY)
+    """
+    filename = os.path.join(cache_dir, "era5", "era5_%04d-%02d_%s.nc" % (year, month, area_key(area)))
+    final = month_end(year, month) + ERA5_DELAY
+    if os.path.exists(filename) and datetime.utcfromtimestamp(os.path.getmtime(filename)) > final:
+        return filename
+
+    print("Downloading ERA5 %04d-%02d" % (year, month), file = sys.stderr)
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    os.environ['CDSAPI_RC'] = cdsapircfile
+    download_era5_month(year, month, area, tmp_filename)
+    kind = netcdf_kind(tmp_filename)
+    if kind is not None:
+        raise ValueError("The downloaded ERA5 file is %s, which netcdf3.py can't read. Convert it with "
+                         "`nccopy -k classic %s %s`, and run the backfill again" % (kind, tmp_filename, filename))
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+def read_era5(filename, lat, lon):
+    """
+    Read the ERA5 variables at the cell closest to ($lat, $lon).
+    Returns a tuple (times, u10, v10, t2m, tcc, tp) of lists, with the units of ERA5 (m/s, K, fraction, m).
+    """
+    with netcdf3.Dataset(filename) as nc:
+        times = cf_times(time_variable(nc))
+        i, j = grid_index(nc, lat, lon)
+        series = [ point_series(nc.variables[name], i, j) for name in ERA5_NETCDF_VARIABLES ]
+    return (times, *series)
+
+
+def era5_to_meteo(times, u10, v10, t2m, tcc, tp):
+    """
+    Convert the ERA5 time series (see read_era5) to MintData, with the bounds of SIRANE (see meteo.py).
+
+    The wind direction is where the wind comes from, like OpenWeatherMap's.
+    NB scripts/meteo_ncep.py uses atan2(u, v), which is where the wind goes.
+    """
+    speeds = [ min(30, math.hypot(u, v)) for u, v in zip(u10, v10) ]
+    dirs = [ math.degrees(math.atan2(-u, -v)) % 360 for u, v in zip(u10, v10) ]
+    # 0 is no wind, 360 is north wind
+    dirs = [ 0 if speed <= 0 else (d if d > 0 else 360) for speed, d in zip(speeds, dirs) ]
+    temps = [ min(50, max(-50, t - 273.15)) for t in t2m ]
+    clouds = [ min(8, max(0, c * 8)) for c in tcc ] # Fraction to oktas
+    precips = [ max(0, p * 1000) for p in tp ] # Hourly accumulation in m to mm/h
+
+    return [ list(row) for row in zip(times, speeds, dirs, temps, clouds, precips) ]
+
+
+def meteo_data(start, end, lat, lon, cache_dir, cdsapircfile):
+    """Returns the MintData of the meteo from $start to $end (excluded), from ERA5"""
+    area = era5_area(lat, lon)
+    data = []
+    for year, month in months_between(start, end):
+        filename = get_era5_month(cache_dir, year, month, area, cdsapircfile)
+        data.extend(era5_to_meteo(*read_era5(filename, lat, lon)))
+    return slice_hours(data, start, end)
+
+
+# === Background concentrations (CAMS reanalysis) ===
+
+def download_cams_reanalysis_month(year, month, reanalysis_type, filename):
+    """Download the CAMS reanalysis of a month (the whole of Europe, one netcdf per species) to the zip file $filename"""
+    request = {
+        'variable': CAMS_REANALYSIS_VARIABLES,
+        'model': 'ensemble',
+        'level': '0',
+        'type': reanalysis_type,
+        'year': str(year),
+        'month': "%02d" % month,
+        'format': 'zip',
+    }
+    c = cdsapi.Client()
+    c.retrieve(CAMS_REANALYSIS_DATASET, request, filename)
+    return filename
+
+
+def get_cams_reanalysis_month(cache_dir, year, month, reanalysis_type, cdsapircfile):
+    """Returns the directory of the netcdf files of the CAMS reanalysis month in the cache, downloading them if needed"""
+    directory = os.path.join(cache_dir, "cams_reanalysis", "%s_%04d-%02d" % (reanalysis_type, year, month))
+    if os.path.isdir(directory):
+        return directory
+
+    print("Downloading the CAMS %s of %04d-%02d" % (reanalysis_type, year, month), file = sys.stderr)
+    os.makedirs(os.path.dirname(directory), exist_ok = True)
+    tmp_filename = "%s.%d.zip" % (directory, os.getpid())
+    tmp_directory = "%s.%d.tmp" % (directory, os.getpid())
+    os.environ['CDSAPI_RC'] = cdsapircfile
+    try:
+        download_cams_reanalysis_month(year, month, reanalysis_type, tmp_filename)
+        with zipfile.ZipFile(tmp_filename) as z:
+            z.extractall(tmp_directory)
+        for name in glob.glob(os.path.join(glob.escape(tmp_directory), "**", "*.nc"), recursive = True):
+            kind = netcdf_kind(name)
+            if kind is not None:
+                raise ValueError("The downloaded CAMS reanalysis file %s is %s, which netcdf3.py can't read. Convert "
+                                 "the files of %s with `nccopy -k classic` into %s, and run the backfill again"
+                                 % (name, kind, tmp_directory, directory))
+        os.replace(tmp_directory, directory)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+    return directory
+
+
+def species_index(varname):
+    """Returns the index of the variable $varname (eg. `no2` or `no2_conc`) in CAMS_REANALYSIS_SPECIES, or None"""
+    name = varname.lower()
+    if name.endswith("_conc"):
+        name = name[:-len("_conc")]
+    try:
+        return CAMS_REANALYSIS_SPECIES.index(name)
+    except ValueError:
+        return None
+
+
+def read_cams_reanalysis(directory, lat, lon):
+    """Read the CAMS reanalysis netcdf files in $directory at the cell closest to ($lat, $lon), and returns MintData"""
+    rows = {}
+    for filename in sorted(glob.glob(os.path.join(glob.escape(directory), "**", "*.nc"), recursive = True)):
+        with netcdf3.Dataset(filename) as nc:
+            times = cf_times(time_variable(nc))
+            i, j = grid_index(nc, lat, lon)
+            for name, variable in nc.variables.items():
+                k = species_index(name)
+                if k is None or len(variable.shape) < 3:
+                    continue
+                for t, value in zip(times, point_series(variable, i, j)):
+                    rows.setdefault(t, [t, None, None, None, None])[k + 1] = value # Already in µg/m3
+
+    return [ row for row in rows.values() if None not in row ]
+
+
+def background_data(start, end, lat, lon, cache_dir, cdsapircfile, reanalysis_type = None):
+    """Returns the MintData of the background concentrations from $start to $end (excluded), from the CAMS reanalysis"""
+    if reanalysis_type is None:
+        reanalysis_type = DEFAULT_CAMS_REANALYSIS_TYPE
+    data = []
+    for year, month in months_between(start, end):
+        directory = get_cams_reanalysis_month(cache_dir, year, month, reanalysis_type, cdsapircfile)
+        data.extend(read_cams_reanalysis(directory, lat, lon))
+    return slice_hours(data, start, end)
+
+
+# === Traffic ===
+
+def recorded_traffic_time(hour, sources = ('nm', 'tipi_datatr')):
+    """
+    Returns the replay time (aware) at which the traffic feeds of $hour (naive UTC) were recorded,
+    or None if one of them wasn't recorded during that hour (see capture.py)
+    """
+    time = (hour + timedelta(hours = 1)).replace(tzinfo = timezone.utc) - timedelta(microseconds = 1)
+    for source in sources:
+        try:
+            entry = capture.find(source, time)
+        except capture.ReplayError:
+            return None
+        recorded = datetime.strptime(entry['time'], capture.TIME_FORMAT).replace(tzinfo = timezone.utc)
+        if time - recorded > TRAFFIC_MAX_AGE:
+            return None
+    return time
+
+
+def snapshot_emislin(source, directory):
+    """
+    Copy the EmisLin file $source (the shared emis_lin.dat of the live runs, which they keep replacing) into
+    $directory, so that every chunk of the backfill modulates the same emissions, whenever it runs.
+
+    Returns a tuple (filename, hour) of the snapshot and of the hour (naive UTC) whose traffic its emissions are,
+    ie. the hour in which the live run wrote it. Returns None if there is no $source.
+    """
+    try:
+        f = open(source, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        # The file that was opened, even if a live run replaces it meanwhile
+        mtime = os.fstat(f.fileno()).st_mtime
+        fd, filename = tempfile.mkstemp(prefix = "emis_lin_base_", suffix = ".dat", dir = directory)
+        # mkstemp creates the file as private, but the inputs are read by other users, like the outputs
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as g:
+            shutil.copyfileobj(f, g)
+    hour = datetime.utcfromtimestamp(mtime).replace(minute = 0, second = 0, microsecond = 0)
+    return filename, hour
+
+
+def profile_factors(profile, hours, reference):
+    """
+    Returns the linear emission modulation factor of each of the $hours according to the TrafficProfile
+    (see emission.read_traffic_profile), relative to the traffic of the hour $reference of the modulated emissions
+    (see snapshot_emislin). Like emission.traffic_modulation, the factors are 1 without a $profile,
+    and for the hours it is missing.
+    """
+    base = profile.get((reference.weekday(), reference.hour)) if profile else None
+    if not base:
+        return [1] * len(hours)
+    return [ profile.get((t.weekday(), t.hour), base) / base for t in hours ]
+
+
+def read_backfill_config(configfile):
+    """Returns the [backfill] options as a dictionary, with their defaults"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    return {
+        'chunk_days': config.getint('backfill', 'chunk_days', fallback = DEFAULT_CHUNK_DAYS),
+        'era5_cdsapircfile': config.get('backfill', 'era5_cdsapircfile', fallback = DEFAULT_ERA5_CDSAPIRC),
+        'cams_reanalysis_type': config.get('backfill', 'cams_reanalysis_type', fallback = DEFAULT_CAMS_REANALYSIS_TYPE),
+        'ads_cdsapircfile': config.get('fond', 'cdsapircfile', fallback = 'atmosphere.cdsapirc'),
+        'cache_dir': config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR),
+        'latitude': float(config['GENERAL']['latitude']),
+        'longitude': float(config['GENERAL']['longitude']),
+    }
+
+
+if __name__ == "__main__":
+    # Write the meteo and background concentration files of a past period, from the reanalyses
+    parser = argparse.ArgumentParser()
+    parser.add_argument("start", help = "First day, eg. 2020-12-01")
+    parser.add_argument("end", help = "Last day (included)")
+    parser.add_argument("--config")
+    parser.add_argument("--meteo", help = "Meteo output file")
+    parser.add_argument("--fond", help = "Background concentrations output file")
+    args = parser.parse_args()
+
+    options = read_backfill_config(args.config if args.config is not None else "config.ini")
+    start, end = parse_date(args.start), parse_date(args.end) + timedelta(days = 1)
+    lat, lon, cache_dir = options['latitude'], options['longitude'], options['cache_dir']
+
+    if args.meteo is not None:
+        with open(args.meteo, 'w') as f:
+            print_sirane_meteo_input(meteo_data(start, end, lat, lon, cache_dir, options['era5_cdsapircfile']), file = f)
+    if args.fond is not None:
+        with open(args.fond, 'w') as f:
+            print_sirane_fond_input(background_data(start, end, lat, lon, cache_dir, options['ads_cdsapircfile'],
+                                                    options['cams_reanalysis_type']), file = f)
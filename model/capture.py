@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import configparser
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+"""
+Record/replay store for the data downloaded by the model (OpenWeatherMap JSON, CAMS netcdf, Tipi XML, NM CSV).
+
+When recording, every payload is stored as a gzip compressed blob named after the sha256 of its content
+(so an unchanged feed is only stored once), and an entry is appended to the time index:
+
+    <capture_dir>/blobs/<2 first hex digits>/<sha256>.gz
+    <capture_dir>/index/<YYYY-MM-DD>.jsonl
+
+Each line of the index is a JSON object with the capture time (UTC), the source (eg. 'owm', 'nm',
+'tipi_datatr', 'cams'), the key (the URL without credentials, or a description of the request),
+the digest and the size of the payload.
+
+When replaying (`model.py --replay <timestamp>`), the fetchers read the latest payload of their source
+recorded at or before the replay time instead of using the network, and now() returns the replay time,
+so that a past hour can be simulated again.
+"""
+
+DEFAULT_CAPTURE_DIR = "sirane/capture"
+
+# Query parameters which are removed from the URLs before they are stored in the index
+CREDENTIAL_PARAMS = {'appid', 'api_key', 'apikey', 'key', 'token', 'password'}
+
+# Number of days before the replay time in which recorded payloads are looked for
+REPLAY_MAX_DAYS = 2
+
+# Format of the capture times in the index (UTC)
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+TIMESTAMP_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"]
+
+_capture_dir = DEFAULT_CAPTURE_DIR
+_recording = False
+_replay_time = None
+_index_lock = threading.Lock()
+
+
+class ReplayError(Exception):
+    """Raised when there is no recorded payload to replay"""
+    pass
+
+
+def configure(capture_dir = None, record = False, replay = None):
+    """
+    Set the capture directory, whether the payloads are recorded, and the replay time
+    (an aware datetime, or None to use the network)
+    """
+    global _capture_dir, _recording, _replay_time
+    _capture_dir = DEFAULT_CAPTURE_DIR if capture_dir is None else capture_dir
+    _replay_time = replay
+    # Replayed payloads are not recorded again
+    _recording = bool(record) and replay is None
+
+
+def configure_from_file(configfile, replay = None):
+    """Configure the store from the [capture] section of the configuration file, see configure()"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    configure(capture_dir = config.get('capture', 'capture_dir', fallback = DEFAULT_CAPTURE_DIR),
+              record = config.getboolean('capture', 'record', fallback = False),
+              replay = replay)
+
+
+def recording():
+    return _recording
+
+
+def replaying():
+    return _replay_time is not None
+
+
+def parse_timestamp(timestamp):
+    """Parse a replay timestamp such as `2021-03-01T14:00` (in UTC, with an optional trailing Z)"""
+    timestamp = timestamp.rstrip("Z")
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(timestamp, fmt).replace(tzinfo = timezone.utc)
+        except ValueError:
+            pass
+    raise ValueError("Invalid timestamp %s, expected eg. 2021-03-01T14:00" % timestamp)
+
+
+# === Clock ===
+
+def now():
+    """Returns the current time (UTC, aware), which is the replay time when replaying"""
+    if _replay_time is not None:
+        return _replay_time
+    return datetime.now(timezone.utc)
+
+
+def utcnow():
+    """Same as now(), but naive like datetime.utcnow()"""
+    return now().replace(tzinfo = None)
+
+
+# === Recording ===
+
+def strip_credentials(url):
+    """Remove the credentials from $url (user:password@, and query parameters like appid)"""
+    parts = urlsplit(url)
+    netloc = parts.netloc.rpartition("@")[2]
+    query = [ (k, v) for k, v in parse_qsl(parts.query, keep_blank_values = True) if k.lower() not in CREDENTIAL_PARAMS ]
+    return urlunsplit((parts.scheme, netloc, parts.path, urlencode(query), parts.fragment))
+
+
+def blob_filename(digest):
+    return os.path.join(_capture_dir, "blobs", digest[:2], digest + ".gz")
+
+
+def index_filename(day):
+    return os.path.join(_capture_dir, "index", day.strftime("%Y-%m-%d") + ".jsonl")
+
+
+def store_blob(chunks):
+    """Store the payload given as an iterable of byte strings, and returns its (digest, size)"""
+    tmp_dir = os.path.join(_capture_dir, "blobs")
+    os.makedirs(tmp_dir, exist_ok = True)
+    tmp_filename = os.path.join(tmp_dir, "%d.%d.tmp" % (os.getpid(), threading.get_ident()))
+
+    h = hashlib.sha256()
+    size = 0
+    with gzip.open(tmp_filename, 'wb') as f:
+        for chunk in chunks:
+            h.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+
+    digest = h.hexdigest()
+    filename = blob_filename(digest)
+    if os.path.exists(filename):
+        # Already recorded
+        os.unlink(tmp_filename)
+    else:
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        os.replace(tmp_filename, filename)
+    return digest, size
+
+
+def add_entry(source, key, digest, size, time):
+    entry = {
+        'time': time.strftime(TIME_FORMAT),
+        'source': source,
+        'key': key,
+        'digest': digest,
+        'size': size,
+    }
+    filename = index_filename(time)
+    with _index_lock:
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        with open(filename, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def record(source, payload, key = None):
+    """Record the bytes $payload downloaded for $source (if recording). $key is the URL or a description of the request"""
+    if not _recording:
+        return None
+    digest, size = store_blob([payload])
+    return add_entry(source, strip_credentials(key) if key else key, digest, size, datetime.now(timezone.utc))
+
+
+def record_file(source, filename, key = None):
+    """Same as record(), for a payload which was downloaded to $filename"""
+    if not _recording:
+        return None
+    with open(filename, 'rb') as f:
+        digest, size = store_blob(iter(lambda: f.read(1024 * 1024), b""))
+    return add_entry(source, key, digest, size, datetime.now(timezone.utc))
+
+
+# === Replay ===
+
+def iter_entries(day):
+    try:
+        with open(index_filename(day)) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    except FileNotFoundError:
+        return
+
+
+def find(source, time = None):
+    """Returns the index entry of the latest payload of $source recorded at or before $time (the replay time by default)"""
+    if time is None:
+        time = now()
+    for days in range(REPLAY_MAX_DAYS + 1):
+        day = time - timedelta(days = days)
+        latest = None
+        for entry in iter_entries(day):
+            entry_time = datetime.strptime(entry['time'], TIME_FORMAT).replace(tzinfo = timezone.utc)
+            if entry['source'] == source and entry_time <= time:
+                latest = entry
+        if latest is not None:
+            return latest
+    raise ReplayError("No %s payload recorded in the %d days before %s" % (source, REPLAY_MAX_DAYS, time.isoformat()))
+
+
+def load(source, time = None):
+    """Returns the entry and the bytes of the payload of $source at $time (see find)"""
+    entry = find(source, time)
+    with gzip.open(blob_filename(entry['digest']), 'rb') as f:
+        return entry, f.read()
+
+
+def extract(source, directory, suffix = "", time = None):
+    """
+    Decompress the payload of $source at $time (see find) into $directory, and returns its filename.
+    The file is named after the digest of the payload, so it is only decompressed once.
+    """
+    entry = find(source, time)
+    filename = os.path.join(directory, "%s_%s%s" % (source, entry['digest'][:16], suffix))
+    if not os.path.exists(filename):
+        os.makedirs(directory, exist_ok = True)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with gzip.open(blob_filename(entry['digest']), 'rb') as src, open(tmp_filename, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_filename, filename)
+    return filename
+
+
+if __name__ == "__main__":
+    # List the payloads recorded on a day
+    parser = argparse.ArgumentParser()
+    parser.add_argument("day", help = "eg. 2021-03-01")
+    parser.add_argument("--config")
+    parser.add_argument("--source")
+    args = parser.parse_args()
+
+    configure_from_file(args.config if args.config is not None else "config.ini")
+    for entry in iter_entries(datetime.strptime(args.day, "%Y-%m-%d")):
+        if args.source is None or entry['source'] == args.source:
+            print("%s\t%s\t%s\t%d\t%s" % (entry['time'], entry['source'], entry['digest'][:16], entry['size'], entry['key']))
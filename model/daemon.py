@@ -0,0 +1,147 @@
+import sys
+import time
+import signal
+import threading
+import traceback
+import configparser
+from datetime import datetime, timedelta, timezone
+
+from fond import main as fond_main
+
+"""
+Scheduler for `model.py --daemon`.
+
+Instead of starting a new process every hour (cron + model.sh), the daemon stays in memory and runs the model
+at regular times. What doesn't change between runs stays loaded: the modules, the compiled segment maps and
+network lengths (see mapcache.py), and the forecast cache.
+
+- The runs are aligned on the feeds' publication times: they happen every `interval` minutes, `offset` minutes
+  after midnight UTC (eg. every hour at :10)
+- If a run takes longer than the interval, the missed runs are coalesced into the next one, instead of
+  running late one after the other
+- SIGUSR1 triggers a run immediately (or right after the current one)
+- SIGTERM stops the daemon after the current run
+- The day's CAMS forecast is prefetched into the forecast cache at `prefetch_time` (UTC), when it is published,
+  so that the runs don't wait in the CDS queue
+"""
+
+DEFAULT_INTERVAL = 60 # minutes
+DEFAULT_OFFSET = 10 # minutes
+DEFAULT_PREFETCH_TIME = "08:00"
+
+# Maximum number of seconds between two checks of the signal flags
+POLL_INTERVAL = 1
+
+
+def next_tick(now, interval, offset):
+    """
+    Returns the first run time strictly after $now, for runs every $interval minutes
+    starting $offset minutes after midnight
+    """
+    day = now.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    first = day + timedelta(minutes = offset)
+    if now < first:
+        # Before the first run of the day, the last run was yesterday
+        first -= timedelta(days = 1)
+    elapsed = (now - first).total_seconds()
+    n = int(elapsed // (interval * 60)) + 1
+    return first + timedelta(minutes = n * interval)
+
+
+def next_daily(now, time_s):
+    """Returns the first time strictly after $now at the time of day $time_s (eg. '08:00')"""
+    hour, minute = map(int, time_s.split(":"))
+    t = now.replace(hour = hour, minute = minute, second = 0, microsecond = 0)
+    if t <= now:
+        t += timedelta(days = 1)
+    return t
+
+
+def read_daemon_config(configfile):
+    """Returns the (interval, offset, prefetch_time) from the [daemon] section of the configuration file"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    interval = config.getfloat('daemon', 'interval', fallback = DEFAULT_INTERVAL)
+    offset = config.getfloat('daemon', 'offset', fallback = DEFAULT_OFFSET)
+    prefetch_time = config.get('daemon', 'prefetch_time', fallback = DEFAULT_PREFETCH_TIME)
+    if interval <= 0:
+        raise ValueError("The daemon interval must be positive")
+    return interval, offset, prefetch_time
+
+
+def start_prefetch(configfile, tohour):
+    """
+    Download today's CAMS forecast up to $tohour into the forecast cache in a background thread (see `fond.py --prefetch`).
+    Returns the thread
+    """
+    def prefetch():
+        try:
+            fond_main(configfile = configfile, tohour = tohour, prefetch = True)
+        except Exception:
+            print("Could not prefetch the forecast:", file = sys.stderr)
+            traceback.print_exc()
+
+    thread = threading.Thread(target = prefetch, name = "prefetch", daemon = True)
+    thread.start()
+    return thread
+
+
+def run_daemon(run, configfile = None, prefetch_tohour = 24):
+    """
+    Call &run() according to the schedule from the configuration file (see the module's documentation), until SIGTERM.
+    The exceptions raised by &run are printed, and don't stop the daemon.
+
+    $prefetch_tohour is the last hour of today's forecast the runs need (see `fond.py --tohour`).
+    """
+    if configfile is None:
+        configfile = "config.ini"
+    interval, offset, prefetch_time = read_daemon_config(configfile)
+
+    flags = {'run': False, 'stop': False}
+
+    def on_usr1(signum, frame):
+        flags['run'] = True
+
+    def on_term(signum, frame):
+        flags['stop'] = True
+
+    signal.signal(signal.SIGUSR1, on_usr1)
+    signal.signal(signal.SIGTERM, on_term)
+
+    now = datetime.now(timezone.utc)
+    tick = next_tick(now, interval, offset)
+    prefetch_tick = next_daily(now, prefetch_time)
+    print("Daemon started, next run at %s" % tick.isoformat(), file = sys.stderr)
+
+    while not flags['stop']:
+        now = datetime.now(timezone.utc)
+
+        if now >= prefetch_tick:
+            print("Prefetching the CAMS forecast", file = sys.stderr)
+            start_prefetch(configfile, prefetch_tohour)
+            prefetch_tick = next_daily(now, prefetch_time)
+
+        if flags['run'] or now >= tick:
+            reason = "signal" if flags['run'] else "schedule"
+            flags['run'] = False
+            print("Starting a run (%s) at %s" % (reason, now.isoformat()), file = sys.stderr)
+            try:
+                run()
+            except Exception:
+                traceback.print_exc()
+
+            # Coalesce the ticks which were missed during the run
+            now = datetime.now(timezone.utc)
+            new_tick = next_tick(now, interval, offset)
+            missed = round((new_tick - tick).total_seconds() / (interval * 60)) - 1
+            if missed > 0:
+                print("Skipped %d run(s) which were due during the last run" % missed, file = sys.stderr)
+            tick = new_tick
+            print("Next run at %s" % tick.isoformat(), file = sys.stderr)
+            continue
+
+        # NB sleep() is interrupted by the signals, so a short sleep is enough to react quickly
+        remaining = (min(tick, prefetch_tick) - now).total_seconds()
+        time.sleep(max(0, min(remaining, POLL_INTERVAL)))
+
+    print("Daemon stopped", file = sys.stderr)
@@ -6,10 +6,16 @@ import sys
 import csv
 import re
 import os
+import json
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
-import requests
+from mapcache import DEFAULT_CACHE_DIR
+import metrics
+from fetch import get as http_get, record_response
+import capture
 
 # TODO what is DataTRT (vs. DataTR)
 
@@ -19,65 +25,304 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def download_latest_data(auth, file_regex = None):
+# XML namespaces because ElementTree parses child elements of d2LogicalModel namespaced
+NS = {
+    'd2': "http://datex2.eu/schema/2/2_0",
+    'xsi': "http://www.w3.org/2001/XMLSchema-instance"
+}
+PAYLOAD_TAG = "{%s}payloadPublication" % NS['d2']
+SITE_MEASUREMENTS_TAG = "{%s}siteMeasurements" % NS['d2']
+
+DATA_TR_REGEX = r"TraficBreizhNantes_1_DataTR_\d{8}_\d{6}.xml"
+DATA_TRT_REGEX = r"TraficBreizhNantes_1_DataTRT_\d{8}_\d{6}.xml"
+
+DATA_TR_HEADER = ["measurementSiteReference", "measurementTimeDefault", "TrafficFlow", "TrafficConcentration", "TrafficSpeed", "numberOfInputValuesUsed"]
+
+NANTES_URL = "http://diffusion-numerique.info-routiere.gouv.fr/tipitrafic/TraficBreizhNantes/"
+
+
+"""
+SiteMeasurement is a typed DataTR csv row (see parse_xml_file), so the indices of both are the same.
+The numbers are ints (or floats if they're not integers), and missing values are None.
+"""
+SiteMeasurement = namedtuple('SiteMeasurement', ['site_id', 'time', 'flow', 'concentration', 'speed', 'input_count'])
+
+
+FOLDER_REGEX = r"\d{4}-\d{2}-\d{2}_\d{2}/"
+FOLDER_FORMAT = "%Y-%m-%d_%H/"
+FILE_TIME_REGEX = r"^(.*_)(\d{8}_\d{6})\.xml$"
+FILE_TIME_FORMAT = "%Y%m%d_%H%M%S"
+WALKED_AT_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Walk the index at least once a day, even if the guesses from the index cache keep working
+INDEX_CACHE_MAX_AGE = timedelta(days = 1)
+# Number of matches remembered for each index page
+INDEX_CACHE_MATCHES = 10
+
+
+"""
+The index cache is a JSON file which remembers what we saw in the index pages, so that we don't have to walk
+the index on every run. It is a dictionary with the keys:
+
+- 'pages': a dictionary of page urls mapping to a dictionary with the keys
+  'etag' and 'last_modified' (for conditional requests) and 'matches' (the last matches of the page)
+- 'files': a dictionary of file regexes mapping to the latest file we've seen, as a dictionary with the keys
+  'folder' and 'file' (the names), 'walked_at' (UTC time of the last index walk), 'lag' (in seconds, see guess_latest_file)
+  and 'period' (the number of seconds between two files, or None if it's irregular)
+"""
+
+
+def read_index_cache(filename):
+    """Read the index cache file, returns an empty cache if there is none"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index_cache(filename, cache):
+    """Write the index cache file"""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok = True)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(cache, f, indent = 1)
+    os.replace(tmp_filename, filename)
+
+
+def parse_file_time(filename):
+    """Returns (prefix, datetime) of a Datex2 xml filename, or None if it doesn't have the usual format"""
+    m = re.match(FILE_TIME_REGEX, filename)
+    if m is None:
+        return None
+    return m.group(1), datetime.strptime(m.group(2), FILE_TIME_FORMAT)
+
+
+def fetch_index_matches(url, auth, pattern, cache):
     """
-    Find the latest Datex2 xml file by navigating the index.
-    Returns the filename
+    Fetch the index page at $url and returns the list of the matches of $pattern in it.
+    If the page didn't change since the last time (according to the index cache), it isn't downloaded again.
     """
-    if file_regex is None:
-        file_regex = "TraficBreizhNantes_1_DataTR_\d{8}_\d{6}.xml"
+    pages = cache.setdefault('pages', {})
+    entry = pages.get(url)
+
+    # Conditional request
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    r = http_get(url, auth = auth, headers = headers)
+    metrics.count('index_requests')
+    if r.status_code == 304 and entry is not None:
+        return entry['matches']
+    r.raise_for_status()
+    metrics.count('bytes_downloaded', metrics.response_size(r))
+
+    matches = re.findall(pattern, r.text)[-INDEX_CACHE_MATCHES:]
+    pages[url] = {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'matches': matches,
+    }
+    return matches
+
+
+def file_period(filenames):
+    """
+    Returns the number of seconds between two consecutive files in the list of $filenames,
+    or None if they aren't regularly spaced.
+    """
+    times = [ parse_file_time(x) for x in filenames ]
+    times = sorted(set( t for _prefix, t in filter(None, times) ))
+    periods = set( (b - a).total_seconds() for a, b in zip(times, times[1:]) )
+    if len(periods) != 1:
+        return None
+    return periods.pop()
 
-    nantes_url = "http://diffusion-numerique.info-routiere.gouv.fr/tipitrafic/TraficBreizhNantes/"
 
+def walk_index(auth, file_regex, cache):
+    """
+    Find the latest Datex2 xml file by navigating the index, and remember it in the index cache.
+    Returns a tuple of (folder, filename)
+    """
     # Fetch index page and find the latest folder
-    r = requests.get(nantes_url, auth = auth)
-    r.raise_for_status()
-    last_folder = re.findall("\d{4}-\d{2}-\d{2}_\d{2}/", r.text)[-1]
+    last_folder = fetch_index_matches(NANTES_URL, auth, FOLDER_REGEX, cache)[-1]
 
     # Fetch folder page and find the latest XML file
     print("GET …/%s" % last_folder)
-    hour_folder_url = nantes_url + last_folder
-    r = requests.get(hour_folder_url, auth = auth)
-    r.raise_for_status()
-    last_file = re.findall(file_regex, r.text)[-1]
-    # last_file will also be the filename
+    hour_folder_url = NANTES_URL + last_folder
+    files = fetch_index_matches(hour_folder_url, auth, file_regex, cache)
+    last_file = files[-1]
+
+    # Only keep the pages we'll need next time
+    cache['pages'] = dict( (url, v) for url, v in cache['pages'].items() if url in (NANTES_URL, hour_folder_url) )
+
+    # Remember the file, and how late its timestamp is compared to the current time
+    now = datetime.utcnow()
+    previous = cache.setdefault('files', {}).get(file_regex, {})
+    period = file_period(files)
+    if period is None:
+        period = previous.get('period')
+    lag = None
+    parsed = parse_file_time(last_file)
+    if parsed is not None and parsed[1].strftime(FOLDER_FORMAT) == last_folder:
+        # Guessing is only possible if the folder name can be deduced from the file name
+        lag = (parsed[1] - now).total_seconds()
+    cache['files'][file_regex] = {
+        'folder': last_folder,
+        'file': last_file,
+        'walked_at': now.strftime(WALKED_AT_FORMAT),
+        'lag': lag,
+        'period': period,
+    }
+
+    return last_folder, last_file
+
+
+def guess_latest_file(entry, now):
+    """
+    Guess the name of the latest Datex2 xml file from the index cache $entry (for a file regex)
+    and the current UTC time $now. Returns a tuple of (folder, filename), or None if we can't guess.
+
+    The files are published every 'period' seconds, and when we last walked the index, the latest file's
+    timestamp was 'lag' seconds from the current time (this includes the timezone and the publication delay).
+    So the latest file we can expect is the last one whose timestamp is before now + lag.
+    """
+    if not entry or entry.get('lag') is None or not entry.get('period'):
+        return None
+    if now - datetime.strptime(entry['walked_at'], WALKED_AT_FORMAT) > INDEX_CACHE_MAX_AGE:
+        return None
+
+    prefix, file_time = parse_file_time(entry['file'])
+    latest = now + timedelta(seconds = entry['lag'])
+    steps = max(0, (latest - file_time).total_seconds() // entry['period'])
+    guess_time = file_time + timedelta(seconds = steps * entry['period'])
+
+    return guess_time.strftime(FOLDER_FORMAT), prefix + guess_time.strftime(FILE_TIME_FORMAT) + ".xml"
+
+
+def is_stale(r, period, now):
+    """
+    Whether the guessed file of the response $r is older than the $period (in seconds) between two files at the UTC time $now,
+    according to its Last-Modified header: a newer file should then have been published since, and the guess was too early
+    (eg. the files are published sooner than when we last walked the index). Returns False without a Last-Modified header.
+    """
+    last_modified = r.headers.get('Last-Modified')
+    if not last_modified or not period:
+        return False
+    try:
+        published = parsedate_to_datetime(last_modified)
+    except (TypeError, ValueError):
+        return False
+    if published.tzinfo is not None:
+        published = published.astimezone(timezone.utc).replace(tzinfo = None)
+    return (now - published).total_seconds() > period
+
+
+def get_latest_file(auth, file_regex = None, index_cache = None, stream = False):
+    """
+    Find the latest Datex2 xml file and GET it.
+    Returns a tuple of (response, filename). The response is streamed if $stream is True.
+
+    If $index_cache is the filename of the index cache, we first try to guess the latest filename.
+    The index is only walked if the guess was wrong (the file doesn't exist, or it is stale, see is_stale),
+    and its pages are only downloaded if they changed.
+    When recording (see capture.py), only the file which is returned is recorded, not a wrong guess.
+    """
+    if file_regex is None:
+        file_regex = DATA_TR_REGEX
+
+    source = 'tipi_datatrt' if file_regex == DATA_TRT_REGEX else 'tipi_datatr'
+    if capture.replaying():
+        # The recorded file, no need to find it
+        r = http_get(NANTES_URL, stream = stream, source = source)
+        return r, os.path.basename(r.url)
+
+    cache = {} if index_cache is None else read_index_cache(index_cache)
+    entry = cache.get('files', {}).get(file_regex)
+
+    r = None
+    now = capture.utcnow()
+    guess = guess_latest_file(entry, now)
+    if guess is not None:
+        folder, last_file = guess
+        print("GET …/%s%s (guessed)" % (folder, last_file))
+        r = http_get(NANTES_URL + folder + last_file, auth = auth, stream = stream)
+        if r.status_code == 404 or (r.status_code == 200 and is_stale(r, entry['period'], now)):
+            metrics.count('guess_misses')
+            r.close()
+            r = None
+        else:
+            entry['folder'], entry['file'] = folder, last_file
+            record_response(source, r, stream)
+
+    if r is None:
+        with metrics.stage('datex2.walk_index'):
+            folder, last_file = walk_index(auth, file_regex, cache)
+        print("GET …/%s" % last_file)
+        r = http_get(NANTES_URL + folder + last_file, auth = auth, stream = stream, source = source)
 
-    # Download file
-    print("GET …/%s" % last_file)
-    file_url = hour_folder_url + last_file
-    r = requests.get(file_url, auth = auth)
     r.raise_for_status()
+    if index_cache is not None:
+        write_index_cache(index_cache, cache)
+
+    return r, last_file
+
+
+def download_latest_data(auth, file_regex = None, index_cache = None):
+    """
+    Find the latest Datex2 xml file (see get_latest_file), and download it.
+    Returns the filename
+    """
+    r, last_file = get_latest_file(auth, file_regex, index_cache)
+    # last_file will also be the filename
     with open(last_file, 'wb') as f:
         f.write(r.content)
     
     return last_file
 
 
-def parse_xml_file(filename):
-    """
-    Parses the Datex2 xml file, and returns a list of csv rows, including header
+def iter_site_measurements_elements(source):
     """
+    Parse the Datex2 xml file incrementally, and yield its siteMeasurements elements.
+    $source is a filename or a binary file object (eg. an HTTP response stream).
 
-    # XML namespaces because ElementTree parses child elements of d2LogicalModel namespaced
-    ns = {
-        'd2': "http://datex2.eu/schema/2/2_0",
-        'xsi': "http://www.w3.org/2001/XMLSchema-instance"
-    }
-    tree = ET.parse(filename)
-    root = tree.getroot()
-
-    data = []
-    for m in root.findall('d2:payloadPublication/d2:siteMeasurements', ns):
-        siteId = m.find('d2:measurementSiteReference', ns).get('id')
-        time = m.find('d2:measurementTimeDefault', ns).text
+    The elements are cleared once they have been handled, so that the memory usage
+    doesn't depend on the size of the file.
+    """
+    payload = None
+    for event, elem in ET.iterparse(source, events = ('start', 'end')):
+        if event == 'start':
+            if elem.tag == PAYLOAD_TAG:
+                payload = elem
+        elif elem.tag == SITE_MEASUREMENTS_TAG:
+            yield elem
+            # Drop the elements we're done with. The ones still being parsed are kept
+            # by the parser, and are yielded on their end event anyway.
+            if payload is not None:
+                payload.clear()
+
+
+def iter_xml_rows(source):
+    """
+    Parse the Datex2 DataTR xml file incrementally, and yield its csv rows (without the header).
+    $source is a filename or a binary file object.
+    """
+    nbInputValues = None
+    for m in iter_site_measurements_elements(source):
+        siteId = m.find('d2:measurementSiteReference', NS).get('id')
+        time = m.find('d2:measurementTimeDefault', NS).text
 
         row = [siteId, time]
         # This would work, but ElementTree doesn't support `*[position]` selectors
-        #m.findall('d2:measuredValue/d2:measuredValue/d2:basicData/*[2]/*[1]', ns)
+        #m.findall('d2:measuredValue/d2:measuredValue/d2:basicData/*[2]/*[1]', NS)
         items = 3 # The number of values to insert
-        for basicData in m.findall('d2:measuredValue/d2:measuredValue/d2:basicData', ns):
+        for basicData in m.findall('d2:measuredValue/d2:measuredValue/d2:basicData', NS):
             # Print the data's label (unneeded)
-            datatype = basicData.get('{%s}type' % ns['xsi'])
+            datatype = basicData.get('{%s}type' % NS['xsi'])
 
             value = basicData[1][0].text
             nbInputValues = basicData[1].get("numberOfInputValuesUsed")
@@ -92,32 +337,52 @@ def parse_xml_file(filename):
         
         row.append(nbInputValues)
 
-        data.append(row)
+        yield row
+
+
+def parse_number(value):
+    """Convert a value from the xml file to an int or a float, or None if it's missing"""
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
 
-    header = ["measurementSiteReference", "measurementTimeDefault", "TrafficFlow", "TrafficConcentration", "TrafficSpeed", "numberOfInputValuesUsed"]
-    data.insert(0, header)
+
+def iter_site_measurements(source):
+    """
+    Parse the Datex2 DataTR xml file incrementally, and yield SiteMeasurement records.
+    $source is a filename or a binary file object.
+    """
+    for row in iter_xml_rows(source):
+        siteId, time, flow, concentration, speed = row[:5]
+        yield SiteMeasurement(siteId, time,
+                              parse_number(flow), parse_number(concentration), parse_number(speed),
+                              parse_number(row[-1]))
+
+
+def parse_xml_file(filename):
+    """
+    Parses the Datex2 xml file, and returns a list of csv rows, including header
+    """
+    data = list(iter_xml_rows(filename))
+
+    data.insert(0, DATA_TR_HEADER)
 
     return data
 
 
 # Copy pasted from parse_xml_file
 def parse_trt_xml(filename):
-    # XML namespaces because ElementTree parses child elements of d2LogicalModel namespaced
-    ns = {
-        'd2': "http://datex2.eu/schema/2/2_0",
-        'xsi': "http://www.w3.org/2001/XMLSchema-instance"
-    }
-    tree = ET.parse(filename)
-    root = tree.getroot()
-
     data = []
-    for m in root.findall('d2:payloadPublication/d2:siteMeasurements', ns):
-        siteId = m.find('d2:measurementSiteReference', ns).get('id')
-        time = m.find('d2:measurementTimeDefault', ns).text
+    for m in iter_site_measurements_elements(filename):
+        siteId = m.find('d2:measurementSiteReference', NS).get('id')
+        time = m.find('d2:measurementTimeDefault', NS).text
 
-        basicData = m.find('d2:measuredValue/d2:measuredValue/d2:basicData', ns)
+        basicData = m.find('d2:measuredValue/d2:measuredValue/d2:basicData', NS)
         # Get the data's label (unneeded)
-        datatype = basicData.get('{%s}type' % ns['xsi'])
+        datatype = basicData.get('{%s}type' % NS['xsi'])
         value = basicData[0][0].text
         nbInputValues = basicData[0].get("numberOfInputValuesUsed")
 
@@ -131,12 +396,30 @@ def parse_trt_xml(filename):
     return data
 
 
-def main(configfile = None, outputfile = None, alsoTRT = False):
-    # Argument defaults
-    if configfile is None:
-        configfile = "config.ini"
+def stream_latest_measurements(auth, index_cache = None, rows = False):
+    """
+    Find the latest DataTR file (see get_latest_file), and parse it as it is being downloaded.
+    Returns the list of SiteMeasurement records, or if $rows, the list of csv rows of iter_xml_rows
+    (with the values as they are written in the file).
+    """
+    r, _last_file = get_latest_file(auth, index_cache = index_cache, stream = True)
+    with r:
+        r.raw.decode_content = True # Handle gzip transfer encoding
+        data = list((iter_xml_rows if rows else iter_site_measurements)(r.raw))
+        metrics.count('bytes_downloaded', metrics.response_size(r))
+        metrics.count('rows', len(data))
+        return data
+
+
+def parse_time(timestamp):
+    """Parse the time of a measurement into a datetime"""
+    # Remove colon in UTC offset (eg. `+01:00`) so that it works in Python < 3.7
+    timestamp = re.sub(r'(\+\d{2}):', r'\1', timestamp)
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S%z')
+
 
-    # Read configuration
+def read_auth(configfile):
+    """Read the Tipi credentials from the configuration file"""
     config = configparser.ConfigParser()
     config.read(configfile)
 
@@ -148,13 +431,40 @@ def main(configfile = None, outputfile = None, alsoTRT = False):
     if re.fullmatch('[A-Z_]+', auth[1]): # eg. 'TIPI_USERNAME'
         raise ValueError("Missing tipitrafic password")
 
+    return auth
 
-    # Download data and parse it
-    filename = download_latest_data(auth)
-    data = parse_xml_file(filename)
 
-    # Delete downloaded file
-    os.unlink(filename)
+def index_cache_filename(configfile):
+    """Returns the filename of the index cache, in the cache directory from the configuration file"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+    return os.path.join(cache_dir, "tipi_index.json")
+
+
+def fetch(configfile = None, rows = False):
+    """
+    Download and parse the latest DataTR file.
+    Returns a tuple of (list of SiteMeasurement, data time), or of (list of csv rows, data time) if $rows
+    (see stream_latest_measurements)
+    """
+    if configfile is None:
+        configfile = "config.ini"
+
+    auth = read_auth(configfile)
+    data = stream_latest_measurements(auth, index_cache_filename(configfile), rows = rows)
+    # The time is the second column of both
+    return data, parse_time(data[0][1])
+
+
+def main(configfile = None, outputfile = None, alsoTRT = False):
+    # Argument defaults
+    if configfile is None:
+        configfile = "config.ini"
+
+    # Download data and parse it, keeping the values as they are written in the file
+    data, dt = fetch(configfile, rows = True)
+    data.insert(0, DATA_TR_HEADER)
 
     # Write CSV data
     if outputfile is not None:
@@ -167,17 +477,13 @@ def main(configfile = None, outputfile = None, alsoTRT = False):
     
     if alsoTRT:
         # Do the same with the DataTRT file
-        filename = download_latest_data(auth, "TraficBreizhNantes_1_DataTRT_\d{8}_\d{6}.xml")
+        filename = download_latest_data(read_auth(configfile), DATA_TRT_REGEX, index_cache_filename(configfile))
         data = parse_trt_xml(filename)
         writer = csv.writer(sys.stdout)
         writer.writerows(data)
         os.unlink(filename)
 
     # Return data time
-    timestamp = data[1][1]
-    # Remove colon in UTC offset (eg. `+01:00`) so that it works in Python < 3.7
-    timestamp = re.sub(r'(\+\d{2}):', r'\1', timestamp)
-    dt = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S%z')
     return dt
 
 
@@ -3,12 +3,21 @@
 import os
 import sys
 import csv
-from datetime import datetime, timezone
-import functools
+from datetime import datetime, timezone, timedelta
 import configparser
+import bisect
+from array import array
+from collections import namedtuple
 
-from trafic_nm import main as trafic_main
-from datex2 import main as datex2_main
+from trafic_nm import fetch as trafic_fetch, TrafficRecord
+from datex2 import fetch as datex2_fetch, DATA_TR_HEADER
+from mapcache import load_compiled, DEFAULT_CACHE_DIR
+from trafficstate import TrafficState, store_filename
+import emission_factors
+import sirane_writer
+import incremental
+import capture
+import metrics
 
 
 """
@@ -32,46 +41,110 @@ Python datatypes:
   ie. `for segment_id in segment_map[traffic_id]`
 - NetworkLengthMap is a dictionary of network segment ids mapping to the segment lengths in meters
   ie. `segment_length = network_length_map[network_id]`
+- AggregationMatrix is a sparse matrix in CSR format, with the network segments as rows and
+  the traffic ids of one or more SegmentMaps as columns. The weights are the segment lengths in km.
+  It turns emissions in g/s/km per traffic id into emissions in g/s per network segment.
+  cf. compile_aggregation
+- ColumnEmissions is a 4-tuple of arrays (e_NOx, e_PM10, e_PM25, present) indexed by AggregationMatrix column,
+  where present[column] is 1 if there was data for that traffic id, and 0 otherwise.
+  cf. new_column_emissions
 """
 
 
+# Emission graph
+# TODO document data source
+EMISSION_V    = [       10,       30,       60,       90,       11,      130 ] # km/h
+EMISSION_NOx  = [     0.55,     0.38,     0.28,     0.30,     0.42,     0.58 ] # g/km
+EMISSION_PM10 = [ 0.005886, 0.004578, 0.001730, 0.004578, 0.006540, 0.007848 ] # g/km
+EMISSION_PM25 = [ 0.003114, 0.002422,  0.00173, 0.002422,  0.00346, 0.004152 ] # g/km
+
+
+def compile_emission_graph(V, *species):
+    """
+    Precompute the linear pieces of the emission graph for compute_emissions.
+
+    $V is the list of speeds in km/h, and each of the $species is the list of the
+    emission factors in g/km at those speeds.
+
+    Returns a tuple (v_min, bounds, intercepts, slopes) where:
+    - v_min is the lowest speed of the graph
+    - bounds is the sorted list of the upper speeds of the intervals
+    - the piece k of each species is intercepts[species][k] + slopes[species][k] * speed, in g/s per vehicle/h:
+      piece 0 is below v_min, pieces 1 to len(bounds) are the intervals (bounds[k-1] is the upper speed of piece k),
+      and the last piece is above the highest speed
+    """
+    # The intervals are searched left to right for the first speed ≥ the input speed,
+    # so a speed that isn't larger than all the speeds before it can never be a right bound
+    # (eg. the 11 km/h entry). We only keep the reachable intervals so that we can bisect.
+    first, last = 0, len(V) - 1
+    bounds = []
+    pieces = [(first, first)]
+    for i in range(1, len(V)):
+        if bounds and V[i] <= bounds[-1]:
+            continue
+        bounds.append(V[i])
+        pieces.append((i - 1, i))
+    pieces.append((last, last))
+
+    # In an interval, the emission factor is t * left + (1-t) * right with t = (speed - v_left) / (v_right - v_left),
+    # ie. right + (speed - v_left) * slope. The pieces outside of the graph are constant (t = 1).
+    # We divide by 3600 to convert to /s from g/h
+    intercepts, slopes = [], []
+    for points in species:
+        a, b = array('d'), array('d')
+        for left, right in pieces:
+            if left == right:
+                a.append(points[left] / 3600)
+                b.append(0)
+            else:
+                slope = (points[left] - points[right]) / (V[right] - V[left])
+                a.append((points[right] - V[left] * slope) / 3600)
+                b.append(slope / 3600)
+        intercepts.append(a)
+        slopes.append(b)
+
+    return V[first], bounds, intercepts, slopes
+
+
+EMISSION_GRAPH = compile_emission_graph(EMISSION_V, EMISSION_NOx, EMISSION_PM10, EMISSION_PM25)
+
+# Species of the emissions computed by the emission functions, in order (see emission_factors.py)
+EMISSION_SPECIES = ['NOx', 'PM10', 'PM25']
+
+
+def graph_pieces(graph, speeds):
+    """Returns the list of the pieces of the emission $graph (see compile_emission_graph) of $speeds"""
+    v_min, bounds, _intercepts, _slopes = graph
+    bisect_left = bisect.bisect_left
+    return [ 0 if speed < v_min else bisect_left(bounds, speed) + 1 for speed in speeds ]
+
+
+def compute_emissions(speeds, rates, graph = EMISSION_GRAPH):
+    """
+    Compute the emissions in g/s/km for a whole batch of traffic data,
+    given the speeds in km/h and the vehicule rates in 1/h.
+
+    $speeds and $rates are sequences of the same length.
+    Returns a list of (e_NOx, e_PM10, e_PM25) tuples, one for each (speed, rate) pair.
+    They should be multiplied by the network segment's length afterwards.
+
+    The pieces of the speeds are looked up once, then each species is computed over the whole batch.
+    """
+    _v_min, _bounds, intercepts, slopes = graph
+    pieces = graph_pieces(graph, speeds)
+    columns = [ array('d', [ (a[k] + b[k] * speed) * rate for k, speed, rate in zip(pieces, speeds, rates) ])
+                for a, b in zip(intercepts, slopes) ]
+    return list(zip(*columns))
+
+
 def compute_emission(speed, rate):
     """
     Compute the emissions in g/s/km given a speed in km/h and a vehicule rate in 1/h.
     They should be multiplied by the network segment's length afterwards
-    """
-    # TODO document data source
-    V    = [       10,       30,       60,       90,       11,      130 ] # km/h
-    NOx  = [     0.55,     0.38,     0.28,     0.30,     0.42,     0.58 ] # g/km
-    PM10 = [ 0.005886, 0.004578, 0.001730, 0.004578, 0.006540, 0.007848 ] # g/km
-    PM25 = [ 0.003114, 0.002422,  0.00173, 0.002422,  0.00346, 0.004152 ] # g/km
-
-    # Find interval
-    i_last = len(V) - 1
-    if speed < V[0]:
-        i_left, i_right = 0, 0
-    elif speed > V[i_last]:
-        i_left, i_right = i_last, i_last
-    else:
-        i = 1
-        while not speed <= V[i]:
-            i += 1
-        i_left, i_right = i-1, i
-
-    # Define interpolation
-    if i_left != i_right:
-        t = (speed - V[i_left]) / (V[i_right] - V[i_left])
-    else:
-        t = 1 # When speed is ≤ 10 or > 130
-    def interpolate(points):
-        return t * points[i_left] + (1-t) * points[i_right]
-    
-    # We divide by 3600 to convert to /s from g/h
-    e_NOx = interpolate(NOx) * rate / 3600
-    e_PM10 = interpolate(PM10) * rate / 3600
-    e_PM25 = interpolate(PM25) * rate / 3600
 
-    return e_NOx, e_PM10, e_PM25
+    See compute_emissions to compute the emissions of many datapoints at once
+    """
+    return compute_emissions([speed], [rate])[0]
 
 
 class SkipEmissionComputation(Exception):
@@ -89,13 +162,18 @@ def insert_emission(data, traffic_data, find_segments, extract_parameters):
                         It may throw a SkipEmissionComputation exception to skip the current datapoint
     """
 
+    # Gather the parameters of the whole batch before computing the emissions at once
+    rows, speeds, rates = [], [], []
     for row in traffic_data:
         try:
             speed, rate = extract_parameters(row)
         except SkipEmissionComputation:
             continue
-        emissions_per_km = compute_emission(speed, rate)
+        rows.append(row)
+        speeds.append(speed)
+        rates.append(rate)
 
+    for row, emissions_per_km in zip(rows, compute_emissions(speeds, rates)):
         # Update the network segments corresponding to the row data
         for segment_id, segment_length in find_segments(row):
             # Convert segment_length to kilometers
@@ -117,48 +195,117 @@ def write_emislin(data, segment_count, file = sys.stdout):
 
     cf. <http://air.ec-lyon.fr/SIRANE/Article.php?&File=&Id=SIRANE_File_EmisLin&Lang=FR>
     """
-    # Define our write function
-    p = functools.partial(print, sep = "\t", file = file)
+    # SIRANE wants the segment ids to be 0-based and to all be present in the emission file,
+    # so we start with columns full of zeros and fill in the segments we have data for
+    ids = [ str(i) for i in range(segment_count) ]
+    e_NOx, e_PM10, e_PM25 = [ ["0"] * segment_count for _ in range(3) ]
+    for k, v in data.items():
+        try:
+            i = int(k)
+        except ValueError:
+            continue
+        # data keys are strings, and must be written exactly like the ids
+        if 0 <= i < segment_count and ids[i] == k:
+            e_NOx[i], e_PM10[i], e_PM25[i] = map(str, v)
 
-    # Headers
-    p("Id", "NO", "NO2", "PM10", "PM25", "O3")
-    
-    # SIRANE wants the segment ids to be 0-based and to all be present in the emission file
-    for i in range(segment_count):
-        k = str(i) # data keys are strings
-        v = data.get(k, [0, 0, 0])
-        p(i, 0, *v, 0) # NO and O3 emissions are set to 0
+    # NO and O3 emissions are set to 0
+    e_NO = sirane_writer.constant_column(0, segment_count)
+    e_O3 = sirane_writer.constant_column(0, segment_count)
+    sirane_writer.write_columns(file,
+        ["Id", "NO", "NO2", "PM10", "PM25", "O3"],
+        [ids, e_NO, e_NOx, e_PM10, e_PM25, e_O3])
 
 
-def write_evolemislin(data, file = sys.stdout):
+def write_evolemislin(data, file = sys.stdout, lin_modulations = 1):
     """
-    Write the data of a merged EvolEmisLin and EvolEmisSurf to file, with hardcoded modulation factors.
-    The modulation factor is set to 1 for linear emissions, and 0 for surface emissions.
+    Write the data of a merged EvolEmisLin and EvolEmisSurf to file.
+    The modulation factor is set to 1 for linear emissions (unless specified), and 0 for surface emissions.
 
-    $data is a list of (datetime, emis_lin_filename, emis_surf_filename) tuples of type (datetime, str, str)
+    $data is a list of (datetime, emis_lin_filename, emis_surf_filename) tuples of type (datetime, str, str),
+    or (datetime, emis_lin_filename, emis_surf_filename, lin_factor) tuples to set the linear modulation factors.
+    lin_factor is either a number, used for every species of every linear modulation, or a list of
+    $lin_modulations factors (one per linear modulation, cf. modulation.py), each of which is either a number
+    or a tuple of the factors of the species NO, NO2, PM10, PM25 and O3.
 
-    NB Make sure that 'Nombre de modulations lineiques = 1' is in `Donnees.dat`
-       as we only write the Mod_Lin_0_* headers
+    NB Make sure that 'Nombre de modulations lineiques = $lin_modulations' is in `Donnees.dat`
+       as we only write the Mod_Lin_0_* to Mod_Lin_<$lin_modulations - 1>_* headers
 
     cf. <http://air.ec-lyon.fr/SIRANE/Article.php?&File=&Id=SIRANE_File_EvolEmisLin&Lang=FR>
         and <http://air.ec-lyon.fr/SIRANE/Article.php?&File=&Id=SIRANE_File_EvolEmisSurf&Lang=FR>
     """
-    # Define our write function
-    p = functools.partial(print, sep = "\t", file = file)
-
     our_species = "NO NO2 PM10 PM25 O3".split()
 
-    lin_headers = [ "Mod_Lin_0_%s" % x for x in our_species ]
+    lin_headers = [ "Mod_Lin_%d_%s" % (k, x) for k in range(lin_modulations) for x in our_species ]
     surf_headers = [ "Mod_Surf_%s" % x for x in our_species ]
-    p("Date", "Fich_Lin", *lin_headers, "Fich_Surf", *surf_headers)
+    headers = ["Date", "Fich_Lin", *lin_headers, "Fich_Surf", *surf_headers]
 
+    rows = []
     for row in data:
-        dt, filename, surf_filename = row
-        p(dt.strftime("%d/%m/%Y %H:%M"),
-          filename,
-          *([1] * len(lin_headers)), # Linear emissions are set to 1
-          surf_filename,
-          *([0] * len(surf_headers))) # Surface emissions are set to 0
+        dt, filename, surf_filename = row[:3]
+        lin_factor = row[3] if len(row) > 3 else 1 # Linear emissions are set to 1 by default
+        if not isinstance(lin_factor, (list, tuple)):
+            lin_factor = [lin_factor] * lin_modulations
+        if len(lin_factor) != lin_modulations:
+            raise ValueError("Expected %d linear modulation factors at %s, got %d" % (lin_modulations, dt, len(lin_factor)))
+
+        lin_factors = []
+        for factor in lin_factor:
+            if isinstance(factor, (list, tuple)):
+                lin_factors.extend(factor)
+            else:
+                lin_factors.extend([factor] * len(our_species))
+
+        rows.append([
+            dt.strftime("%d/%m/%Y %H:%M"),
+            filename,
+            *lin_factors,
+            surf_filename,
+            *([0] * len(surf_headers))]) # Surface emissions are set to 0
+
+    sirane_writer.write_rows(file, headers, rows)
+
+
+def read_traffic_profile(filename):
+    """
+    Read a traffic profile file, and returns a TrafficProfile.
+
+    A traffic profile file is a csv file (with header) whose columns are the day of the week
+    (0 is monday, 6 is sunday), the hour (in UTC), and the relative traffic at that time.
+    A TrafficProfile is a dictionary of (weekday, hour) tuples mapping to the relative traffic.
+    """
+    profile = {}
+
+    with open(filename) as f:
+        reader = csv.reader(f)
+        reader = iter(reader)
+        _headers = next(reader) # Skip headers
+
+        for row in reader:
+            profile[(int(row[0]), int(row[1]))] = float(row[2])
+
+    return profile
+
+
+def traffic_modulation(profile, start_time, hours):
+    """
+    Returns the list of the linear emission modulation factors for each hour from $start_time
+    to $start_time + $hours (included), relative to the traffic at $start_time according to the TrafficProfile.
+
+    The factors are 1 if there is no $profile, or if it is missing one of the hours.
+    """
+    times = [ start_time + timedelta(hours = h) for h in range(hours + 1) ]
+    if not profile:
+        return [1] * len(times)
+
+    reference = profile.get((start_time.weekday(), start_time.hour))
+    if not reference:
+        return [1] * len(times)
+
+    factors = []
+    for dt in times:
+        traffic = profile.get((dt.weekday(), dt.hour))
+        factors.append(1 if traffic is None else traffic / reference)
+    return factors
 
 
 def read_network_lengths(segment_length_filename):
@@ -230,11 +377,237 @@ def create_find_segments(segment_map, network_lengths, get_traffic_id):
     return find_segments
 
 
+AggregationMatrix = namedtuple('AggregationMatrix', ['row_count', 'indptr', 'indices', 'weights', 'columns'])
+AggregationMatrix.__doc__ = """
+Sparse matrix in CSR format (see the file formats above).
+The entries of row r are at positions indptr[r] to indptr[r+1] (excluded) in indices (the column numbers) and weights.
+columns[k] is a dictionary of the traffic ids of the k-th SegmentMap mapping to their column number.
+"""
+
+
+def network_row(network_id):
+    """
+    Returns the row of the network id $network_id in an AggregationMatrix, or None if write_emislin would
+    never write it: the ids of the EmisLin file are 0, 1, 2, … so eg. "abc", "-1" or "007" aren't written.
+    """
+    try:
+        row = int(network_id)
+    except ValueError:
+        return None
+    if row < 0 or str(row) != network_id:
+        return None
+    return row
+
+
+def compile_aggregation(segment_maps, network_lengths):
+    """
+    Compile a list of SegmentMaps and a NetworkLengthMap into an AggregationMatrix.
+    The columns of each SegmentMap are placed after the ones of the previous maps,
+    so that the emissions of every traffic source are summed by a single product.
+
+    The network ids are the row numbers (see network_row). The ids which SIRANE can't have are ignored,
+    as write_emislin ignores them, and so are the network segments without a length, as in create_find_segments.
+    """
+    columns = []
+    entries = [] # (row, column, weight)
+    column_count = 0
+    for segment_map in segment_maps:
+        source_columns = {}
+        for traffic_id, network_ids in segment_map.items():
+            column = column_count
+            source_columns[traffic_id] = column
+            column_count += 1
+
+            for network_id in network_ids:
+                segment_length = network_lengths.get(network_id)
+                row = network_row(network_id)
+                if segment_length is not None and row is not None:
+                    # Convert segment_length to kilometers
+                    entries.append((row, column, segment_length / 1000))
+        columns.append(source_columns)
+
+    # Bucket the entries by row
+    row_count = max((row for row, _column, _weight in entries), default = -1) + 1
+    indptr = array('l', [0] * (row_count + 1))
+    for row, _column, _weight in entries:
+        indptr[row + 1] += 1
+    for row in range(row_count):
+        indptr[row + 1] += indptr[row]
+
+    indices = array('l', [0] * len(entries))
+    weights = array('d', [0] * len(entries))
+    position = array('l', indptr[:-1])
+    for row, column, weight in entries:
+        i = position[row]
+        indices[i] = column
+        weights[i] = weight
+        position[row] += 1
+
+    return AggregationMatrix(row_count, indptr, indices, weights, columns)
+
+
+def new_column_emissions(matrix):
+    """
+    Returns empty ColumnEmissions for the columns of the AggregationMatrix
+    """
+    column_count = sum(len(c) for c in matrix.columns)
+    return (array('d', [0]) * column_count,
+            array('d', [0]) * column_count,
+            array('d', [0]) * column_count,
+            bytearray(column_count))
+
+
+def insert_column_emissions(column_emissions, columns, traffic_data, get_traffic_id, extract_parameters,
+                            traffic_state = None, time = None, ttl = 0, compute = None):
+    """
+    Updates the ColumnEmissions in-place, based on the list of traffic_data, using &get_traffic_id and &extract_parameters
+
+    $columns is the dictionary of traffic ids to column numbers of the traffic source, ie. an item of AggregationMatrix.columns
+    &get_traffic_id(row) is a function that returns the traffic segment id given a traffic data row
+    &extract_parameters(row) is the same as in insert_emission
+
+    If $traffic_state is a trafficstate.TrafficState, the valid (speed, rate) of each traffic id is stored in it at $time
+    (seconds since the epoch), and the datapoints skipped by &extract_parameters use the last valid (speed, rate)
+    of their traffic id instead, if it is at most $ttl seconds old.
+
+    &compute(speeds, rates) computes the emissions of the batch, like compute_emissions (the default),
+    eg. with the factors of an emission factor file (see emission_factors.py).
+
+    Returns a tuple of (number of datapoints used, number of datapoints whose traffic id is not in $columns,
+    number of datapoints used whose (speed, rate) came from $traffic_state).
+    The other datapoints were skipped by &extract_parameters (eg. missing speed).
+    """
+    # Gather the parameters of the whole batch before computing the emissions at once
+    row_columns, speeds, rates = [], [], []
+    unmatched = filled = 0
+    for row in traffic_data:
+        column = columns.get(get_traffic_id(row))
+        if column is None:
+            unmatched += 1
+            continue
+        try:
+            speed, rate = extract_parameters(row)
+        except SkipEmissionComputation:
+            last = None if traffic_state is None else traffic_state.lookup(column, time, ttl)
+            if last is None:
+                continue
+            speed, rate = last
+            filled += 1
+        else:
+            if traffic_state is not None:
+                traffic_state.remember(column, speed, rate, time)
+        row_columns.append(column)
+        speeds.append(speed)
+        rates.append(rate)
+
+    if compute is None:
+        compute = compute_emissions
+
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    for column, emissions in zip(row_columns, compute(speeds, rates)):
+        # Add emissions to existing ones if the traffic id appears multiple times
+        e_NOx[column] += emissions[0]
+        e_PM10[column] += emissions[1]
+        e_PM25[column] += emissions[2]
+        present[column] = 1
+
+    return len(row_columns), unmatched, filled
+
+
+def fill_missing_columns(column_emissions, columns, traffic_state, time, ttl, compute = None):
+    """
+    Updates the ColumnEmissions in-place with the last valid (speed, rate) of the traffic ids of $columns
+    which had no datapoint, if it is at most $ttl seconds older than $time (see insert_column_emissions).
+    Returns the number of traffic ids filled.
+    """
+    if compute is None:
+        compute = compute_emissions
+
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    filled_columns, speeds, rates = [], [], []
+    for column in columns.values():
+        if present[column]:
+            continue
+        last = traffic_state.lookup(column, time, ttl)
+        if last is not None:
+            filled_columns.append(column)
+            speeds.append(last[0])
+            rates.append(last[1])
+
+    for column, emissions in zip(filled_columns, compute(speeds, rates)):
+        e_NOx[column], e_PM10[column], e_PM25[column] = emissions
+        present[column] = 1
+
+    return len(filled_columns)
+
+
+def aggregate_emissions(matrix, column_emissions):
+    """
+    Multiply the AggregationMatrix with the ColumnEmissions, and return the resulting SiraneEmisLin data.
+
+    Only the network segments with at least one traffic datapoint are present in the result.
+    """
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    indptr, indices, weights = matrix.indptr, matrix.indices, matrix.weights
+
+    data = {}
+    for row in range(matrix.row_count):
+        start, end = indptr[row], indptr[row + 1]
+        if start == end:
+            continue
+
+        nox = pm10 = pm25 = 0
+        found = False
+        for i in range(start, end):
+            column = indices[i]
+            if present[column]:
+                weight = weights[i]
+                nox += e_NOx[column] * weight
+                pm10 += e_PM10[column] * weight
+                pm25 += e_PM25[column] * weight
+                found = True
+
+        if found:
+            data[str(row)] = [nox, pm10, pm25]
+
+    return data
+
+
+def compile_mapfiles(nm_segment_mapfile, d2_segment_mapfile, segment_length_file):
+    """
+    Read the NM and DATEX2 segment map files and the network lengths file,
+    and returns a tuple (AggregationMatrix, number of network segments in the lengths file)
+    """
+    network_lengths = read_network_lengths(segment_length_file)
+    nm_segment_map = read_mapfile(nm_segment_mapfile)
+    d2_segment_map = read_mapfile(d2_segment_mapfile)
+    matrix = compile_aggregation([nm_segment_map, d2_segment_map], network_lengths)
+    return matrix, len(network_lengths)
+
+
+def load_aggregation(nm_segment_mapfile, d2_segment_mapfile, segment_length_file, cache_dir = None):
+    """
+    Same as compile_mapfiles, but the result is cached in $cache_dir until one of the files changes.
+    cf. mapcache.py
+    """
+    # The matrix is cached as a plain tuple, so that the cache doesn't depend on
+    # whether this module is imported or run as a script
+    def compile(*sources):
+        matrix, network_count = compile_mapfiles(*sources)
+        return tuple(matrix), network_count
+
+    # NB the version in the name invalidates the matrices compiled by older versions of compile_aggregation
+    sources = [nm_segment_mapfile, d2_segment_mapfile, segment_length_file]
+    matrix, network_count = load_compiled('aggregation_v2', sources, compile, cache_dir = cache_dir)
+    return AggregationMatrix(*matrix), network_count
+
+
 # Functions to handle data from trafic_nm.py
 
+# Indices in trafic_nm.TrafficRecord
 I_NM_ID = 0
-I_NM_SPEED = 6
-I_NM_RATE = 4
+I_NM_SPEED = 3
+I_NM_RATE = 2
 
 def extract_nm_parameters(traffic_row):
     speed = int(traffic_row[I_NM_SPEED])
@@ -258,10 +631,10 @@ I_D2_SPEED = 4
 I_D2_RATE = 2
 
 def extract_d2_parameters(traffic_row):
-    # NB Missing values are empty strings
+    # NB Missing values are empty strings in csv rows, and None in datex2.SiteMeasurement records
     try:
         speed = int(traffic_row[I_D2_SPEED])
-    except ValueError:
+    except (TypeError, ValueError):
         # Missing speed, ignore this datapoint
         raise SkipEmissionComputation()
 
@@ -270,7 +643,37 @@ def extract_d2_parameters(traffic_row):
     return speed, rate
 
 
-def main(configfile = None, outputfile = None, keep_traffic_data = None):
+def load_compute(config):
+    """
+    Returns the &compute function of insert_column_emissions for the [emission] section of $config:
+    the emission factors of `emission_factors` with the vehicle mix of `vehicle_mix`, or None (the emission graph)
+    if `emission_factors` isn't set.
+    """
+    factor_file = config.get('emission', 'emission_factors', fallback = None)
+    if factor_file is None:
+        return None
+    mix_file = config.get('emission', 'vehicle_mix', fallback = None)
+    if mix_file is None:
+        raise ValueError("Missing vehicle_mix in the [emission] section, which is needed with emission_factors")
+
+    factors = emission_factors.load_factors(factor_file, mix_file, EMISSION_SPECIES)
+    return lambda speeds, rates: emission_factors.compute_emissions(factors, speeds, rates)
+
+
+FetchedEmissions = namedtuple('FetchedEmissions', ['matrix', 'segment_count', 'column_emissions', 'traffic_time', 'datex_time'])
+FetchedEmissions.__doc__ = """
+The emissions of the current traffic, before they are summed into the network segments (see fetch_emissions):
+the AggregationMatrix, the number of network segments, the ColumnEmissions, and the times of the NM and DATEX2 data.
+"""
+
+
+def fetch_emissions(configfile = None, keep_traffic_data = None):
+    """
+    Download the NM and DATEX2 traffic data, and compute the emissions of each traffic id.
+    Returns FetchedEmissions.
+
+    If $keep_traffic_data, the traffic data is also written to sirane/traffic_data.
+    """
     if configfile is None:
         configfile = "config.ini"
     keep_traffic_data = bool(keep_traffic_data)
@@ -281,6 +684,8 @@ def main(configfile = None, outputfile = None, keep_traffic_data = None):
     nm_segment_mapfile = config['emission']['nm_segment_map']
     d2_segment_mapfile = config['emission']['d2_segment_map']
     segment_length_file = config['emission']['network_segment_length']
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+    traffic_ttl = config.getfloat('emission', 'traffic_ttl', fallback = 0) * 60
     segment_count = None
     try:
         segment_count = int(config['emission']['segment_count'])
@@ -289,70 +694,108 @@ def main(configfile = None, outputfile = None, keep_traffic_data = None):
     
     # Initialize data
     now_s = datetime.now(timezone.utc).strftime("%Y-%m-%d_%H-%M-%S")
-    emis_data = {}
 
-    # Read network lengths, needed to compute the emissions
-    network_lengths = read_network_lengths(segment_length_file)
+    # Read mapfiles and network lengths (needed to compute the emissions), compiled together
+    with metrics.stage('emission.load_mapfiles'):
+        matrix, network_count = load_aggregation(nm_segment_mapfile, d2_segment_mapfile, segment_length_file, cache_dir = cache_dir)
     if segment_count is None:
-        segment_count = len(network_lengths)
+        segment_count = network_count
     
     print("DEBUG segment count = %d" % segment_count)
 
-    # === trafic_nm.py ===
+    nm_columns, d2_columns = matrix.columns
+    column_emissions = new_column_emissions(matrix)
 
-    # Download NM traffic data
-    traffic_filename = "trafic_%s.csv" % now_s
-    traffic_time = trafic_main(outputfile = traffic_filename)
-
-    # Read mapfile
-    nm_segment_map = read_mapfile(nm_segment_mapfile)
-    find_nm_segments = create_find_segments(nm_segment_map, network_lengths, lambda row: row[I_NM_ID])
+    # Emission factors per vehicle category from the emission factor file, or else the emission graph
+    compute = load_compute(config)
 
-    # Use downloaded data to update emis_data
-    with open(traffic_filename) as f:
-        reader = csv.reader(f, delimiter = ";")
-        reader = iter(reader)
-        _headers = next(reader) # Skip headers
+    # === trafic_nm.py ===
 
-        insert_emission(emis_data, reader, find_nm_segments, extract_nm_parameters)
-    if not keep_traffic_data:
-        os.unlink(traffic_filename)
+    # Download NM traffic data, only the columns we need
+    with metrics.stage('emission.download_nm'):
+        traffic_records, traffic_time = trafic_fetch()
 
     # === datex2.py ===
 
-    # Download PC Circulation data
-    datex_filename = "datex2_%s.csv" % now_s
-    datex_time = datex2_main(configfile = configfile, outputfile = datex_filename)
+    # Download PC Circulation data, parsed as it is downloaded
+    with metrics.stage('emission.download_datex2'):
+        datex_records, datex_time = datex2_fetch(configfile = configfile)
 
-    # Read datex2 mapfile
-    d2_segment_map = read_mapfile(d2_segment_mapfile)
-    find_d2_segments = create_find_segments(d2_segment_map, network_lengths, lambda row: row[I_D2_ID])
+    # The last valid traffic of each traffic id fills the gaps of the feeds, see trafficstate.py
+    # NB the store isn't used when replaying, as it holds the traffic of the last live run
+    traffic_state = None
+    if traffic_ttl > 0 and not capture.replaying():
+        sources = [nm_segment_mapfile, d2_segment_mapfile, segment_length_file]
+        traffic_state = TrafficState(store_filename(cache_dir), len(column_emissions[3]), sources)
 
-    # Use downloaded data to update emis_data
-    with open(datex_filename) as f:
-        reader = csv.reader(f)
-        reader = iter(reader)
-        _headers = next(reader) # Skip headers
-
-        insert_emission(emis_data, reader, find_d2_segments, extract_d2_parameters)
-    if not keep_traffic_data:
-        os.unlink(datex_filename)
-    
-    # Write data to output
-    if outputfile is None:
-        write_emislin(emis_data, segment_count)
-    else:
-        with open(outputfile, 'w') as f:
-            write_emislin(emis_data, segment_count, f)
+    try:
+        with metrics.stage('emission.compute'):
+            # Use downloaded data to update column_emissions
+            feeds = [
+                ('nm', nm_columns, traffic_records, traffic_time, lambda row: row[I_NM_ID], extract_nm_parameters),
+                ('datex2', d2_columns, datex_records, datex_time, lambda row: row[I_D2_ID], extract_d2_parameters),
+            ]
+            for name, columns, records, data_time, get_traffic_id, extract_parameters in feeds:
+                time = data_time.timestamp()
+                matched, unmatched, filled = insert_column_emissions(column_emissions, columns, records, get_traffic_id, extract_parameters,
+                                                                     traffic_state = traffic_state, time = time, ttl = traffic_ttl,
+                                                                     compute = compute)
+                metrics.count('matched_%s' % name, matched)
+                metrics.count('unmatched_%s' % name, unmatched)
+                if traffic_state is not None:
+                    filled += fill_missing_columns(column_emissions, columns, traffic_state, time, traffic_ttl, compute = compute)
+                    metrics.count('filled_%s' % name, filled)
+    finally:
+        if traffic_state is not None:
+            traffic_state.close()
     
-    # Move the traffic data files if we're keeping them
+    # Write the traffic data files if we're keeping them
     if keep_traffic_data:
         os.makedirs('sirane/traffic_data', exist_ok = True)
-        os.rename(traffic_filename, 'sirane/traffic_data/%s' % traffic_filename)
-        os.rename(datex_filename, 'sirane/traffic_data/%s' % datex_filename)
+        traffic_filename = "trafic_%s.csv" % now_s
+        with open('sirane/traffic_data/%s' % traffic_filename, 'w') as f:
+            writer = csv.writer(f, delimiter = ";")
+            writer.writerow(TrafficRecord._fields)
+            writer.writerows(traffic_records)
+        datex_filename = "datex2_%s.csv" % now_s
+        with open('sirane/traffic_data/%s' % datex_filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(DATA_TR_HEADER)
+            writer.writerows(datex_records)
+
+    return FetchedEmissions(matrix, segment_count, column_emissions, traffic_time, datex_time)
+
 
+def main(configfile = None, outputfile = None, keep_traffic_data = None):
+    if configfile is None:
+        configfile = "config.ini"
+    config = configparser.ConfigParser()
+    config.read(configfile)
+
+    fetched = fetch_emissions(configfile = configfile, keep_traffic_data = keep_traffic_data)
+
+    # Only update the network segments whose traffic changed since the last run, see incremental.py
+    if config.getboolean('emission', 'incremental', fallback = False):
+        sources = [ config['emission'][x] for x in ['nm_segment_map', 'd2_segment_map', 'network_segment_length'] ]
+        cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+        with metrics.stage('emission.write'):
+            incremental.update_emislin(fetched, sources, cache_dir = cache_dir, outputfile = outputfile)
+        return fetched.traffic_time, fetched.datex_time
+
+    with metrics.stage('emission.aggregate'):
+        # Sum the contributions of both sources into the network segments
+        emis_data = aggregate_emissions(fetched.matrix, fetched.column_emissions)
+        metrics.count('rows', len(emis_data))
+    
+    # Write data to output
+    with metrics.stage('emission.write'):
+        if outputfile is None:
+            write_emislin(emis_data, fetched.segment_count)
+        else:
+            with open(outputfile, 'w') as f:
+                write_emislin(emis_data, fetched.segment_count, f)
     
-    return traffic_time, datex_time
+    return fetched.traffic_time, fetched.datex_time
 
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import sys
+import csv
+import argparse
+import operator
+from array import array
+from collections import namedtuple
+
+"""
+Emission factors per vehicle category and species, for emission.py (see `emission_factors` in `docs/config.md`).
+
+The factors are read from an emission factor file, in the manner of COPERT's speed-dependent factors:
+for each vehicle category (eg. passenger cars, light commercial vehicles, heavy goods vehicles, buses)
+and each species, the emission factor in g/km at a few speeds, linearly interpolated in between, and constant
+below the lowest and above the highest speed. The vehicle mix file gives the share of each category in the traffic.
+
+At load time, the categories are summed with their shares into a single fleet factor per species, and each fleet
+factor is tabulated every 1 km/h (SPEED_STEP) from 0 to the highest speed of the file, in g/s per vehicle/h.
+Computing the emissions of a batch is then a table lookup and a multiplication per datapoint and species, whatever
+the number of categories, and it is done one species at a time over the whole batch (see compute_columns).
+
+Speeds are rounded to the nearest step of the tables. The speeds of the traffic feeds are integers, so this is exact.
+
+NB This is not the same as emission.compute_emissions, which is kept as the default: its graph has a 11 km/h
+   point where 110 km/h was meant, and it interpolates from the wrong end of each interval
+   (cf. `docs/samples/emission_factors.csv`, which is the same graph, fixed).
+"""
+
+SPEED_STEP = 1 # km/h
+
+EmissionFactors = namedtuple('EmissionFactors', ['species', 'max_speed', 'tables'])
+EmissionFactors.__doc__ = """
+The tabulated fleet emission factors: the list of the species, the highest speed of the tables in km/h,
+and for each species an array of its factor in g/s per vehicle/h at the speeds 0, SPEED_STEP, 2 × SPEED_STEP, … max_speed.
+"""
+
+
+def read_factor_file(filename):
+    """
+    Read an emission factor file, and returns a dictionary of (category, species) tuples mapping
+    to the list of (speed in km/h, factor in g/km) tuples, sorted by speed.
+
+    An emission factor file is a csv file (with header) whose columns are the vehicle category, the species,
+    the speed in km/h and the emission factor in g/km at that speed. Additional columns are ignored.
+    """
+    curves = {}
+
+    with open(filename) as f:
+        reader = csv.reader(f)
+        reader = iter(reader)
+        _headers = next(reader) # Skip headers
+
+        for row in reader:
+            if not row:
+                continue
+            key = (row[0], row[1])
+            curves.setdefault(key, []).append((float(row[2]), float(row[3])))
+
+    for (category, species), points in curves.items():
+        points.sort()
+        speeds = [ v for v, _factor in points ]
+        if len(set(speeds)) != len(speeds):
+            raise ValueError("Duplicate speed in the %s factors of %s in %s" % (species, category, filename))
+
+    return curves
+
+
+def read_mix_file(filename):
+    """
+    Read a vehicle mix file, and returns a dictionary of vehicle categories mapping to their share of the traffic.
+
+    A vehicle mix file is a csv file (with header) whose columns are the vehicle category and its share
+    of the traffic (in any unit, as the shares are divided by their sum). Additional columns are ignored.
+    """
+    mix = {}
+
+    with open(filename) as f:
+        reader = csv.reader(f)
+        reader = iter(reader)
+        _headers = next(reader) # Skip headers
+
+        for row in reader:
+            if row:
+                mix[row[0]] = mix.get(row[0], 0) + float(row[1])
+
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("The vehicle mix in %s is empty" % filename)
+    return dict( (category, share / total) for category, share in mix.items() )
+
+
+def interpolate(points, speed):
+    """Returns the factor of the sorted (speed, factor) $points at $speed, see the module's documentation"""
+    if speed <= points[0][0]:
+        return points[0][1]
+    for (v_left, left), (v_right, right) in zip(points, points[1:]):
+        if speed <= v_right:
+            return left + (speed - v_left) / (v_right - v_left) * (right - left)
+    return points[-1][1]
+
+
+def compile_factors(curves, mix, species):
+    """
+    Returns the EmissionFactors of the $species (a list of species names), from the curves
+    of read_factor_file and the vehicle mix of read_mix_file.
+
+    A category without factors for a species doesn't emit it. Every species must have the factors
+    of at least one of the categories of the mix.
+    """
+    for category in mix:
+        if not any(c == category for c, _species in curves):
+            raise ValueError("No emission factors for the vehicle category %s" % category)
+
+    max_speed = max(v for points in curves.values() for v, _factor in points)
+    steps = int(max_speed / SPEED_STEP) + 1
+
+    tables = []
+    for name in species:
+        weighted = [ (share, curves[(category, name)]) for category, share in mix.items() if (category, name) in curves ]
+        if not weighted:
+            raise ValueError("No emission factors for %s" % name)
+        # We divide by 3600 to convert to /s from g/h
+        tables.append(array('d', (
+            sum(share * interpolate(points, i * SPEED_STEP) for share, points in weighted) / 3600
+            for i in range(steps))))
+
+    return EmissionFactors(list(species), (steps - 1) * SPEED_STEP, tables)
+
+
+def load_factors(factor_file, mix_file, species):
+    """Read the emission factor file and the vehicle mix file, and returns the EmissionFactors of $species"""
+    return compile_factors(read_factor_file(factor_file), read_mix_file(mix_file), species)
+
+
+def speed_indices(factors, speeds):
+    """Returns the list of the table indices of $speeds (in km/h), see the module's documentation"""
+    last = len(factors.tables[0]) - 1
+    return [ 0 if v <= 0 else last if v >= factors.max_speed else int(v / SPEED_STEP + 0.5) for v in speeds ]
+
+
+def compute_columns(factors, speeds, rates):
+    """
+    Compute the emissions in g/s/km for a whole batch of traffic data,
+    given the speeds in km/h and the vehicule rates in 1/h.
+
+    Returns a list with an array of the emissions of each species of $factors, one for each (speed, rate) pair.
+    """
+    indices = speed_indices(factors, speeds)
+    return [ array('d', map(operator.mul, map(table.__getitem__, indices), rates)) for table in factors.tables ]
+
+
+def compute_emissions(factors, speeds, rates):
+    """
+    Same as compute_columns, but returns a list of tuples of the emissions of each species, one for each
+    (speed, rate) pair, like emission.compute_emissions
+    """
+    return list(zip(*compute_columns(factors, speeds, rates)))
+
+
+if __name__ == "__main__":
+    # Print the fleet emission factors in g/km
+    parser = argparse.ArgumentParser()
+    parser.add_argument("factor_file")
+    parser.add_argument("mix_file")
+    parser.add_argument("--species", default = "NOx,PM10,PM25", help = "Comma-separated species (default NOx,PM10,PM25)")
+    parser.add_argument("--step", type = int, default = 10, help = "Speed step of the output in km/h")
+    args = parser.parse_args()
+
+    factors = load_factors(args.factor_file, args.mix_file, args.species.split(","))
+    print("\t".join(["speed"] + factors.species))
+    for speed in range(0, int(factors.max_speed) + 1, args.step):
+        i = int(speed / SPEED_STEP)
+        print("\t".join([str(speed)] + [ "%.6g" % (table[i] * 3600) for table in factors.tables ]))
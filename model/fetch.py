@@ -0,0 +1,164 @@
+import io
+import sys
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics
+import capture
+
+"""
+HTTP client shared by the modules which download data (meteo.py, trafic_nm.py, datex2.py).
+
+get() is used like requests.get(), but:
+- the connections are kept alive between requests, with one requests.Session per host
+- every request has a timeout (DEFAULT_TIMEOUT), so that a hung connection can't stall the model forever
+- connection errors, timeouts and 5xx responses are retried, with an exponential backoff
+- the requests can't go beyond the deadline of the current thread (see set_deadline), which also limits the retries
+- the number of requests, errors and retries, and the latency of each host are recorded in the run's metrics
+- with a $source, the payload is recorded, or replayed instead of using the network (see capture.py)
+
+NB For streamed responses, the timeout and the deadline apply to the connection and to each read,
+not to the whole download.
+"""
+
+# (connect, read) timeout of each request, in seconds
+DEFAULT_TIMEOUT = (10, 60)
+# Number of retries after the first attempt, and delay before the first retry (doubled after each retry)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1
+
+RETRY_STATUSES = range(500, 600)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# The deadline of the requests of each thread, see set_deadline
+_local = threading.local()
+
+
+class FetchDeadlineExceeded(requests.Timeout):
+    """Raised by get() when the deadline of the current thread has passed"""
+    pass
+
+
+def set_deadline(seconds):
+    """
+    Set the deadline of the requests of the current thread to $seconds from now (None to remove it).
+    The requests made after the deadline fail with FetchDeadlineExceeded.
+
+    The deadline is per thread and isn't inherited by new threads: a thread which runs a stage of a run
+    sets its own (see model.run_stages), and keeps it even if it's left running after the run.
+    """
+    _local.deadline = None if seconds is None else time.monotonic() + seconds
+
+
+def remaining_time():
+    """Returns the number of seconds left before the deadline of the current thread, or None if there is no deadline"""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+
+def session_for(host):
+    """Returns the requests.Session used for $host, created on first use"""
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            _sessions[host] = session
+        return session
+
+
+def clip_timeout(timeout):
+    """Returns the $timeout (a number or a (connect, read) tuple), limited to the time left before the deadline"""
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise FetchDeadlineExceeded("The deadline of the requests has passed")
+    if isinstance(timeout, tuple):
+        return tuple(min(x, remaining) for x in timeout)
+    return min(timeout, remaining)
+
+
+def replayed_response(source):
+    """Returns a requests.Response with the payload of $source recorded at the replay time"""
+    entry, payload = capture.load(source)
+    r = requests.Response()
+    r.status_code = 200
+    r.url = entry['key'] or ""
+    r.raw = io.BytesIO(payload)
+    return r
+
+
+def record_response(source, r, stream = False):
+    """
+    Record the payload of the response $r as $source if we're recording and it succeeded (see get).
+    A $stream response is read in memory, and can still be read afterwards.
+    """
+    if capture.recording() and r.status_code == 200:
+        payload = r.content
+        capture.record(source, payload, key = r.url)
+        if stream:
+            r.raw = io.BytesIO(payload)
+
+
+def get(url, timeout = None, retries = None, backoff = None, source = None, **kwargs):
+    """
+    GET $url, see the module's documentation. The other arguments are passed to requests.Session.get().
+    Returns the requests.Response of the last attempt. Its status isn't checked unless it's a 5xx status
+    which is retried, so the caller still has to call raise_for_status().
+
+    $source is the name of the feed in the record/replay store (eg. 'owm'), or None if the payload isn't recorded.
+    NB When recording, a streamed response is read in memory before it's returned.
+    """
+    if source is not None and capture.replaying():
+        return replayed_response(source)
+
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT
+    if retries is None:
+        retries = DEFAULT_RETRIES
+    if backoff is None:
+        backoff = DEFAULT_BACKOFF
+
+    host = host_of(url)
+    session = session_for(host)
+    delay = backoff
+
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        start = time.monotonic()
+        try:
+            r = session.get(url, timeout = clip_timeout(timeout), **kwargs)
+        except FetchDeadlineExceeded:
+            raise
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.record_request(host, time.monotonic() - start, error = True)
+            if last_attempt:
+                raise
+            print("GET %s failed (%s), retrying in %ss" % (host, e, delay), file = sys.stderr)
+        else:
+            failed = r.status_code in RETRY_STATUSES
+            metrics.record_request(host, time.monotonic() - start, error = failed)
+            if not failed or last_attempt:
+                if source is not None:
+                    record_response(source, r, kwargs.get('stream'))
+                return r
+            print("GET %s failed (HTTP %d), retrying in %ss" % (host, r.status_code, delay), file = sys.stderr)
+            r.close()
+
+        # Don't wait beyond the deadline
+        remaining = remaining_time()
+        if remaining is not None and remaining < delay:
+            raise FetchDeadlineExceeded("Not enough time left before the deadline of the requests to retry %s" % host)
+        metrics.record_retry(host)
+        time.sleep(delay)
+        delay *= 2
@@ -10,12 +10,23 @@ import argparse
 import configparser
 import os
 import sys
-import functools
+import fcntl
 import subprocess
+import threading
+import glob
+import json
+import hashlib
+import struct
 from datetime import datetime, timedelta
 
 import cdsapi
 
+import sirane_writer
+import netcdf3
+import metrics
+import capture
+from mapcache import DEFAULT_CACHE_DIR
+
 # We define MintData as an array of [datetime, c(NO2), c(O3), c(PM10), c(PM2.5)]
 # Concentrations are in µg/m3 and datetime in UTC
 
@@ -24,6 +35,17 @@ import cdsapi
 # It turns out the entry groups are not sorted by time, but alphabetically ie. 1 10 11 12 … 2 20 21 … 3 4 5 6 …
 
 
+CAMS_MODEL = 'ensemble' # used to be 'chimere', but it didn't work one day
+CAMS_VARIABLES = [
+    # NB order matters
+    'nitrogen_dioxide', 'ozone', 'particulate_matter_10um',
+    'particulate_matter_2.5um',
+]
+
+# Number of days the forecasts are kept in the cache
+FORECAST_CACHE_DAYS = 2
+
+
 # Download forecast data from midnight until $upto hours for [NO2, O3, PM10, PM2.5]
 # Returns the filename of the downloaded file.
 def download_netcdf_from_cams (date, area, upto = None, filename = None):
@@ -34,16 +56,12 @@ def download_netcdf_from_cams (date, area, upto = None, filename = None):
         filename = "fond_%s.nc" % date_s
 
     request = {
-        'model': 'ensemble', # used to be 'chimere', but it didn't work one day
+        'model': CAMS_MODEL,
         'date': "%s/%s" % (date_s, date_s),
         'format': 'netcdf',
         'type': 'forecast',
         'time': '00:00',
-        'variable': [
-            # NB order matters
-            'nitrogen_dioxide', 'ozone', 'particulate_matter_10um',
-            'particulate_matter_2.5um',
-        ],
+        'variable': CAMS_VARIABLES,
         'level': '0',
         'leadtime_hour': [ str(i) for i in range(upto+1) ],
         'area': area,
@@ -55,6 +73,102 @@ def download_netcdf_from_cams (date, area, upto = None, filename = None):
     return filename
 
 
+# The forecast cache keeps the downloaded netcdf files in $cache_dir/cams/, named
+# fond_<date>_<key>_<upto>.nc where <key> is a hash of the area, model and variables of the request,
+# and <upto> is the last leadtime hour. A file is reused by any request for the same date and key,
+# up to the same or an earlier leadtime.
+
+def forecast_cache_prefix (cache_dir, date, area):
+    key = json.dumps([area, CAMS_MODEL, CAMS_VARIABLES])
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, "cams", "fond_%s_%s_" % (date.strftime('%Y-%m-%d'), key))
+
+
+# Returns the filename of a cached forecast for $date in $area which goes up to at least $upto hours, or None
+def find_cached_forecast (cache_dir, date, area, upto):
+    prefix = forecast_cache_prefix(cache_dir, date, area)
+    for filename in glob.glob(glob.escape(prefix) + "*.nc"):
+        try:
+            cached_upto = int(filename[len(prefix):-len(".nc")])
+        except ValueError:
+            continue
+        if cached_upto >= upto:
+            return filename
+    return None
+
+
+# Delete the cached forecasts (and their lock files) which are older than FORECAST_CACHE_DAYS
+def clean_forecast_cache (cache_dir, today):
+    oldest = (today - timedelta(days = FORECAST_CACHE_DAYS - 1)).strftime('%Y-%m-%d')
+    for filename in glob.glob(os.path.join(glob.escape(cache_dir), "cams", "fond_*")):
+        if not filename.endswith((".nc", ".lock")):
+            continue
+        date_s = os.path.basename(filename).split("_")[1]
+        if date_s < oldest:
+            os.unlink(filename)
+
+
+# Returns the filename of the forecast for $date in $area up to $upto hours,
+# downloading it into the forecast cache if it isn't there yet
+def get_forecast (date, area, upto = None, cache_dir = None):
+    if upto is None: upto = 24
+    if cache_dir is None: cache_dir = DEFAULT_CACHE_DIR
+
+    if capture.replaying():
+        # The forecast recorded before the replay time (see capture.py)
+        return capture.extract('cams', os.path.join(cache_dir, "replay"), ".nc")
+
+    prefix = forecast_cache_prefix(cache_dir, date, area)
+    os.makedirs(os.path.dirname(prefix), exist_ok = True)
+
+    # Only one download of a forecast at a time, in this process (eg. the daemon's prefetch and a run)
+    # or in another one: the others wait for it, and then find it in the cache
+    with open(prefix + "download.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        filename = find_cached_forecast(cache_dir, date, area, upto)
+        if filename is not None:
+            print("Using cached forecast %s" % filename, file = sys.stderr)
+            metrics.count('cache_hit')
+            return filename
+
+        filename = prefix + "%d.nc" % upto
+
+        # Download to a temporary file first, so that a concurrent run never uses a partial file
+        tmp_filename = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+        download_netcdf_from_cams(date, area, upto = upto, filename = tmp_filename)
+        metrics.count('bytes_downloaded', os.path.getsize(tmp_filename))
+        capture.record_file('cams', tmp_filename, key = "%s area=%s upto=%d" % (date.strftime('%Y-%m-%d'), area, upto))
+        os.replace(tmp_filename, filename)
+        clean_forecast_cache(cache_dir, date)
+
+    return filename
+
+
+# Start downloading the forecast for $date into the forecast cache in a background thread, see get_forecast
+# This is meant to be called when the forecast is published, so that the next runs don't wait for the CDS queue.
+# Returns the thread
+def start_prefetch (date, area, upto = None, cache_dir = None):
+    def prefetch():
+        try:
+            get_forecast(date, area, upto = upto, cache_dir = cache_dir)
+        except Exception as e:
+            print("Could not prefetch the forecast for %s: %s" % (date.strftime('%Y-%m-%d'), e), file = sys.stderr)
+
+    thread = threading.Thread(target = prefetch, name = "prefetch")
+    thread.start()
+    return thread
+
+
+# Keep the MintData rows from $fromhour to $tohour hours after the forecast's day (inclusive)
+def slice_leadtimes (data, fromhour = None, tohour = None):
+    if not data: return data
+    day = data[0][0].replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    start = day + timedelta(hours = fromhour if fromhour is not None else 0)
+    end = day + timedelta(hours = tohour) if tohour is not None else None
+    return [ d for d in data if start <= d[0] and (end is None or d[0] <= end) ]
+
+
 # Call a java program that opens the netcdf file for us and extracts the data we want
 # Then, retrieve its output and convert it to MintData
 # NB the java program should output the values in the right order of NO2 O3 PM10 PM2.5
@@ -86,6 +200,93 @@ def extract_cams_data_java (java, jarname, netcdf_filename, lat, lon):
     return data
 
 
+# Variables extracted from the netcdf file, in the order of MintData
+NETCDF_VARIABLES = ["no2_conc", "o3_conc", "pm10_conc", "pm2p5_conc"]
+
+
+# Round $x to a float32, as Java's float arithmetic does
+def to_float32 (x):
+    return struct.unpack('>f', struct.pack('>f', x))[0]
+
+
+# Returns the float with the shortest decimal representation that rounds to the same float32 as $x.
+# This is what we get when parsing Java's Float.toString(), ie. the output of the java program.
+def float32_as_printed (x):
+    for digits in range(1, 10):
+        value = float("%.*g" % (digits, x))
+        if to_float32(value) == x:
+            return value
+    return x
+
+
+# Index of the value closest to $x in $values, computed in float32 like the java program
+# NB like the java program, longitudes aren't wrapped (eg. -1.5 is far from 358.5)
+def nearest_index (values, x):
+    x = to_float32(x)
+    dists = [ abs(to_float32(v - x)) for v in values ]
+    return min(range(len(values)), key = lambda i: dists[i])
+
+
+# Returns [(index, weight), (index, weight)] to linearly interpolate at $x between the $values (sorted in any order)
+# Outside of the values, the closest edge is used
+def interpolation_weights (values, x):
+    order = sorted(range(len(values)), key = lambda i: values[i])
+    if x <= values[order[0]]:
+        return [(order[0], 1.0)]
+    if x >= values[order[-1]]:
+        return [(order[-1], 1.0)]
+    for i0, i1 in zip(order, order[1:]):
+        if values[i0] <= x <= values[i1]:
+            t = (x - values[i0]) / (values[i1] - values[i0])
+            return [(i0, 1 - t), (i1, t)]
+
+
+# Read the netcdf file directly and extract MintData at the point ($lat, $lon)
+# $interpolation is either:
+# - 'nearest' (default), to use the closest cell with the same output as the java program
+# - 'bilinear', to interpolate between the 4 closest cells
+def extract_cams_data (netcdf_filename, lat, lon, interpolation = None):
+    if interpolation is None: interpolation = 'nearest'
+
+    with netcdf3.Dataset(netcdf_filename) as nc:
+        # The time's long_name tells us the day, eg. "FORECAST time from 20210212"
+        time = nc.variables['time']
+        day = datetime.strptime(time.attributes['long_name'].split(" ")[-1], "%Y%m%d")
+        data = [ [ day + timedelta(hours = int(hour)) ] for hour in time.read() ]
+
+        lats = nc.variables['latitude'].read()
+        lons = nc.variables['longitude'].read()
+
+        if interpolation == 'nearest':
+            points = [ (nearest_index(lats, lat), nearest_index(lons, lon), 1.0) ]
+        elif interpolation == 'bilinear':
+            # Longitudes may be in [0, 360[
+            if max(lons) > 180:
+                lon = lon % 360
+            points = [ (i, j, wi * wj)
+                       for i, wi in interpolation_weights(lats, lat)
+                       for j, wj in interpolation_weights(lons, lon) ]
+        else:
+            raise ValueError("Unknown interpolation %s" % interpolation)
+
+        print("Relevant data index: %s" % ", ".join("%d, %d" % (i, j) for i, j, _w in points), file = sys.stderr)
+
+        # Assume dimensions are *_conc(time=*, level=1, latitude=*, longitude=*)
+        for varname in NETCDF_VARIABLES:
+            var = nc.variables[varname]
+            values = [0] * len(data)
+            for i, j, weight in points:
+                for k, value in enumerate(var.read_series((0, i, j))):
+                    values[k] += weight * value
+
+            for row, value in zip(data, values):
+                if interpolation == 'nearest':
+                    value = float32_as_printed(value)
+                row.append(value) # No conversion needed, already in µg/m3
+
+    return data
+
+
 # Sort MintData in ascending time, inplace
 def sort_data (data):
     data.sort(key = lambda x: x[0])
@@ -93,20 +294,21 @@ def sort_data (data):
 
 # Takes a MintData and prints sirane input data
 def print_sirane_fond_input (data, file = sys.stdout):
-    # Define a print function to use our defaults
-    p = functools.partial(print, sep = "\t", file = file)
-
-    # Print header
-    p('Date', 'NO2', 'O3', 'PM10', 'PM25')
-
+    rows = []
     for d in data:
         # Format to DD/MM/YYYY HH:MM
         date = d[0].strftime("%d/%m/%Y %H:%M")
 
-        p(date, *d[1:])
+        rows.append([date, *d[1:]])
+
+    sirane_writer.write_rows(file, ['Date', 'NO2', 'O3', 'PM10', 'PM25'], rows)
 
 
-def main(outputfile = None, configfile = None, tohour = None, keepgrib = False, java = None, jar = None):
+def main(outputfile = None, configfile = None, tohour = None, keepgrib = False, java = None, jar = None, fromhour = None, prefetch = False,
+         backend = None, interpolation = None):
+    # NB keepgrib is ignored: the downloaded file is always kept in the forecast cache
+    if tohour is None: tohour = 24
+
     # === Read configuration file ===
 
     if configfile is None:
@@ -119,6 +321,7 @@ def main(outputfile = None, configfile = None, tohour = None, keepgrib = False,
         cdsapircfile = config['fond']['cdsapircfile']
     except:
         cdsapircfile = 'atmosphere.cdsapirc'
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
     lat, lon = config['GENERAL']['latitude'], config['GENERAL']['longitude']
     lat, lon = float(lat), float(lon)
     if java is None:
@@ -131,6 +334,14 @@ def main(outputfile = None, configfile = None, tohour = None, keepgrib = False,
             jar = config['fond']['fond_jar']
         except:
             jar = "fond_extract_data-all.jar"
+    if backend is None:
+        backend = config.get('fond', 'backend', fallback = 'python')
+    if interpolation is None:
+        interpolation = config.get('fond', 'interpolation', fallback = 'nearest')
+    if backend not in ('python', 'java'):
+        raise ValueError("Unknown backend %s" % backend)
+    if backend == 'java' and interpolation != 'nearest':
+        raise ValueError("The java program only supports the nearest interpolation")
 
     # === Download grib file and extract data ===
 
@@ -148,10 +359,29 @@ def main(outputfile = None, configfile = None, tohour = None, keepgrib = False,
 
     os.environ['CDSAPI_RC'] = cdsapircfile
 
-    netcdf_filename = download_netcdf_from_cams(datetime.utcnow(), area, upto = tohour)
-    data = extract_cams_data_java(java, jar, netcdf_filename, lat, lon)
+    if prefetch:
+        # Only fill the forecast cache
+        get_forecast(capture.utcnow(), area, upto = tohour, cache_dir = cache_dir)
+        return None
+
+    with metrics.stage('fond.download'):
+        netcdf_filename = get_forecast(capture.utcnow(), area, upto = tohour, cache_dir = cache_dir)
+    with metrics.stage('fond.extract'):
+        if backend == 'python':
+            try:
+                data = extract_cams_data(netcdf_filename, lat, lon, interpolation)
+            except netcdf3.NetcdfFormatError as e:
+                if interpolation != 'nearest':
+                    raise
+                print("Could not read %s (%s), using the java program instead" % (netcdf_filename, e), file = sys.stderr)
+                backend = 'java'
+        if backend == 'java':
+            data = extract_cams_data_java(java, jar, netcdf_filename, lat, lon)
+        metrics.count('rows', len(data))
 
     sort_data(data)
+    # The cached forecast may contain more leadtimes than we asked for
+    data = slice_leadtimes(data, fromhour, tohour)
     if outputfile is not None:
         with open(outputfile, 'w') as f:
             print_sirane_fond_input(data, file = f)
@@ -159,10 +389,6 @@ def main(outputfile = None, configfile = None, tohour = None, keepgrib = False,
         print_sirane_fond_input(data)
     start_time = data[0][0] # First start hour
 
-    # cleanup
-    if not keepgrib:
-        os.unlink(netcdf_filename)
-
     return start_time
 
 
@@ -173,12 +399,18 @@ if __name__ == "__main__":
     parser.add_argument("--tohour")
     parser.add_argument("--java")
     parser.add_argument("--jar")
+    parser.add_argument("--fromhour")
+    parser.add_argument("--backend", choices = ['python', 'java'])
+    parser.add_argument("--interpolation", choices = ['nearest', 'bilinear'])
     parser.add_argument("--keep-grib", action = 'store_true')
+    parser.add_argument("--prefetch", action = 'store_true', help = "Only download today's forecast into the cache")
     args = parser.parse_args()
 
     if args.tohour is not None: args.tohour = int(args.tohour)
+    if args.fromhour is not None: args.fromhour = int(args.fromhour)
 
-    main(outputfile = args.file, configfile = args.config, tohour = args.tohour, keepgrib = args.keep_grib, java = args.java, jar = args.jar)
+    main(outputfile = args.file, configfile = args.config, tohour = args.tohour, keepgrib = args.keep_grib, java = args.java, jar = args.jar,
+         fromhour = args.fromhour, prefetch = args.prefetch, backend = args.backend, interpolation = args.interpolation)
 
 
 
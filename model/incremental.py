@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import mmap
+import fcntl
+import shutil
+import argparse
+from array import array
+
+from mapcache import load_compiled, source_key, DEFAULT_CACHE_DIR
+import metrics
+
+"""
+Incremental updates of the EmisLin file (see `incremental = true` in `docs/config.md`).
+
+Between two runs, most traffic ids have the same speed and rate, so most network segments have the same emissions.
+Instead of summing the emissions of every segment and writing the whole file, the state of the last run is kept
+in the state directory (`<cache_dir>/incremental/`):
+
+    meta.json       the network (source files and number of segments), whether the state is complete,
+                    and the generation of the EmisLin file of the last run
+    columns.bin     the ColumnEmissions of the last run: 3 doubles per column (NOx, PM10, PM25), then 1 byte per column (present)
+    rows.bin        the emissions of each network segment: 3 doubles per segment (NOx, PM10, PM25)
+    emis_lin.0.dat  the EmisLin files of the last two runs (generations 0 and 1)
+    emis_lin.1.dat
+    dirty.bin       the rows rewritten by the last update, ie. the rows in which both generations differ (longs)
+
+The binary files are memory-mapped. A run compares its ColumnEmissions with the ones of the last run, finds the network
+segments of the changed columns with the transpose of the AggregationMatrix (CSC, see compile_transpose), sums the
+emissions of only those dirty segments again, and rewrites only their rows.
+
+The EmisLin file of a run is hardlinked into its INPUT directory, and SIRANE may still be reading it during the next
+update, so the rows are rewritten in place in the other generation (the file of the run before), and the generations
+are swapped. The rows of the other generation which are out of date are the dirty rows of this update and of the last
+one (dirty.bin). The other generation is only rewritten in place when nothing else links to it (the INPUT file which
+linked to it was replaced by a later run). Otherwise, eg. with `model.py --isolated`, whose work directories keep their
+inputs, it is replaced by a copy of the current generation first, which is counted in the `bytes_written` metric.
+
+To rewrite a row in place, every row of the file has the same width: the values are written with 17 significant digits
+(VALUE_FORMAT), so that SIRANE reads the same doubles as from emission.write_emislin, and the rows are padded with
+trailing spaces.
+
+The state is replaced as a whole (as after a change of the network files) when it is missing or incomplete,
+eg. if a run was interrupted while updating it. The state is locked while it is updated, so concurrent runs
+(`model.py --isolated`) take turns.
+"""
+
+STATE_VERSION = 2
+
+HEADER = "Id\tNO\tNO2\tPM10\tPM25\tO3\n"
+# Enough digits to read the same doubles again
+VALUE_FORMAT = "%.17g"
+# Longest value written with VALUE_FORMAT (the emissions are positive), eg. 1.2345678901234567e+100
+VALUE_WIDTH = 23
+
+
+def record_width(segment_count):
+    """Returns the width of a row of the EmisLin file of a network of $segment_count segments, newline included"""
+    # Id, NO, NO2, PM10, PM25 and O3, separated by tabs
+    return len(str(max(segment_count - 1, 0))) + 1 + 3 * VALUE_WIDTH + 5 + 1 + 1
+
+
+def format_record(row, nox, pm10, pm25, width):
+    """Returns the row of the network segment $row in the EmisLin file, padded to $width. NO and O3 are 0"""
+    line = "%d\t0\t%s\t%s\t%s\t0" % (row, VALUE_FORMAT % nox, VALUE_FORMAT % pm10, VALUE_FORMAT % pm25)
+    return line.ljust(width - 1) + "\n"
+
+
+def compile_transpose(matrix):
+    """
+    Returns the transpose of the AggregationMatrix $matrix as a tuple (column_count, indptr, rows):
+    the network segments of column c are rows[indptr[c]] to rows[indptr[c+1] - 1]
+    """
+    column_count = sum(len(c) for c in matrix.columns)
+    indptr = array('l', [0] * (column_count + 1))
+    for column in matrix.indices:
+        indptr[column + 1] += 1
+    for column in range(column_count):
+        indptr[column + 1] += indptr[column]
+
+    rows = array('l', [0] * len(matrix.indices))
+    position = array('l', indptr[:-1])
+    for row in range(matrix.row_count):
+        for i in range(matrix.indptr[row], matrix.indptr[row + 1]):
+            column = matrix.indices[i]
+            rows[position[column]] = row
+            position[column] += 1
+
+    return column_count, indptr, rows
+
+
+def load_transpose(matrix, sources, cache_dir = None):
+    """Same as compile_transpose, but cached until one of the $sources of $matrix changes (cf. mapcache.py)"""
+    return load_compiled('aggregation_v2_csc', sources, lambda *_sources: compile_transpose(matrix), cache_dir = cache_dir)
+
+
+def sum_row(matrix, column_emissions, row):
+    """Returns the [NOx, PM10, PM25] emissions of the network segment $row, see emission.aggregate_emissions"""
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    nox = pm10 = pm25 = 0
+    for i in range(matrix.indptr[row], matrix.indptr[row + 1]):
+        column = matrix.indices[i]
+        if present[column]:
+            weight = matrix.weights[i]
+            nox += e_NOx[column] * weight
+            pm10 += e_PM10[column] * weight
+            pm25 += e_PM25[column] * weight
+    return [nox, pm10, pm25]
+
+
+def read_row_list(filename):
+    """Returns the array of the row numbers in the file $filename (see dirty.bin)"""
+    rows = array('l')
+    with open(filename, 'rb') as f:
+        rows.frombytes(f.read())
+    return rows
+
+
+def write_row_list(filename, rows):
+    """Write the list of row numbers $rows to the file $filename"""
+    with open(filename, 'wb') as f:
+        array('l', rows).tofile(f)
+
+
+def changed_columns(previous, column_emissions):
+    """Returns the list of the columns whose emissions (or presence) differ between two ColumnEmissions"""
+    p_NOx, p_PM10, p_PM25, p_present = previous
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    return [ column for column in range(len(present))
+             if present[column] != p_present[column] or e_NOx[column] != p_NOx[column]
+             or e_PM10[column] != p_PM10[column] or e_PM25[column] != p_PM25[column] ]
+
+
+class State:
+    """The state directory of the incremental updates, use it as a context manager to lock it"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def emislin_path(self, generation):
+        return self.path("emis_lin.%d.dat" % generation)
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok = True)
+        self.lock = open(self.path("lock"), 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+    def read_meta(self):
+        try:
+            with open(self.path("meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, meta):
+        tmp_filename = "%s.%d.tmp" % (self.path("meta.json"), os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_filename, self.path("meta.json"))
+
+    def is_valid(self, meta):
+        """Whether the state matches the network described by $meta (see update_emislin)"""
+        current = self.read_meta()
+        if current is None or not current.get('complete') or current.get('generation') not in (0, 1):
+            return False
+        if not os.path.exists(self.emislin_path(current['generation'])) or not os.path.exists(self.path("dirty.bin")):
+            return False
+        current = dict(current, complete = True)
+        del current['generation']
+        return current == meta
+
+
+def write_full(state, matrix, segment_count, column_emissions, meta):
+    """Write the whole state from the ColumnEmissions, and returns the number of rows and bytes written"""
+    width = meta['width']
+    state.write_meta(dict(meta, complete = False))
+
+    rows = array('d', [0]) * (3 * segment_count)
+    for row in range(min(matrix.row_count, segment_count)):
+        rows[3 * row:3 * row + 3] = array('d', sum_row(matrix, column_emissions, row))
+
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    with open(state.path("columns.bin"), 'wb') as f:
+        e_NOx.tofile(f)
+        e_PM10.tofile(f)
+        e_PM25.tofile(f)
+        f.write(present)
+    with open(state.path("rows.bin"), 'wb') as f:
+        rows.tofile(f)
+
+    tmp_filename = "%s.%d.tmp" % (state.emislin_path(0), os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(HEADER)
+        f.writelines(format_record(row, *rows[3 * row:3 * row + 3], width = width) for row in range(segment_count))
+    os.replace(tmp_filename, state.emislin_path(0))
+    # The other generation is out of date, it will be a copy of this one (see write_changes)
+    try:
+        os.unlink(state.emislin_path(1))
+    except FileNotFoundError:
+        pass
+    write_row_list(state.path("dirty.bin"), [])
+
+    state.write_meta(dict(meta, generation = 0))
+    return segment_count, len(HEADER) + segment_count * width
+
+
+def write_changes(state, matrix, transpose, segment_count, column_emissions, meta):
+    """
+    Apply the changes of the ColumnEmissions to the state, and returns the number of rows and bytes written.
+    The bytes include the copy of the current generation of the EmisLin file, if the other one is still in use.
+    """
+    width = meta['width']
+    column_count, col_indptr, col_rows = transpose
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    generation = state.read_meta()['generation']
+
+    # Until the state is updated, it can't be used by another run
+    state.write_meta(dict(meta, complete = False))
+
+    with open(state.path("columns.bin"), 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+        values = memoryview(mm)[:24 * column_count].cast('d')
+        previous = (values[:column_count], values[column_count:2 * column_count], values[2 * column_count:],
+                    memoryview(mm)[24 * column_count:])
+        changed = changed_columns(previous, column_emissions)
+        for column in changed:
+            previous[0][column] = e_NOx[column]
+            previous[1][column] = e_PM10[column]
+            previous[2][column] = e_PM25[column]
+            previous[3][column] = present[column]
+        for view in previous:
+            view.release()
+        values.release()
+    metrics.count('changed_columns', len(changed))
+
+    # The network segments of the changed columns are summed again
+    dirty = set()
+    for column in changed:
+        dirty.update(col_rows[col_indptr[column]:col_indptr[column + 1]])
+    dirty = sorted(row for row in dirty if row < segment_count)
+    metrics.count('dirty_rows', len(dirty))
+
+    # Rewrite the out of date rows of the other generation, see the module's documentation
+    other = state.emislin_path(1 - generation)
+    try:
+        in_place = os.stat(other).st_nlink == 1
+    except FileNotFoundError:
+        in_place = False
+    bytes_written = 0
+    if in_place:
+        rewritten = sorted(set(dirty).union(read_row_list(state.path("dirty.bin"))))
+    else:
+        # It's still an input of a run (or there's none yet), replace it with a copy of the current generation
+        tmp_filename = "%s.%d.tmp" % (other, os.getpid())
+        shutil.copyfile(state.emislin_path(generation), tmp_filename)
+        os.replace(tmp_filename, other)
+        bytes_written += os.path.getsize(other)
+        rewritten = dirty
+
+    dirty_set = set(dirty)
+    with open(state.path("rows.bin"), 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm_rows, \
+         open(other, 'r+b') as g, mmap.mmap(g.fileno(), 0) as mm_file:
+        rows = memoryview(mm_rows).cast('d')
+        header = len(HEADER)
+        for row in rewritten:
+            if row in dirty_set:
+                rows[3 * row:3 * row + 3] = array('d', sum_row(matrix, column_emissions, row))
+            offset = header + row * width
+            mm_file[offset:offset + width] = format_record(row, *rows[3 * row:3 * row + 3], width = width).encode()
+        rows.release()
+    write_row_list(state.path("dirty.bin"), dirty)
+
+    state.write_meta(dict(meta, generation = 1 - generation))
+    return len(rewritten), bytes_written + len(rewritten) * width
+
+
+def update_emislin(fetched, sources, cache_dir = None, file = sys.stdout, outputfile = None):
+    """
+    Update the state with the FetchedEmissions $fetched (see emission.fetch_emissions), and write the EmisLin file
+    to $outputfile (hardlinked to the state) or else to $file.
+
+    $sources are the segment map files and the network lengths file from which the AggregationMatrix was compiled.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    matrix, segment_count, column_emissions = fetched.matrix, fetched.segment_count, fetched.column_emissions
+
+    meta = {
+        'version': STATE_VERSION,
+        'sources': source_key(sources),
+        'segment_count': segment_count,
+        'column_count': len(column_emissions[3]),
+        'width': record_width(segment_count),
+        'complete': True,
+    }
+    # NB json turns the tuples of the source key into lists
+    meta = json.loads(json.dumps(meta))
+
+    with State(os.path.join(cache_dir, "incremental")) as state:
+        # NB empty files can't be memory-mapped
+        if state.is_valid(meta) and segment_count > 0 and meta['column_count'] > 0:
+            transpose = load_transpose(matrix, sources, cache_dir = cache_dir)
+            rows_written, bytes_written = write_changes(state, matrix, transpose, segment_count, column_emissions, meta)
+        else:
+            print("Writing the whole incremental emission state", file = sys.stderr)
+            rows_written, bytes_written = write_full(state, matrix, segment_count, column_emissions, meta)
+
+        emislin = state.emislin_path(state.read_meta()['generation'])
+        if outputfile is not None:
+            tmp_filename = "%s.%d.tmp" % (outputfile, os.getpid())
+            try:
+                os.link(emislin, tmp_filename)
+            except OSError:
+                shutil.copyfile(emislin, tmp_filename)
+                bytes_written += os.path.getsize(tmp_filename)
+            os.replace(tmp_filename, outputfile)
+        else:
+            with open(emislin) as f:
+                shutil.copyfileobj(f, file)
+                bytes_written += os.fstat(f.fileno()).st_size
+        metrics.count('rows_written', rows_written)
+        metrics.count('bytes_written', bytes_written)
+
+
+if __name__ == "__main__":
+    # Show the state of the incremental updates
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    meta = State(os.path.join(args.cache_dir, "incremental")).read_meta()
+    if meta is None:
+        print("No incremental emission state in %s" % args.cache_dir)
+    else:
+        print("%d network segments, %d columns, %s" % (meta['segment_count'], meta['column_count'],
+                                                       "complete" if meta['complete'] else "incomplete"))
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import math
+import time
+import argparse
+
+"""
+Builds the segment map files and the network lengths file (see emission.py) from the geometries of the network
+and of the traffic sensors, instead of matching them by hand in a GIS.
+
+Inputs:
+- the SIRANE network, as a csv file (with header) whose columns are the segment id and the coordinates x1, y1, x2, y2
+  of its ends, or as a GeoJSON file of LineStrings with the segment id in a property
+- the traffic sections, as the Nantes Métropole csv file with every column (`trafic_nm.py --file`), whose Geométrie
+  column has the GeoJSON LineString of each section, or as a GeoJSON file with the traffic id in a property
+
+The traffic geometries are longitudes and latitudes (WGS84), and are projected to Lambert-93 (EPSG:2154, the usual
+projection of SIRANE's network) so that the distances are in meters. The network is projected too if its coordinates
+look like longitudes and latitudes, unless `--network-crs` tells otherwise.
+
+Matching:
+- the straight pieces of the network segments are indexed in an STR-tree (a packed R-tree, see STRTree)
+- for each traffic section, the network pieces within `buffer` meters of one of its pieces are looked up in the tree
+- each candidate piece is sampled every `sample_step` meters. A sample is covered if the nearest piece of the section is
+  within `buffer` meters, and has the same heading (in either direction) up to `max_angle` degrees. The heading check
+  keeps the cross streets out of the buffer
+- a network segment is matched to the section if at least `min_overlap` of its length is covered
+
+A network segment may be matched to several sections, eg. one per direction of traffic, whose emissions are added.
+
+The segment map file has a third column, the covered length in meters, which is ignored by emission.py.
+"""
+
+DEFAULT_BUFFER = 15 # m
+DEFAULT_MAX_ANGLE = 30 # degrees
+DEFAULT_MIN_OVERLAP = 0.5
+DEFAULT_SAMPLE_STEP = 5 # m
+
+# Maximum number of children of an STR-tree node
+NODE_CAPACITY = 16
+
+# Labels of the geometry column in the Nantes Métropole csv file
+NM_ID_LABEL = "Identifiant"
+NM_GEOMETRY_LABELS = ["Geométrie", "Géométrie", "Geometrie", "geo_shape"]
+
+CRS = ['auto', 'lambert93', 'wgs84']
+
+
+# === Lambert-93 ===
+
+# GRS80 ellipsoid, and the Lambert-93 conic projection (RGF93 is the same as WGS84 at our scale)
+GRS80_A = 6378137.0
+GRS80_E = 0.0818191910428158
+L93_LON0 = math.radians(3)
+L93_LAT0 = math.radians(46.5)
+L93_LAT1 = math.radians(44)
+L93_LAT2 = math.radians(49)
+L93_X0 = 700000.0
+L93_Y0 = 6600000.0
+
+
+def _m(lat):
+    return math.cos(lat) / math.sqrt(1 - (GRS80_E * math.sin(lat)) ** 2)
+
+
+def _t(lat):
+    e_sin = GRS80_E * math.sin(lat)
+    return math.tan(math.pi / 4 - lat / 2) / ((1 - e_sin) / (1 + e_sin)) ** (GRS80_E / 2)
+
+
+L93_N = (math.log(_m(L93_LAT1)) - math.log(_m(L93_LAT2))) / (math.log(_t(L93_LAT1)) - math.log(_t(L93_LAT2)))
+L93_F = _m(L93_LAT1) / (L93_N * _t(L93_LAT1) ** L93_N)
+L93_RHO0 = GRS80_A * L93_F * _t(L93_LAT0) ** L93_N
+
+
+def lambert93(lon, lat):
+    """Returns the Lambert-93 (x, y) in meters of the WGS84 $lon and $lat in degrees"""
+    rho = GRS80_A * L93_F * _t(math.radians(lat)) ** L93_N
+    theta = L93_N * (math.radians(lon) - L93_LON0)
+    return L93_X0 + rho * math.sin(theta), L93_Y0 + L93_RHO0 - rho * math.cos(theta)
+
+
+def is_wgs84(geometries):
+    """Whether the coordinates of the $geometries look like longitudes and latitudes rather than meters"""
+    for parts in geometries:
+        for line in parts:
+            for x, y in line:
+                if abs(x) > 180 or abs(y) > 90:
+                    return False
+    return True
+
+
+def project(geometries, crs):
+    """
+    Project the dictionary of ids to geometries (lists of lines, which are lists of (x, y) points) to Lambert-93,
+    in place. $crs is 'wgs84', 'lambert93' (nothing to do) or 'auto' (guessed from the coordinates)
+    """
+    if crs == 'auto':
+        crs = 'wgs84' if is_wgs84(geometries.values()) else 'lambert93'
+    if crs == 'wgs84':
+        for key, parts in geometries.items():
+            geometries[key] = [ [ lambert93(x, y) for x, y in line ] for line in parts ]
+    return geometries
+
+
+# === Geometry ===
+
+def pieces(parts):
+    """Returns the list of the straight pieces ((x1, y1), (x2, y2)) of the lines $parts, without the empty ones"""
+    return [ (p, q) for line in parts for p, q in zip(line, line[1:]) if p != q ]
+
+
+def piece_length(piece):
+    (x1, y1), (x2, y2) = piece
+    return math.hypot(x2 - x1, y2 - y1)
+
+
+def piece_bbox(piece, margin = 0):
+    (x1, y1), (x2, y2) = piece
+    return (min(x1, x2) - margin, min(y1, y2) - margin, max(x1, x2) + margin, max(y1, y2) + margin)
+
+
+def heading(piece):
+    """Returns the heading of $piece in degrees, from 0 to 180 (the direction doesn't matter)"""
+    (x1, y1), (x2, y2) = piece
+    return math.degrees(math.atan2(y2 - y1, x2 - x1)) % 180
+
+
+def angle_between(a, b):
+    """Returns the angle between the headings $a and $b (see heading), from 0 to 90 degrees"""
+    d = abs(a - b) % 180
+    return min(d, 180 - d)
+
+
+def point_distance(x, y, piece):
+    """Returns the distance of the point ($x, $y) to $piece"""
+    (x1, y1), (x2, y2) = piece
+    dx, dy = x2 - x1, y2 - y1
+    t = ((x - x1) * dx + (y - y1) * dy) / (dx * dx + dy * dy)
+    t = 0 if t < 0 else 1 if t > 1 else t
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+# === STR-tree ===
+
+class STRTree:
+    """
+    Static R-tree, bulk loaded with the Sort-Tile-Recursive algorithm.
+
+    $entries is a list of (bbox, item) tuples, where bbox is a (xmin, ymin, xmax, ymax) tuple.
+    The nodes are (bbox, children, leaf) tuples, where children are the entries of a leaf, or else nodes.
+    """
+
+    def __init__(self, entries, capacity = NODE_CAPACITY):
+        self.capacity = capacity
+        level = [ (bbox, item, True) for bbox, item in entries ]
+        leaf = True
+        # Pack the entries into leaves, then the nodes into upper nodes, until there's a single root
+        while level:
+            level = self.pack(level, leaf)
+            leaf = False
+            if len(level) <= 1:
+                break
+        self.root = level[0] if level else None
+
+    def pack(self, level, leaf):
+        """Returns the nodes which contain the nodes or entries of $level, $capacity at a time"""
+        capacity = self.capacity
+        leaf_count = -(-len(level) // capacity)
+        slice_count = int(math.ceil(math.sqrt(leaf_count)))
+        slice_size = slice_count * capacity
+
+        def center_x(x):
+            return x[0][0] + x[0][2]
+
+        def center_y(x):
+            return x[0][1] + x[0][3]
+
+        nodes = []
+        level = sorted(level, key = center_x)
+        for i in range(0, len(level), slice_size):
+            vertical = sorted(level[i:i + slice_size], key = center_y)
+            for j in range(0, len(vertical), capacity):
+                children = vertical[j:j + capacity]
+                bbox = (min(x[0][0] for x in children), min(x[0][1] for x in children),
+                        max(x[0][2] for x in children), max(x[0][3] for x in children))
+                if leaf:
+                    children = [ (x[0], x[1]) for x in children ]
+                nodes.append((bbox, children, leaf))
+        return nodes
+
+    def query(self, bbox):
+        """Returns the list of the items whose bbox intersects $bbox"""
+        if self.root is None:
+            return []
+        xmin, ymin, xmax, ymax = bbox
+        items = []
+        stack = [self.root]
+        while stack:
+            _bbox, children, leaf = stack.pop()
+            for child in children:
+                b = child[0]
+                if b[0] <= xmax and b[2] >= xmin and b[1] <= ymax and b[3] >= ymin:
+                    if leaf:
+                        items.append(child[1])
+                    else:
+                        stack.append(child)
+        return items
+
+
+# === Matching ===
+
+def index_network(network):
+    """
+    Returns an STRTree of the pieces of the $network (a dictionary of ids to geometries),
+    whose items are (network id, piece)
+    """
+    entries = []
+    for network_id, parts in network.items():
+        for piece in pieces(parts):
+            entries.append((piece_bbox(piece), (network_id, piece)))
+    return STRTree(entries)
+
+
+def match_section(tree, lengths, parts, buffer = DEFAULT_BUFFER, max_angle = DEFAULT_MAX_ANGLE,
+                  min_overlap = DEFAULT_MIN_OVERLAP, sample_step = DEFAULT_SAMPLE_STEP):
+    """
+    Returns the list of the (network id, covered length) of the network segments matched to the traffic section
+    whose geometry is $parts, see the module's documentation.
+    $tree is the index_network() of the network, and $lengths the network_lengths() of its segments.
+    """
+    section = [ (piece, heading(piece)) for piece in pieces(parts) ]
+    candidates = set()
+    for piece, _heading in section:
+        candidates.update(tree.query(piece_bbox(piece, buffer)))
+
+    covered = {}
+    for network_id, piece in candidates:
+        length = piece_length(piece)
+        samples = max(1, int(math.ceil(length / sample_step)))
+        piece_heading = heading(piece)
+        (x1, y1), (x2, y2) = piece
+        count = 0
+        for i in range(samples):
+            t = (i + 0.5) / samples
+            x, y = x1 + t * (x2 - x1), y1 + t * (y2 - y1)
+            # The nearest piece of the section must be close enough, and in the same direction
+            distance, nearest_heading = min((point_distance(x, y, p), h) for p, h in section)
+            if distance <= buffer and angle_between(piece_heading, nearest_heading) <= max_angle:
+                count += 1
+        if count:
+            covered[network_id] = covered.get(network_id, 0) + length * count / samples
+
+    return [ (network_id, length) for network_id, length in sorted(covered.items())
+             if lengths.get(network_id) and length >= min_overlap * lengths[network_id] ]
+
+
+def match(tree, lengths, sections, **options):
+    """
+    Match the traffic $sections (a dictionary of ids to Lambert-93 geometries) to the network, given its
+    index_network() $tree and the network_lengths() $lengths.
+    Returns the list of (network id, traffic id, covered length) rows of the segment map.
+    The $options are those of match_section.
+    """
+    rows = []
+    for traffic_id, parts in sections.items():
+        for network_id, length in match_section(tree, lengths, parts, **options):
+            rows.append((network_id, traffic_id, length))
+    return rows
+
+
+def network_lengths(network):
+    """Returns a dictionary of the network ids mapping to the length of their segment in meters"""
+    return dict( (network_id, sum(piece_length(p) for p in pieces(parts))) for network_id, parts in network.items() )
+
+
+# === Files ===
+
+def geojson_lines(geometry):
+    """Returns the lines of a GeoJSON LineString or MultiLineString $geometry"""
+    if geometry is None:
+        return []
+    if geometry['type'] == 'LineString':
+        return [ [ tuple(p[:2]) for p in geometry['coordinates'] ] ]
+    if geometry['type'] == 'MultiLineString':
+        return [ [ tuple(p[:2]) for p in line ] for line in geometry['coordinates'] ]
+    return []
+
+
+def read_geojson(filename, id_property):
+    """
+    Read a GeoJSON file of LineStrings or MultiLineStrings, and returns a dictionary of the $id_property
+    of the features mapping to their lines
+    """
+    with open(filename) as f:
+        collection = json.load(f)
+    geometries = {}
+    for feature in collection['features']:
+        key = str(feature['properties'][id_property])
+        geometries.setdefault(key, []).extend(geojson_lines(feature.get('geometry')))
+    return geometries
+
+
+def read_network_csv(filename):
+    """Read a network csv file (id, x1, y1, x2, y2 with header), and returns a dictionary of the ids to their lines"""
+    network = {}
+    with open(filename) as f:
+        reader = csv.reader(f)
+        reader = iter(reader)
+        _headers = next(reader) # Skip headers
+
+        for row in reader:
+            if not row:
+                continue
+            x1, y1, x2, y2 = map(float, row[1:5])
+            network[row[0]] = [[(x1, y1), (x2, y2)]]
+    return network
+
+
+def read_nm_csv(filename):
+    """
+    Read the Nantes Métropole csv file with every column (see `trafic_nm.py --file`),
+    and returns a dictionary of the traffic ids mapping to their lines
+    """
+    sections = {}
+    with open(filename, encoding = "utf-8") as f:
+        reader = csv.reader(f, delimiter = ";")
+        headers = next(reader)
+        headers[0] = headers[0].lstrip("\ufeff") # Byte order mark
+        geometry_labels = [ x for x in NM_GEOMETRY_LABELS if x in headers ]
+        if not geometry_labels:
+            raise ValueError("No geometry column in %s, download it with `trafic_nm.py --file`" % filename)
+        i_id, i_geometry = headers.index(NM_ID_LABEL), headers.index(geometry_labels[0])
+
+        for row in reader:
+            if row and row[i_geometry]:
+                sections[row[i_id]] = geojson_lines(json.loads(row[i_geometry]))
+    return sections
+
+
+def read_geometries(filename, id_property):
+    """Read a GeoJSON file (by extension) or else a network csv file"""
+    if os.path.splitext(filename)[1].lower() in (".geojson", ".json"):
+        return read_geojson(filename, id_property)
+    return read_network_csv(filename)
+
+
+def write_segment_map(rows, filename):
+    with open(filename, 'w', newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["network_id", "traffic_id", "covered_length"])
+        for network_id, traffic_id, length in rows:
+            writer.writerow([network_id, traffic_id, round(length, 2)])
+
+
+def write_network_lengths(lengths, filename):
+    def sort_key(network_id):
+        return (0, int(network_id), "") if network_id.isdigit() else (1, 0, network_id)
+
+    with open(filename, 'w', newline = "") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "length"])
+        for network_id in sorted(lengths, key = sort_key):
+            writer.writerow([network_id, round(lengths[network_id], 3)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network", required = True, help = "Network csv file (id, x1, y1, x2, y2) or GeoJSON file")
+    parser.add_argument("--network-crs", choices = CRS, default = 'auto')
+    parser.add_argument("--network-id-property", default = "id", help = "Id property of a GeoJSON network (default id)")
+    parser.add_argument("--lengths-output", help = "Network lengths file to write")
+    parser.add_argument("--nm", help = "Nantes Métropole csv file with the geometries (see trafic_nm.py --file)")
+    parser.add_argument("--nm-output", help = "Segment map file to write for the Nantes Métropole traffic ids")
+    parser.add_argument("--d2", help = "GeoJSON file of the DATEX2 measurement sites")
+    parser.add_argument("--d2-id-property", default = "id", help = "Id property of the DATEX2 GeoJSON file (default id)")
+    parser.add_argument("--d2-output", help = "Segment map file to write for the DATEX2 measurement sites")
+    parser.add_argument("--buffer", type = float, default = DEFAULT_BUFFER, help = "In meters (default %(default)s)")
+    parser.add_argument("--max-angle", type = float, default = DEFAULT_MAX_ANGLE, help = "In degrees (default %(default)s)")
+    parser.add_argument("--min-overlap", type = float, default = DEFAULT_MIN_OVERLAP,
+                        help = "Fraction of a network segment which must be covered (default %(default)s)")
+    parser.add_argument("--sample-step", type = float, default = DEFAULT_SAMPLE_STEP, help = "In meters (default %(default)s)")
+    args = parser.parse_args()
+
+    inputs = [
+        ("Nantes Métropole", args.nm, args.nm_output, read_nm_csv),
+        ("DATEX2", args.d2, args.d2_output, lambda filename: read_geojson(filename, args.d2_id_property)),
+    ]
+    for _name, filename, output, _read in inputs:
+        if filename is not None and output is None:
+            parser.error("An output segment map file is needed for %s" % filename)
+
+    started = time.monotonic()
+    network = project(read_geometries(args.network, args.network_id_property), args.network_crs)
+    print("Read %d network segments" % len(network), file = sys.stderr)
+    lengths = network_lengths(network)
+    if args.lengths_output is not None:
+        write_network_lengths(lengths, args.lengths_output)
+    tree = index_network(network)
+
+    options = {
+        'buffer': args.buffer,
+        'max_angle': args.max_angle,
+        'min_overlap': args.min_overlap,
+        'sample_step': args.sample_step,
+    }
+    for name, filename, output, read in inputs:
+        if filename is None:
+            continue
+        sections = project(read(filename), 'wgs84')
+        rows = match(tree, lengths, sections, **options)
+        write_segment_map(rows, output)
+        matched = set(traffic_id for _network_id, traffic_id, _length in rows)
+        print("%s: %d of %d traffic ids matched to %d network segments" % (
+            name, len(matched), len(sections), len(set(network_id for network_id, _t, _l in rows))), file = sys.stderr)
+
+    print("Done in %.1f s" % (time.monotonic() - started), file = sys.stderr)
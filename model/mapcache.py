@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pickle
+import hashlib
+import argparse
+
+"""
+Cache for data compiled from input files which rarely change, like the segment map files
+and the network lengths file (cf. emission.py).
+
+The compiled data is pickled into the cache directory, along with a key made of the path,
+size and modification time of each source file. When any of the source files changes,
+the cached data is discarded and compiled again.
+
+The data is also kept in memory, so that a long running process (see `model.py --daemon`) only checks
+that the source files didn't change.
+"""
+
+DEFAULT_CACHE_DIR = "sirane/cache"
+
+# Cache filename -> (key, data) of the data loaded by this process
+_loaded = {}
+
+
+def source_key(sources):
+    """
+    Returns the cache key for the list of source filenames: a list of (path, size, mtime) tuples
+    """
+    key = []
+    for filename in sources:
+        st = os.stat(filename)
+        key.append((os.path.abspath(filename), st.st_size, st.st_mtime_ns))
+    return key
+
+
+def cache_filename(name, sources, cache_dir):
+    """
+    Returns the filename of the cache file for the compiled data $name of the $sources
+    """
+    paths = "\n".join(os.path.abspath(x) for x in sources)
+    digest = hashlib.sha1(paths.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "%s-%s.pickle" % (name, digest))
+
+
+def load_compiled(name, sources, compile, cache_dir = None):
+    """
+    Returns the result of &compile(*$sources), from the cache if none of the $sources files changed.
+
+    $name identifies the compiled data in the cache directory (eg. 'aggregation').
+    $sources is the list of source filenames, passed as arguments to &compile.
+    The result of &compile must be picklable.
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+
+    key = source_key(sources)
+    filename = cache_filename(name, sources, cache_dir)
+
+    # Data already loaded by this process
+    loaded = _loaded.get(filename)
+    if loaded is not None and loaded[0] == key:
+        return loaded[1]
+
+    # Try the cache first
+    try:
+        with open(filename, 'rb') as f:
+            cached_key, data = pickle.load(f)
+        if cached_key == key:
+            _loaded[filename] = (key, data)
+            return data
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError, ImportError):
+        # Missing or unreadable cache file, we just compile it again
+        pass
+
+    print("Compiling %s into %s" % (", ".join(sources), filename), file = sys.stderr)
+    data = compile(*sources)
+
+    # Write to a temporary file first, so that a concurrent run never reads a partial file
+    os.makedirs(cache_dir, exist_ok = True)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump((key, data), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+    _loaded[filename] = (key, data)
+    return data
+
+
+if __name__ == "__main__":
+    # Compile the emission.py mapfiles, eg. after editing them with the scripts in scripts/
+    import configparser
+    from emission import load_aggregation
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config")
+    args = parser.parse_args()
+
+    configfile = args.config if args.config is not None else "config.ini"
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+
+    matrix, network_count = load_aggregation(
+        config['emission']['nm_segment_map'],
+        config['emission']['d2_segment_map'],
+        config['emission']['network_segment_length'],
+        cache_dir = cache_dir)
+    print("%d network segments, %d matrix entries" % (network_count, len(matrix.indices)))
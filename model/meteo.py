@@ -2,13 +2,15 @@
 
 import argparse
 import configparser
-import functools
 import re
 import sys
 from datetime import datetime
 
-import requests
+import sirane_writer
+import metrics
+import fetch
 
+OWM_URL = "https://api.openweathermap.org/data/2.5/onecall"
 
 """
 We define the internal data exchange type MintData.
@@ -30,9 +32,10 @@ Not mentionned here are the upper and lower bounds used by sirane for certain pa
 def request_owp_data (lat, lon, api_key):
     """Get weather data from OpenWeatherMap JSON API as a dictionary"""
     part = "current,minutely,daily,alerts"
-    url = "https://api.openweathermap.org/data/2.5/onecall?lat=%s&lon=%s&exclude=%s&appid=%s" % (lat, lon, part, api_key)
-    r = requests.get(url)
+    url = OWM_URL + "?lat=%s&lon=%s&exclude=%s&appid=%s" % (lat, lon, part, api_key)
+    r = fetch.get(url, source = 'owm')
     r.raise_for_status()
+    metrics.count('bytes_downloaded', metrics.response_size(r))
     data = r.json()
     return data
 
@@ -72,17 +75,14 @@ def extract_owp_data (data):
 
 def print_sirane_meteo_input (data, file = sys.stdout):
     """Take the object of type MintData and print it formatted for sirane to the file (by default, stdout)"""
-    # Define a print function to use our defaults
-    p = functools.partial(print, sep = "\t", file = file)
-
-    # Print header
-    p('Date', 'U', 'Dir', 'Temp', 'Cld', 'Precip')
-
+    rows = []
     for d in data:
         # Format to DD/MM/YYYY HH:MM
         date = d[0].strftime("%d/%m/%Y %H:%M")
 
-        p(date, *d[1:])
+        rows.append([date, *d[1:]])
+
+    sirane_writer.write_rows(file, ['Date', 'U', 'Dir', 'Temp', 'Cld', 'Precip'], rows)
 
 
 def main(outputfile = None, configfile = None):
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from datetime import datetime, timezone
+
+"""
+Lightweight instrumentation of the model pipeline.
+
+A run (see start_run) is made of stages, eg. `emission.download_nm` or `launch`. For each stage, we record
+its wall time, its CPU time, and counters like the number of bytes downloaded or written, or the number of rows.
+
+    metrics.start_run()
+    with metrics.stage('emission.compute'):
+        ...
+        metrics.count('matched', 123)
+    metrics.finish_run(run_log = "run_log.jsonl", textfile = "captation.prom")
+
+The stages are recorded per thread, so concurrent stages (see model.run_stages) don't mix their counters.
+Counters are added to the innermost stage of the current thread. When no run was started (eg. when a module
+is used as a script), stage() and count() do nothing.
+
+The HTTP requests made through fetch.py are also recorded per host (number of requests, errors, retries and latency).
+
+The CPU time of a stage is the CPU time of its thread. The CPU time of the child processes (SIRANE, java)
+is only known for the whole process once they exit, so it is recorded separately as children_cpu_seconds.
+"""
+
+METRIC_PREFIX = "captation"
+
+# The CPU time of the current thread (Python >= 3.7), or of the whole process
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+_run = None
+_local = threading.local()
+
+
+class Run:
+    """
+    The stages of a model run, as a list of dictionaries,
+    and the HTTP statistics of each host, as a dictionary of hosts mapping to dictionaries
+    """
+    def __init__(self):
+        self.start = datetime.now(timezone.utc)
+        self.stages = []
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.stages.append(record)
+
+    def host(self, host):
+        """Returns the statistics of $host (call with the lock held)"""
+        stats = self.hosts.get(host)
+        if stats is None:
+            stats = self.hosts[host] = {
+                'requests': 0,
+                'errors': 0,
+                'retries': 0,
+                'latency_seconds': 0.0,
+                'max_latency_seconds': 0.0,
+            }
+        return stats
+
+
+def start_run():
+    """Start recording the stages of a new run"""
+    global _run
+    _run = Run()
+    return _run
+
+
+def children_cpu_time():
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager which records the stage $name (see the module's documentation)"""
+    run = _run
+    if run is None:
+        yield
+        return
+
+    record = {
+        'stage': name,
+        'start': datetime.now(timezone.utc).isoformat(),
+        'counters': {},
+    }
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(record)
+
+    wall, cpu, children_cpu = time.monotonic(), thread_time(), children_cpu_time()
+    try:
+        yield
+    except BaseException as e:
+        record['error'] = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        record['wall_seconds'] = time.monotonic() - wall
+        record['cpu_seconds'] = thread_time() - cpu
+        record['children_cpu_seconds'] = children_cpu_time() - children_cpu
+        stack.pop()
+        run.add(record)
+
+
+def count(key, value = 1):
+    """Add $value to the counter $key of the current stage (eg. 'bytes_downloaded', 'rows')"""
+    stack = getattr(_local, 'stack', None)
+    if _run is None or not stack:
+        return
+    counters = stack[-1]['counters']
+    counters[key] = counters.get(key, 0) + value
+
+
+def peak(key, value):
+    """Raise the counter $key of the current stage to $value if it's lower (eg. 'peak_rss_bytes', see is_peak)"""
+    stack = getattr(_local, 'stack', None)
+    if _run is None or not stack:
+        return
+    counters = stack[-1]['counters']
+    counters[key] = max(counters.get(key, value), value)
+
+
+def is_peak(key):
+    """Whether the counter $key is a maximum (see peak) rather than a sum"""
+    return key.startswith("peak_")
+
+
+def record_request(host, latency, error = False):
+    """Record an HTTP request to $host which took $latency seconds (until the response headers)"""
+    run = _run
+    if run is None:
+        return
+    with run.lock:
+        stats = run.host(host)
+        stats['requests'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['latency_seconds'] += latency
+        stats['max_latency_seconds'] = max(stats['max_latency_seconds'], latency)
+
+
+def record_retry(host):
+    """Record that a request to $host is retried"""
+    run = _run
+    if run is None:
+        return
+    with run.lock:
+        run.host(host)['retries'] += 1
+
+
+def response_size(response):
+    """Returns the number of bytes received for the requests $response (compressed, if it was)"""
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError):
+        return len(response.content)
+
+
+def write_run_log(filename, run, status, error = None):
+    """Append the $run as a single JSON line to the file $filename"""
+    entry = {
+        'start': run.start.isoformat(),
+        'status': status,
+        'error': error,
+        'stages': run.stages,
+        'hosts': run.hosts,
+    }
+    with open(filename, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def aggregate_stages(stages):
+    """
+    Returns the stage records $stages merged by stage name (in the order of their first record), as stage records
+    with a 'runs' key: the number of records. The times and the counters are summed (the peak counters take their
+    maximum), and the stage has an 'error' if one of its records has one.
+    """
+    merged = {}
+    for record in stages:
+        x = merged.get(record['stage'])
+        if x is None:
+            x = merged[record['stage']] = {
+                'stage': record['stage'],
+                'runs': 0,
+                'wall_seconds': 0,
+                'cpu_seconds': 0,
+                'children_cpu_seconds': 0,
+                'counters': {},
+            }
+        x['runs'] += 1
+        for key in ('wall_seconds', 'cpu_seconds', 'children_cpu_seconds'):
+            x[key] += record[key]
+        for key, value in record['counters'].items():
+            if key not in x['counters']:
+                x['counters'][key] = value
+            elif is_peak(key):
+                x['counters'][key] = max(x['counters'][key], value)
+            else:
+                x['counters'][key] += value
+        if 'error' in record and 'error' not in x:
+            x['error'] = record['error']
+    return list(merged.values())
+
+
+def format_openmetrics(run, status):
+    """
+    Returns the $run's metrics in the OpenMetrics text format.
+    A stage which ran several times (eg. `backfill.inputs`, once per chunk) is a single series, see aggregate_stages.
+    """
+    lines = []
+
+    def metric(name, help, samples):
+        name = "%s_%s" % (METRIC_PREFIX, name)
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s gauge" % name)
+        for labels, value in samples:
+            labels_s = ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+            lines.append("%s{%s} %s" % (name, labels_s, repr(float(value))) if labels else "%s %s" % (name, repr(float(value))))
+
+    metric("run_start_timestamp_seconds", "Start time of the last model run", [((), run.start.timestamp())])
+    metric("run_success", "Whether the last model run succeeded", [((), 1 if status == "ok" else 0)])
+
+    stages = aggregate_stages(run.stages)
+    metric("stage_runs", "Number of times the stages of the last model run ran",
+           [((('stage', x['stage']),), x['runs']) for x in stages])
+    metric("stage_wall_seconds", "Wall time of the stages of the last model run",
+           [((('stage', x['stage']),), x['wall_seconds']) for x in stages])
+    metric("stage_cpu_seconds", "CPU time of the stages of the last model run",
+           [((('stage', x['stage']),), x['cpu_seconds']) for x in stages])
+    metric("stage_children_cpu_seconds", "CPU time of the child processes which exited during the stages of the last model run",
+           [((('stage', x['stage']),), x['children_cpu_seconds']) for x in stages])
+    metric("stage_success", "Whether the stages of the last model run succeeded",
+           [((('stage', x['stage']),), 0 if 'error' in x else 1) for x in stages])
+
+    keys = sorted(set(key for x in stages for key in x['counters']))
+    for key in keys:
+        metric("stage_%s" % key, "Counter %s of the stages of the last model run" % key,
+               [((('stage', x['stage']),), x['counters'][key]) for x in stages if key in x['counters']])
+
+    hosts = sorted(run.hosts.items())
+    metric("http_requests", "Number of HTTP requests to each host during the last model run",
+           [((('host', host),), x['requests']) for host, x in hosts])
+    metric("http_errors", "Number of failed HTTP requests (connection errors, timeouts, 5xx) to each host during the last model run",
+           [((('host', host),), x['errors']) for host, x in hosts])
+    metric("http_retries", "Number of retried HTTP requests to each host during the last model run",
+           [((('host', host),), x['retries']) for host, x in hosts])
+    metric("http_latency_seconds_sum", "Total latency of the HTTP requests to each host during the last model run",
+           [((('host', host),), x['latency_seconds']) for host, x in hosts])
+    metric("http_latency_seconds_max", "Maximum latency of the HTTP requests to each host during the last model run",
+           [((('host', host),), x['max_latency_seconds']) for host, x in hosts])
+
+    lines.append("# EOF")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def write_textfile(filename, run, status):
+    """
+    Write the $run's metrics to $filename for node_exporter's textfile collector.
+    The file is replaced atomically, so that it is never scraped half-written.
+    """
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(format_openmetrics(run, status))
+    os.replace(tmp_filename, filename)
+
+
+def finish_run(run_log = None, textfile = None, error = None):
+    """
+    Stop recording the current run, and write it to the JSON-lines $run_log and the OpenMetrics $textfile (if not None).
+    $error is the exception which stopped the run, if any.
+    """
+    global _run
+    run, _run = _run, None
+    if run is None:
+        return None
+
+    status = "ok" if error is None else "error"
+    error_s = None if error is None else "%s: %s" % (type(error).__name__, error)
+    if run_log is not None:
+        write_run_log(run_log, run, status, error_s)
+    if textfile is not None:
+        write_textfile(textfile, run, status)
+    return run
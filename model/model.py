@@ -3,21 +3,56 @@ import argparse
 import os
 import sys
 import shutil
-import subprocess
+import threading
+import time
+import traceback
+import configparser
 from datetime import datetime, timezone, timedelta
 
 from meteo import main as meteo_main
 from fond import main as fond_main
-from emission import main as emission_main, write_evolemislin
+from emission import main as emission_main, write_evolemislin, read_traffic_profile, traffic_modulation
+from workdir import SIRANE_DIR, DEFAULT_WORKDIR_ROOT, DEFAULT_WORKDIR_KEEP, create_workdir, install_input, link_input, \
+    hold_workdir, release_workdir, prune_workdirs
+from runpool import run_sirane, run_pool, read_pool_config
+from runcache import run_cached
+from mapcache import DEFAULT_CACHE_DIR
+from daemon import run_daemon
+from meteo import print_sirane_meteo_input
+from fond import print_sirane_fond_input
+import backfill as bf
+import modulation
+import metrics
+import monitor
+import fetch
+import capture
 
 
 # WARN SIRANE's directory is hardcoded as being "sirane"
 
+# Default maximum number of seconds each fetch stage may take, see run_stages()
+# The fond stage waits in the CDS queue, so it gets the largest budget
+DEFAULT_DEADLINES = {
+    'meteo': 120,
+    'fond': 1800,
+    'emission': 600,
+}
 
-def edit_donnees_dat(start_time_s, end_time_s, donnees_dat_path, output_filename):
+
+# Default JSON-lines file to which each run's stages are appended, see metrics.py
+DEFAULT_RUN_LOG = "sirane/run_log.jsonl"
+
+
+class FetchError(Exception):
+    """Raised by run_stages() when one or more stages failed or missed their deadline"""
+    pass
+
+
+def edit_donnees_dat(start_time_s, end_time_s, donnees_dat_path, output_filename, lin_modulations = None):
     """
     Edit the Donnees.dat at $donnees_dat_path and write the output to $output_filename.
-    We edit in the simulation start and end times based on the strings $start_time_s and $end_time_s
+    We edit in the simulation start and end times based on the strings $start_time_s and $end_time_s,
+    and the number of linear modulations if $lin_modulations is given (see modulation.py)
     """
     # Slurp lines
     with open(donnees_dat_path) as f:
@@ -31,92 +66,409 @@ def edit_donnees_dat(start_time_s, end_time_s, donnees_dat_path, output_filename
                 line = "Date de debut = %s\n" % start_time_s
             if line.startswith("Date de fin"):
                 line = "Date de fin = %s\n" % end_time_s
+            if line.startswith("Nombre de modulations lineiques") and lin_modulations is not None:
+                line = "Nombre de modulations lineiques = %d\n" % lin_modulations
             
             f.write(line)
 
-def launch_model():
+
+def run_stages(stages, deadlines):
     """
-    Launch the model in its directory using the "default" input files configuration layout.
+    Run the $stages concurrently, each in its own thread, and wait for all of them.
+
+    $stages is a dictionary of stage names mapping to functions without arguments.
+    $deadlines is a dictionary of stage names mapping to the number of seconds that stage
+    may run for, counted from the moment all the stages are started (None means no deadline).
+
+    The HTTP requests of each stage (see fetch.py) stop at its deadline, or at the deadline of the requests of the
+    calling thread if it comes first. A stage which misses its deadline is left running in the background, but its
+    requests fail from then on, so that it doesn't keep downloading (eg. into the next run of the daemon).
+
+    Returns a dictionary of stage names mapping to the return values of the stage functions.
+    Raises a FetchError listing every stage which raised an exception or missed its deadline.
     """
-    # Flush stdout and stderr before launching the model so that it displays
-    # buffered output before the subprocess's output
-    sys.stdout.flush()
-    sys.stderr.flush()
+    results = {}
+    errors = {}
+
+    # The deadlines of the requests are per thread, so each stage thread sets its own
+    fetch_deadlines = {}
+    for name in stages:
+        limits = [ x for x in (fetch.remaining_time(), deadlines.get(name)) if x is not None ]
+        fetch_deadlines[name] = min(limits) if limits else None
+
+    def run(name, func):
+        fetch.set_deadline(fetch_deadlines[name])
+        try:
+            with metrics.stage(name):
+                results[name] = func()
+        except Exception as e:
+            errors[name] = e
+            # Print the traceback now, as the exception doesn't cross the thread boundary
+            print("Stage %s failed:" % name, file = sys.stderr)
+            traceback.print_exc()
+
+    # Daemon threads so that a stage stuck on the network doesn't keep the process alive
+    threads = {}
+    for name, func in stages.items():
+        threads[name] = threading.Thread(target = run, args = (name, func), name = name, daemon = True)
+
+    start = time.monotonic()
+    for thread in threads.values():
+        thread.start()
+
+    # Wait for the stages with the closest deadlines first
+    def deadline_key(name):
+        deadline = deadlines.get(name)
+        return float('inf') if deadline is None else deadline
+
+    for name in sorted(threads, key = deadline_key):
+        deadline = deadlines.get(name)
+        if deadline is None:
+            threads[name].join()
+        else:
+            elapsed = time.monotonic() - start
+            threads[name].join(max(0, deadline - elapsed))
+
+        if threads[name].is_alive():
+            errors[name] = TimeoutError("missed its %ss deadline" % deadline)
+            print("Stage %s missed its %ss deadline" % (name, deadline), file = sys.stderr)
 
-    # Run SIRANE in sirane/ directory
-    cmd = ["./sirane-rev128-etudiants-Linux64", "INPUT/Donnees.dat", "Log.txt"]
-    subprocess.run(cmd, cwd = "sirane")
+    if errors:
+        summary = ", ".join("%s (%s)" % (name, errors[name]) for name in stages if name in errors)
+        raise FetchError("Failed stages: %s" % summary)
 
+    return results
 
-def main(configfile = None, skip_download = None, skip_emission = False, keep_traffic = None):
+
+def launch_model(cwd = SIRANE_DIR, settings = None):
+    """
+    Launch the model in the directory $cwd (sirane/ or a work directory) using the "default" input files configuration layout.
+    $settings is the runpool.PoolSettings (memory limit, timeout, …) of the model.
+    Returns SIRANE's return code. Its peak memory is recorded in the current metrics stage.
+    """
+    watched = run_sirane(cwd, settings)
+    monitor.record_metrics(watched)
+    return watched.returncode
+
+
+def main(configfile = None, skip_download = None, skip_emission = False, keep_traffic = None, hours = None,
+         isolated = None, skip_launch = None, replay = None):
+    """
+    Prepare SIRANE's input files and launch the model.
+
+    If $isolated, the inputs are written to a new work directory (see workdir.py) and the model is run there,
+    instead of the shared sirane/ directory.
+    If $replay is an aware datetime, the data recorded at that time is used instead of downloading it (see capture.py).
+    Returns the directory in which the model was (or would have been with $skip_launch) run.
+    """
     if configfile is None:
         configfile = "config.ini"
+    if hours is None:
+        hours = 0
     skip_download = bool(skip_download)
     skip_emission = bool(skip_emission)
     keep_traffic = bool(keep_traffic)
+    isolated = bool(isolated)
+    skip_launch = bool(skip_launch)
     
     timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%SZ")
 
-    # Create an empty data files directory
-    dl_dir = "sirane/dl_data"
-    # shutil.rmtree(dl_dir, ignore_errors=True) # DEBUG uncomment
+    # Read the stage deadlines (in seconds) from the configuration file
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    capture.configure_from_file(configfile, replay = replay)
+    deadlines = {}
+    for name, default in DEFAULT_DEADLINES.items():
+        deadlines[name] = config.getfloat('model', '%s_deadline' % name, fallback = default)
+
+    # Record the stages of the run, see metrics.py
+    run_log = config.get('model', 'run_log', fallback = DEFAULT_RUN_LOG)
+    metrics_textfile = config.get('model', 'metrics_textfile', fallback = None)
+    metrics.start_run()
+    error = None
+
+    # The HTTP requests of the run can't go beyond the deadline of the stages which make them
+    fetch_deadline = config.getfloat('model', 'fetch_deadline', fallback = max(deadlines['meteo'], deadlines['emission']))
+    fetch.set_deadline(fetch_deadline)
+
+    # Linear emission modulation per road class, see modulation.py
+    modulation_options = modulation.read_modulation_config(configfile)
+    modulated = None
+    lin_modulations = None
+    run_dir = None
+
     try:
-        os.mkdir(dl_dir)
-    except FileExistsError:
-        pass
-
-    # TODO download more data
-    if not skip_download:
-        print("Fetching data…")
-
-        # Create meteo file
-        meteo_output = "%s/meteo_%s.dat" % (dl_dir, timestamp)
-        print("Creating meteo file at %s" % meteo_output)
-        meteo_start = meteo_main(outputfile = meteo_output, configfile = configfile)
-
-        # Create fond file
-        fond_output = "%s/fond_%s.dat" % (dl_dir, timestamp)
-        print("Creating fond file at %s" % fond_output)
-        fond_start = fond_main(outputfile = fond_output, configfile = configfile)
-
-        if not skip_emission:
-            # Create EmisLin file
+        # Directory in which the model is run
+        if isolated:
+            workdir_root = config.get('model', 'workdir_root', fallback = DEFAULT_WORKDIR_ROOT)
+            prune_workdirs(workdir_root, config.getint('model', 'workdir_keep', fallback = DEFAULT_WORKDIR_KEEP))
+            run_dir = create_workdir(root = workdir_root, prefix = timestamp + "-")
+            hold_workdir(run_dir)
+            print("Created work directory %s" % run_dir)
+        else:
+            run_dir = SIRANE_DIR
+
+        # Create an empty data files directory
+        dl_dir = "%s/dl_data" % run_dir
+        # shutil.rmtree(dl_dir, ignore_errors=True) # DEBUG uncomment
+        try:
+            os.mkdir(dl_dir)
+        except FileExistsError:
+            pass
+
+        # TODO download more data
+        if not skip_download:
+            print("Fetching data…")
+
+            # The stages don't share anything, so they are run concurrently
+            meteo_output = "%s/meteo_%s.dat" % (dl_dir, timestamp)
+            fond_output = "%s/fond_%s.dat" % (dl_dir, timestamp)
             emis_output = "%s/emis_lin_%s.dat" % (dl_dir, timestamp)
-            print("Creating emission file at %s" % emis_output)
-            traffic_time, datex_time = emission_main(outputfile = emis_output, configfile = configfile, keep_traffic_data = keep_traffic)
+            print("Creating meteo file at %s" % meteo_output)
+            print("Creating fond file at %s" % fond_output)
+            stages = {
+                'meteo': lambda: meteo_main(outputfile = meteo_output, configfile = configfile),
+                # The forecast starts at midnight, and must go beyond the current hour by $hours
+                'fond': lambda: fond_main(outputfile = fond_output, configfile = configfile,
+                                          tohour = max(24, capture.now().hour + hours + 1)),
+            }
+            if not skip_emission and modulation_options is not None:
+                # Only the modulation factors of the base emissions are computed, see modulation.py
+                print("Computing the emission modulation factors")
+                stages['emission'] = lambda: modulation.main(configfile = configfile, keep_traffic_data = keep_traffic)
+            elif not skip_emission:
+                print("Creating emission file at %s" % emis_output)
+                stages['emission'] = lambda: emission_main(outputfile = emis_output, configfile = configfile, keep_traffic_data = keep_traffic)
 
-    else:
-        print("Skipped fetching data from network sources")
-
-    # Compute simulation start time
-    # NB 0 hour simulation because we don't have a traffic/emission prediction model
-    start_time = max(meteo_start, fond_start)
-    end_time = start_time + timedelta(hours = 0)
-    start_time_s = start_time.strftime("%d/%m/%Y %H:%M:%S")
-    end_time_s = end_time.strftime("%d/%m/%Y %H:%M:%S")
-
-    # Edit INPUT/Donnees.dat
-    print("Editing Donnees.dat")
-    edit_donnees_dat(start_time_s, end_time_s, "sirane/INPUT/Donnees.dat", "sirane/new_donnees.dat")
-    shutil.move("sirane/new_donnees.dat", "sirane/INPUT/Donnees.dat")
+            results = run_stages(stages, deadlines)
+            meteo_start = results['meteo']
+            fond_start = results['fond']
+            if 'emission' in results and modulation_options is not None:
+                modulated = results['emission']
+                traffic_time, datex_time = modulated.traffic_time, modulated.datex_time
+            elif 'emission' in results:
+                traffic_time, datex_time = results['emission']
+
+        else:
+            print("Skipped fetching data from network sources")
+
+        # Compute simulation start time
+        # NB 0 hour simulation by default because we don't have a traffic/emission prediction model,
+        # multi-hour simulations modulate the current emissions with a traffic profile
+        start_time = max(meteo_start, fond_start)
+        end_time = start_time + timedelta(hours = hours)
+        start_time_s = start_time.strftime("%d/%m/%Y %H:%M:%S")
+        end_time_s = end_time.strftime("%d/%m/%Y %H:%M:%S")
+
+        # Write the input files
+        with metrics.stage('inputs'):
+            # Edit INPUT/Donnees.dat
+            print("Editing Donnees.dat")
+            if modulation_options is not None:
+                lin_modulations = modulation.class_weights_from_options(modulation_options).class_count
+            edit_donnees_dat(start_time_s, end_time_s, "%s/INPUT/Donnees.dat" % run_dir, "%s/new_donnees.dat" % run_dir,
+                             lin_modulations = lin_modulations)
+            install_input("%s/new_donnees.dat" % run_dir, run_dir, "Donnees.dat")
     
-    # Create EvolEmisLin file
-    evolemis_data = [(start_time, "EMISSIONS/EMIS_LIN/emis_lin.dat", "EMISSIONS/EMIS_SURF/Emis_surf.dat")]
-    evolemis_output = "%s/evol_emis_lin_%s.dat" % (dl_dir, timestamp)
-    with open(evolemis_output, 'w') as f:
-        write_evolemislin(evolemis_data, f)
+            # Create EvolEmisLin file, with one row per hour
+            profile = None
+            profile_file = config.get('emission', 'traffic_profile', fallback = None)
+            if hours > 0 and profile_file is not None:
+                profile = read_traffic_profile(profile_file)
+            factors = traffic_modulation(profile, start_time, hours)
+            if modulated is not None:
+                # The road class factors of the current hour, modulated by the traffic profile
+                factors = [ modulation.evol_factors(modulated.factors, factor) for factor in factors ]
+            evolemis_data = [ (start_time + timedelta(hours = h), "EMISSIONS/EMIS_LIN/emis_lin.dat", "EMISSIONS/EMIS_SURF/Emis_surf.dat", factor)
+                              for h, factor in enumerate(factors) ]
+            evolemis_output = "%s/evol_emis_lin_%s.dat" % (dl_dir, timestamp)
+            with open(evolemis_output, 'w') as f:
+                write_evolemislin(evolemis_data, f, lin_modulations = lin_modulations or 1)
+
+            # Copy data files
+            print("Copying files")
+            install_input(meteo_output, run_dir, "METEO/Meteo.dat")
+            install_input(fond_output, run_dir, "FOND/Concentration_Fond.dat")
+            if modulated is not None:
+                link_input(modulated.emis_lin, run_dir, "EMISSIONS/EMIS_LIN/emis_lin.dat")
+            elif not skip_emission:
+                install_input(emis_output, run_dir, "EMISSIONS/EMIS_LIN/emis_lin.dat")
+            install_input(evolemis_output, run_dir, "EMISSIONS/Emissions_Lin_Surf.dat")
+
+        # Launch model
+        if skip_launch:
+            print("Skipped launching the model in %s" % run_dir)
+        else:
+            print("Launching model in %s" % run_dir)
+            settings = read_pool_config(configfile)
+            run_cache_size = config.getfloat('model', 'run_cache_size', fallback = 0)
+            with metrics.stage('launch'):
+                if run_cache_size > 0:
+                    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+                    returncode = run_cached(run_dir, lambda: launch_model(run_dir, settings), cache_dir, run_cache_size)
+                else:
+                    returncode = launch_model(run_dir, settings)
+                metrics.count('returncode', returncode)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        fetch.set_deadline(None)
+        if isolated and run_dir is not None:
+            release_workdir(run_dir)
+        metrics.finish_run(run_log = run_log, textfile = metrics_textfile, error = error)
+
+    return run_dir
+
+
+def backfill(configfile = None, start = None, end = None, chunk_days = None, skip_launch = None):
+    """
+    Simulate the past days from $start to $end (included, naive UTC datetimes) from the reanalyses (see backfill.py).
+
+    The period is split into chunks of $chunk_days days, each simulated by a single SIRANE run in its own
+    work directory, and the runs are made in parallel (see runpool.py).
+    Returns the list of the work directories, in chronological order.
+    """
+    if configfile is None:
+        configfile = "config.ini"
+    skip_launch = bool(skip_launch)
+
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    options = bf.read_backfill_config(configfile)
+    if chunk_days is None:
+        chunk_days = options['chunk_days']
+    lat, lon, cache_dir = options['latitude'], options['longitude'], options['cache_dir']
+    end = end + timedelta(days = 1)
 
-    # Copy data files
-    print("Copying files")
-    shutil.move(meteo_output, "sirane/INPUT/METEO/Meteo.dat")
-    shutil.move(fond_output, "sirane/INPUT/FOND/Concentration_Fond.dat")
-    if not skip_emission:
-        shutil.move(emis_output, "sirane/INPUT/EMISSIONS/EMIS_LIN/emis_lin.dat")
-    shutil.move(evolemis_output, "sirane/INPUT/EMISSIONS/Emissions_Lin_Surf.dat")
+    profile = None
+    profile_file = config.get('emission', 'traffic_profile', fallback = None)
+    if profile_file is not None:
+        profile = read_traffic_profile(profile_file)
 
-    # Launch model
-    print("Launching model")
-    launch_model()
+    # The bases of the past hours are kept apart from the ones of the live runs
+    modulation_options = modulation.read_modulation_config(configfile)
+    lin_modulations = None
+    if modulation_options is not None:
+        lin_modulations = modulation.class_weights_from_options(modulation_options).class_count
+        base_dir = os.path.join(modulation_options['base_dir'], "backfill")
+
+    run_log = config.get('model', 'run_log', fallback = DEFAULT_RUN_LOG)
+    metrics_textfile = config.get('model', 'metrics_textfile', fallback = None)
+    metrics.start_run()
+    error = None
+    base = None
+    workdirs = []
+
+    try:
+        with metrics.stage('backfill.meteo'):
+            meteo_data = bf.meteo_data(start, end, lat, lon, cache_dir, options['era5_cdsapircfile'])
+            metrics.count('rows', len(meteo_data))
+        with metrics.stage('backfill.fond'):
+            fond_data = bf.background_data(start, end, lat, lon, cache_dir, options['ads_cdsapircfile'],
+                                           options['cams_reanalysis_type'])
+            metrics.count('rows', len(fond_data))
+
+        for name, data in [('meteo', meteo_data), ('background concentrations', fond_data)]:
+            missing = bf.missing_hours(data, start, end)
+            if missing:
+                raise ValueError("The %s of %d hours are missing, from %s to %s" % (name, len(missing), missing[0], missing[-1]))
+
+        workdir_root = config.get('model', 'workdir_root', fallback = DEFAULT_WORKDIR_ROOT)
+        prune_workdirs(workdir_root, config.getint('model', 'workdir_keep', fallback = DEFAULT_WORKDIR_KEEP))
+        capture.configure_from_file(configfile)
+
+        # The hours without recorded traffic modulate a snapshot of the emissions of the live runs
+        os.makedirs(workdir_root, exist_ok = True)
+        base = bf.snapshot_emislin(os.path.join(SIRANE_DIR, "INPUT", "EMISSIONS/EMIS_LIN/emis_lin.dat"), workdir_root)
+        if base is not None:
+            print("Modulating the emissions of %s for the hours without recorded traffic" % base[1], file = sys.stderr)
+        for chunk_start, chunk_end in bf.split_chunks(start, end, chunk_days):
+            with metrics.stage('backfill.inputs'):
+                run_dir = create_workdir(root = workdir_root, prefix = "backfill_%s-" % chunk_start.strftime("%Y-%m-%d"))
+                hold_workdir(run_dir)
+                workdirs.append(run_dir)
+                print("Preparing %s to %s in %s" % (chunk_start, chunk_end, run_dir), file = sys.stderr)
+                dl_dir = "%s/dl_data" % run_dir
+                os.mkdir(dl_dir)
+
+                meteo_output = "%s/meteo.dat" % dl_dir
+                with open(meteo_output, 'w') as f:
+                    print_sirane_meteo_input(bf.slice_hours(meteo_data, chunk_start, chunk_end), file = f)
+                install_input(meteo_output, run_dir, "METEO/Meteo.dat")
+
+                fond_output = "%s/fond.dat" % dl_dir
+                with open(fond_output, 'w') as f:
+                    print_sirane_fond_input(bf.slice_hours(fond_data, chunk_start, chunk_end), file = f)
+                install_input(fond_output, run_dir, "FOND/Concentration_Fond.dat")
+
+                # The emissions of each hour: computed from the traffic recorded during that hour if there is one,
+                # otherwise the snapshot of the live emissions modulated by the traffic profile.
+                # With road classes, the recorded hours are the base emissions of their day type with
+                # the modulation factors of that hour (see modulation.py), instead of one file per hour.
+                if base is not None:
+                    link_input(base[0], run_dir, "EMISSIONS/EMIS_LIN/emis_lin.dat")
+                hours = bf.hours_between(chunk_start, chunk_end)
+                evolemis_data = []
+                for hour in hours:
+                    replay_time = bf.recorded_traffic_time(hour)
+                    if replay_time is None:
+                        if base is None:
+                            raise ValueError("No emissions to modulate for %s, which has no recorded traffic" % hour)
+                        factor, = bf.profile_factors(profile, [hour], base[1])
+                        evolemis_data.append((hour, "EMISSIONS/EMIS_LIN/emis_lin.dat", "EMISSIONS/EMIS_SURF/Emis_surf.dat", factor))
+                        continue
+                    capture.configure_from_file(configfile, replay = replay_time)
+                    try:
+                        if modulation_options is not None:
+                            modulated = modulation.main(configfile = configfile, time = hour, base_dir = base_dir)
+                        else:
+                            emis_output = "%s/emis_lin_%s.dat" % (dl_dir, hour.strftime("%Y%m%d%H"))
+                            emission_main(outputfile = emis_output, configfile = configfile)
+                    finally:
+                        capture.configure_from_file(configfile)
+                    if modulation_options is not None:
+                        relpath = "EMISSIONS/EMIS_LIN/%s" % os.path.basename(modulated.emis_lin)
+                        link_input(modulated.emis_lin, run_dir, relpath)
+                        evolemis_data.append((hour, relpath, "EMISSIONS/EMIS_SURF/Emis_surf.dat",
+                                              modulation.evol_factors(modulated.factors)))
+                    else:
+                        relpath = "EMISSIONS/EMIS_LIN/emis_lin_%s.dat" % hour.strftime("%Y%m%d%H")
+                        install_input(emis_output, run_dir, relpath)
+                        evolemis_data.append((hour, relpath, "EMISSIONS/EMIS_SURF/Emis_surf.dat", 1))
+                    metrics.count('recorded_hours')
+
+                evolemis_output = "%s/evol_emis_lin.dat" % dl_dir
+                with open(evolemis_output, 'w') as f:
+                    write_evolemislin(evolemis_data, f, lin_modulations = lin_modulations or 1)
+                install_input(evolemis_output, run_dir, "EMISSIONS/Emissions_Lin_Surf.dat")
+
+                start_time_s = chunk_start.strftime("%d/%m/%Y %H:%M:%S")
+                end_time_s = hours[-1].strftime("%d/%m/%Y %H:%M:%S")
+                edit_donnees_dat(start_time_s, end_time_s, "%s/INPUT/Donnees.dat" % run_dir, "%s/new_donnees.dat" % run_dir,
+                                 lin_modulations = lin_modulations)
+                install_input("%s/new_donnees.dat" % run_dir, run_dir, "Donnees.dat")
+
+        if skip_launch:
+            print("Skipped launching the model in %s" % " ".join(workdirs))
+        else:
+            with metrics.stage('backfill.launch'):
+                returncodes = run_pool(workdirs, read_pool_config(configfile))
+                metrics.count('failed_runs', sum(1 for x in returncodes if x != 0))
+            for run_dir, returncode in zip(workdirs, returncodes):
+                print("%s: %s" % (run_dir, "ok" if returncode == 0 else "failed (%d)" % returncode))
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        # The work directories have their own links to the snapshot
+        if base is not None:
+            os.unlink(base[0])
+        for run_dir in workdirs:
+            release_workdir(run_dir)
+        metrics.finish_run(run_log = run_log, textfile = metrics_textfile, error = error)
+
+    return workdirs
 
 
 if __name__ == "__main__":
@@ -125,9 +477,33 @@ if __name__ == "__main__":
     parser.add_argument("--skip-download", action = "store_true")
     parser.add_argument("--skip-emission", action = "store_true")
     parser.add_argument("--keep-traffic", action = "store_true")
+    parser.add_argument("--hours", type = int, help = "Number of hours to simulate after the current one")
+    parser.add_argument("--isolated", action = "store_true", help = "Run the model in a new work directory")
+    parser.add_argument("--skip-launch", action = "store_true", help = "Only prepare the input files")
+    parser.add_argument("--daemon", action = "store_true", help = "Stay in memory and run the model on a schedule")
+    parser.add_argument("--replay", type = capture.parse_timestamp, metavar = "TIMESTAMP",
+                        help = "Use the data recorded at this UTC time (eg. 2021-03-01T14:00) instead of downloading it")
+    parser.add_argument("--backfill", nargs = 2, metavar = ("START", "END"),
+                        help = "Simulate the days from START to END (included, eg. 2020-12-01 2021-02-28) from the reanalyses")
+    parser.add_argument("--chunk-days", type = int, help = "Number of days simulated by each SIRANE run with --backfill")
     args = parser.parse_args()
 
-    main(configfile = args.config,
-         skip_download = args.skip_download,
-         skip_emission = args.skip_emission,
-         keep_traffic = args.keep_traffic)
+    def run():
+        main(configfile = args.config,
+             skip_download = args.skip_download,
+             skip_emission = args.skip_emission,
+             keep_traffic = args.keep_traffic,
+             hours = args.hours,
+             isolated = args.isolated,
+             skip_launch = args.skip_launch,
+             replay = args.replay)
+
+    if args.backfill is not None:
+        start, end = [ bf.parse_date(x) for x in args.backfill ]
+        backfill(configfile = args.config, start = start, end = end, chunk_days = args.chunk_days,
+                 skip_launch = args.skip_launch)
+    elif args.daemon:
+        # The last run of the day needs the forecast up to 24:00 + $hours
+        run_daemon(run, configfile = args.config, prefetch_tohour = 24 + (args.hours or 0))
+    else:
+        run()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import glob
+import pickle
+import argparse
+import configparser
+from datetime import timedelta
+from array import array
+from collections import namedtuple
+
+from emission import fetch_emissions, aggregate_emissions, write_emislin, load_aggregation
+from mapcache import load_compiled, DEFAULT_CACHE_DIR
+import capture
+import metrics
+
+"""
+Temporal modulation of the linear emissions.
+
+Instead of writing the emissions of every network segment each hour, a base EmisLin file is kept
+for each day type (DAY_TYPES), and the changes from hour to hour are given to SIRANE as linear modulation
+factors (the Mod_Lin_<k>_* columns of Emissions_Lin_Surf.dat), one modulation per road class.
+A run then only writes the small modulation table, and links the base file into its inputs.
+
+The road class of each network segment comes from the road classes file (see `docs/config.md`).
+The classes are SIRANE's linear modulation numbers, so they must be the same as in SIRANE's network file,
+and 'Nombre de modulations lineiques' in Donnees.dat is set to the number of classes.
+
+The factors are fitted on the live NM and DATEX2 data: for each class and species, the factor is the ratio of the
+emissions of the traffic ids which have data in both the current hour and the base, to their emissions in the base.
+This is done on the ColumnEmissions (one value per traffic id, see emission.py), weighted by the length of
+the network segments of each class (ClassWeights), so the network-sized emissions are never computed.
+
+The base of a day type is replaced by the current emissions (with factors of 1) when it is missing,
+older than `base_max_age` days, or when less than `min_coverage` of the current traffic ids are in it.
+Each base is kept in the modulation cache directory as an EmisLin file and a pickled Base.
+"""
+
+DAY_TYPES = ['weekday', 'saturday', 'sunday']
+
+DEFAULT_BASE_MAX_AGE = 7 # days
+DEFAULT_MIN_COVERAGE = 0.95
+
+# Number of previous base files of each day type which are kept, for the runs which may still link them
+KEEP_BASES = 2
+
+
+Base = namedtuple('Base', ['time', 'day_type', 'emis_lin', 'segment_count', 'column_emissions'])
+Base.__doc__ = """
+The base emissions of a day type: the (naive UTC) time of the traffic data, the day type,
+the filename of the EmisLin file, the number of network segments, and the ColumnEmissions.
+"""
+
+ClassWeights = namedtuple('ClassWeights', ['class_count', 'indptr', 'classes', 'weights'])
+ClassWeights.__doc__ = """
+The lengths in km of the network segments of each road class, per AggregationMatrix column (ie. traffic id):
+the entries of column c are at positions indptr[c] to indptr[c+1] (excluded) in classes and weights.
+"""
+
+ModulatedEmissions = namedtuple('ModulatedEmissions', ['emis_lin', 'factors', 'rebased', 'traffic_time', 'datex_time'])
+ModulatedEmissions.__doc__ = """
+The result of &main: the filename of the base EmisLin file, the list of the (NOx, PM10, PM25) factors of each road class,
+whether the base was replaced by the current emissions, and the times of the NM and DATEX2 data.
+"""
+
+
+def day_type(dt):
+    """Returns the day type of the datetime $dt, see DAY_TYPES"""
+    weekday = dt.weekday()
+    if weekday < 5:
+        return 'weekday'
+    return 'saturday' if weekday == 5 else 'sunday'
+
+
+def read_road_classes(filename):
+    """
+    Read the road classes file, and returns a dictionary of network segment ids mapping to their class.
+
+    The road classes file is a csv file (with header) whose first column is the network segment id,
+    and the second column its road class, from 0. Additional columns are ignored.
+    """
+    road_classes = {}
+
+    with open(filename) as f:
+        reader = csv.reader(f)
+        reader = iter(reader)
+        _headers = next(reader) # Skip headers
+
+        for row in reader:
+            road_class = int(row[1])
+            if road_class < 0:
+                raise ValueError("Invalid road class %d for segment %s in %s" % (road_class, row[0], filename))
+            road_classes[row[0]] = road_class
+
+    return road_classes
+
+
+def compile_class_weights(matrix, road_classes):
+    """
+    Compile the AggregationMatrix and the road classes into ClassWeights.
+    The segments which aren't in $road_classes are in class 0.
+    """
+    column_count = sum(len(c) for c in matrix.columns)
+    class_count = max(road_classes.values(), default = 0) + 1
+
+    # Sum the weights of each (column, class)
+    column_weights = [ {} for _ in range(column_count) ]
+    indptr, indices, weights = matrix.indptr, matrix.indices, matrix.weights
+    for row in range(matrix.row_count):
+        road_class = road_classes.get(str(row), 0)
+        for i in range(indptr[row], indptr[row + 1]):
+            entry = column_weights[indices[i]]
+            entry[road_class] = entry.get(road_class, 0) + weights[i]
+
+    class_indptr = array('l', [0] * (column_count + 1))
+    classes = array('l')
+    class_weights = array('d')
+    for column, entry in enumerate(column_weights):
+        for road_class, weight in sorted(entry.items()):
+            classes.append(road_class)
+            class_weights.append(weight)
+        class_indptr[column + 1] = len(classes)
+
+    return ClassWeights(class_count, class_indptr, classes, class_weights)
+
+
+def load_class_weights(nm_segment_mapfile, d2_segment_mapfile, segment_length_file, road_classes_file, cache_dir = None):
+    """Returns the ClassWeights of the network, cached in $cache_dir until one of the files changes (cf. mapcache.py)"""
+    def compile(*sources):
+        matrix, _network_count = load_aggregation(*sources[:3], cache_dir = cache_dir)
+        return tuple(compile_class_weights(matrix, read_road_classes(sources[3])))
+
+    sources = [nm_segment_mapfile, d2_segment_mapfile, segment_length_file, road_classes_file]
+    return ClassWeights(*load_compiled('class_weights', sources, compile, cache_dir = cache_dir))
+
+
+def coverage(column_emissions, base_column_emissions):
+    """Returns the fraction of the traffic ids with data in $column_emissions which also have data in the base"""
+    present, base_present = column_emissions[3], base_column_emissions[3]
+    count = both = 0
+    for column, value in enumerate(present):
+        if value:
+            count += 1
+            if base_present[column]:
+                both += 1
+    return both / count if count else 1
+
+
+def fit_factors(class_weights, column_emissions, base_column_emissions):
+    """
+    Returns the list of the (NOx, PM10, PM25) modulation factors of each road class, which turn
+    the base emissions into the current ones (see the module's documentation).
+    A factor is 1 if the class has no traffic id with data in both.
+    """
+    indptr, classes, weights = class_weights.indptr, class_weights.classes, class_weights.weights
+    current = [ [0, 0, 0] for _ in range(class_weights.class_count) ]
+    base = [ [0, 0, 0] for _ in range(class_weights.class_count) ]
+
+    e_NOx, e_PM10, e_PM25, present = column_emissions
+    b_NOx, b_PM10, b_PM25, base_present = base_column_emissions
+    for column in range(len(present)):
+        if not (present[column] and base_present[column]):
+            continue
+        for i in range(indptr[column], indptr[column + 1]):
+            weight = weights[i]
+            x, b = current[classes[i]], base[classes[i]]
+            x[0] += e_NOx[column] * weight
+            x[1] += e_PM10[column] * weight
+            x[2] += e_PM25[column] * weight
+            b[0] += b_NOx[column] * weight
+            b[1] += b_PM10[column] * weight
+            b[2] += b_PM25[column] * weight
+
+    return [ tuple(c / b if b > 0 else 1 for c, b in zip(x, y)) for x, y in zip(current, base) ]
+
+
+def evol_factors(factors, scale = 1):
+    """
+    Returns the linear modulation factors of a row of Emissions_Lin_Surf.dat (see emission.write_evolemislin),
+    from the (NOx, PM10, PM25) factors of each road class, multiplied by $scale (eg. the traffic profile).
+    NO and O3 use the NOx factor (their emissions are 0 anyway).
+    """
+    return [ tuple(round(x * scale, 6) for x in (nox, nox, pm10, pm25, nox)) for nox, pm10, pm25 in factors ]
+
+
+# === Base files ===
+
+def base_filename(base_dir, day_type):
+    return os.path.join(base_dir, "base_%s.pickle" % day_type)
+
+
+def read_base(base_dir, day_type):
+    """Returns the Base of $day_type in $base_dir, or None if there is none"""
+    try:
+        with open(base_filename(base_dir, day_type), 'rb') as f:
+            base = Base(*pickle.load(f))
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+        return None
+    if not os.path.exists(base.emis_lin):
+        return None
+    return base
+
+
+def write_base(base_dir, day_type, time, fetched):
+    """
+    Write the emissions of FetchedEmissions $fetched (see emission.fetch_emissions) as the base of $day_type
+    in $base_dir, and returns the new Base
+    """
+    os.makedirs(base_dir, exist_ok = True)
+
+    # Each base has its own EmisLin file, so that replacing a base doesn't change the inputs of a run
+    # which is linking the previous one
+    emis_lin = os.path.join(base_dir, "emis_lin_%s_%s.dat" % (day_type, time.strftime("%Y%m%d%H%M%S")))
+    emis_data = aggregate_emissions(fetched.matrix, fetched.column_emissions)
+    metrics.count('rows', len(emis_data))
+    tmp_filename = "%s.%d.tmp" % (emis_lin, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        write_emislin(emis_data, fetched.segment_count, f)
+    os.replace(tmp_filename, emis_lin)
+
+    base = Base(time, day_type, emis_lin, fetched.segment_count, fetched.column_emissions)
+    filename = base_filename(base_dir, day_type)
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        pickle.dump(tuple(base), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+    # Remove the oldest EmisLin files of the day type
+    previous = sorted(glob.glob(os.path.join(base_dir, "emis_lin_%s_*.dat" % day_type)))
+    for old in previous[:-(KEEP_BASES + 1)]:
+        os.unlink(old)
+
+    return base
+
+
+def rebase_reason(base, fetched, time, options):
+    """Returns why the Base $base must be replaced by the FetchedEmissions $fetched at $time, or None"""
+    if base is None:
+        return "no base"
+    if base.segment_count != fetched.segment_count or len(base.column_emissions[3]) != len(fetched.column_emissions[3]):
+        return "the network changed"
+    if abs(time - base.time) > timedelta(days = options['base_max_age']):
+        return "the base is from %s" % base.time
+    base_coverage = coverage(fetched.column_emissions, base.column_emissions)
+    if base_coverage < options['min_coverage']:
+        return "only %.1f%% of the traffic ids are in the base" % (base_coverage * 100)
+    return None
+
+
+def read_modulation_config(configfile):
+    """Returns the [modulation] options as a dictionary, or None if there is no road classes file"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    road_classes = config.get('modulation', 'road_classes', fallback = None)
+    if road_classes is None:
+        return None
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+    return {
+        'road_classes': road_classes,
+        'base_max_age': config.getfloat('modulation', 'base_max_age', fallback = DEFAULT_BASE_MAX_AGE),
+        'min_coverage': config.getfloat('modulation', 'min_coverage', fallback = DEFAULT_MIN_COVERAGE),
+        'base_dir': os.path.join(cache_dir, "modulation"),
+        'cache_dir': cache_dir,
+        'nm_segment_map': config['emission']['nm_segment_map'],
+        'd2_segment_map': config['emission']['d2_segment_map'],
+        'network_segment_length': config['emission']['network_segment_length'],
+    }
+
+
+def class_weights_from_options(options):
+    return load_class_weights(options['nm_segment_map'], options['d2_segment_map'], options['network_segment_length'],
+                              options['road_classes'], cache_dir = options['cache_dir'])
+
+
+def main(configfile = None, keep_traffic_data = None, time = None, base_dir = None):
+    """
+    Download the traffic data, and returns the ModulatedEmissions of the hour at $time (naive UTC, the current time by default).
+
+    The bases are kept in $base_dir, by default the modulation directory of the cache (see read_modulation_config).
+    """
+    if configfile is None:
+        configfile = "config.ini"
+    if time is None:
+        time = capture.utcnow()
+    options = read_modulation_config(configfile)
+    if options is None:
+        raise ValueError("No road classes file in %s, see the modulation section in docs/config.md" % configfile)
+    if base_dir is None:
+        base_dir = options['base_dir']
+
+    fetched = fetch_emissions(configfile = configfile, keep_traffic_data = keep_traffic_data)
+
+    with metrics.stage('modulation.fit'):
+        class_weights = class_weights_from_options(options)
+        kind = day_type(time)
+        base = read_base(base_dir, kind)
+        reason = rebase_reason(base, fetched, time, options)
+        if reason is None:
+            factors = fit_factors(class_weights, fetched.column_emissions, base.column_emissions)
+
+    if reason is not None:
+        print("New %s base emissions: %s" % (kind, reason), file = sys.stderr)
+        with metrics.stage('modulation.rebase'):
+            base = write_base(base_dir, kind, time, fetched)
+        factors = [(1, 1, 1)] * class_weights.class_count
+
+    return ModulatedEmissions(base.emis_lin, factors, reason is not None, fetched.traffic_time, fetched.datex_time)
+
+
+if __name__ == "__main__":
+    # Print the modulation factors of the current traffic
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config")
+    args = parser.parse_args()
+
+    result = main(configfile = args.config)
+    print("Base %s%s" % (result.emis_lin, " (new)" if result.rebased else ""))
+    print("Class\tNOx\tPM10\tPM25")
+    for road_class, factors in enumerate(result.factors):
+        print("%d\t%s" % (road_class, "\t".join("%.4f" % x for x in factors)))
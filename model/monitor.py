@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+from collections import namedtuple
+
+import metrics
+
+"""
+Monitor a running SIRANE process.
+
+SIRANE needs a lot of memory, and a run which doesn't fit in RAM can take hours instead of minutes
+once it falls into swap. watch() samples the memory (RSS, virtual size, swap) and CPU time of the SIRANE
+process from /proc/<pid> at regular intervals, and reads SIRANE's log file to estimate its progress.
+- The samples are written to a memory profile (csv), used to size the memory limits of the machine or cgroup
+- The process is killed if it runs for longer than the timeout, or if its memory (RSS + swap) goes over the ceiling
+- The peak memory of the run is returned, to be recorded in the caller's metrics stage (see record_metrics)
+
+Only works on Linux. Elsewhere, watch() simply waits for the process.
+"""
+
+DEFAULT_INTERVAL = 5
+# Minimum number of seconds between two progress reports on stderr
+REPORT_INTERVAL = 60
+# Number of seconds to wait for SIRANE to exit after SIGTERM, before SIGKILL
+KILL_GRACE = 10
+
+PROFILE_FILENAME = "memory_profile.csv"
+PROFILE_HEADER = ["elapsed_s", "rss_kib", "vms_kib", "swap_kib", "cpu_s", "progress"]
+
+# SIRANE's log file starts a line for each time step, eg. `Pas de temps 12/24 : 05/03/2021 11:00:00`.
+# The last one in the log file is the current progress. The other lines have dates (eg. `Calcul du 05/03/2021 11:00`),
+# which mustn't be mistaken for a step.
+PROGRESS_REGEX = re.compile(rb'^[ \t]*Pas de temps[ \t]*(\d+)[ \t]*/[ \t]*(\d+)', re.MULTILINE)
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# A sample of the process's memory (in KiB) and CPU time (in seconds)
+Sample = namedtuple('Sample', ['elapsed', 'rss', 'vms', 'swap', 'cpu', 'progress'])
+
+# The outcome of watch(): the process's return code, its peak memory (a Sample), and whether it was killed
+Watched = namedtuple('Watched', ['returncode', 'peak', 'killed'])
+
+
+class MonitorLimitExceeded(Exception):
+    """Raised (and caught) in watch() when the process goes over its timeout or memory ceiling"""
+    pass
+
+
+def read_memory(pid):
+    """Returns the (RSS, virtual size, swap) of the process $pid in KiB, from /proc/<pid>/status"""
+    values = {}
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ('VmRSS', 'VmSize', 'VmSwap'):
+                values[key] = int(value.split()[0])
+    return values.get('VmRSS', 0), values.get('VmSize', 0), values.get('VmSwap', 0)
+
+
+def read_cpu(pid):
+    """Returns the user + system CPU time of the process $pid in seconds, from /proc/<pid>/stat"""
+    with open("/proc/%d/stat" % pid) as f:
+        stat = f.read()
+    # The process name (2nd field) may contain spaces, the other fields come after its closing parenthesis
+    fields = stat[stat.rindex(")") + 2:].split()
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / CLOCK_TICKS
+
+
+class LogProgress:
+    """
+    Reads the new lines of SIRANE's log file, and keeps the last progress found in them (a fraction, or None).
+    The log file of a previous run (modified before $since, a timestamp) is ignored.
+    """
+    def __init__(self, filename, since):
+        self.filename = filename
+        self.since = since
+        self.offset = 0
+        self.progress = None
+
+    def update(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_mtime < self.since:
+                    return self.progress
+                if st.st_size < self.offset:
+                    # The file was truncated
+                    self.offset = 0
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return self.progress
+        # Only handle complete lines
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        for m in PROGRESS_REGEX.finditer(data[:end]):
+            step, count = int(m.group(1)), int(m.group(2))
+            if 0 < step <= count:
+                self.progress = step / count
+        return self.progress
+
+
+def format_eta(elapsed, progress):
+    if not progress:
+        return "unknown"
+    remaining = elapsed * (1 - progress) / progress
+    return "%d min" % round(remaining / 60)
+
+
+def sample_process(pid, start, log_progress):
+    rss, vms, swap = read_memory(pid)
+    return Sample(time.monotonic() - start, rss, vms, swap, read_cpu(pid), log_progress.update())
+
+
+def wait_interval(proc, interval):
+    """Wait for $interval seconds, or until the process exits"""
+    try:
+        proc.wait(interval)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def stop_process(proc):
+    """Ask the process to terminate, and kill it if it doesn't"""
+    proc.terminate()
+    try:
+        proc.wait(KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def watch(proc, cwd, timeout = None, memory_ceiling = None, interval = None, profile = None):
+    """
+    Wait for the SIRANE process $proc (a subprocess.Popen) running in the directory $cwd, while monitoring it.
+
+    $timeout is the maximum run time in seconds, $memory_ceiling the maximum RSS + swap in MiB (None for no limit).
+    The process is sampled every $interval seconds, and the samples are written to the csv file $profile
+    (by default memory_profile.csv in $cwd).
+    Returns Watched, whose return code is negative if the process was killed.
+
+    NB the metrics stages are per thread (see metrics.py), so watch() doesn't record anything itself:
+    the caller records the Watched in its own stage with record_metrics().
+    """
+    if interval is None:
+        interval = DEFAULT_INTERVAL
+    if profile is None:
+        profile = os.path.join(cwd, PROFILE_FILENAME)
+
+    peak = Sample(0, 0, 0, 0, 0, None)
+    if not os.path.isdir("/proc/%d" % proc.pid):
+        # No procfs
+        return Watched(proc.wait(), peak, False)
+
+    start = time.monotonic()
+    log_progress = LogProgress(os.path.join(cwd, "Log.txt"), time.time())
+    last_report = start
+    killed = False
+
+    with open(profile, 'w') as f:
+        print(*PROFILE_HEADER, sep = ",", file = f)
+        try:
+            while proc.poll() is None:
+                # Even if the samples fail
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise MonitorLimitExceeded("ran for more than %ss" % timeout)
+
+                try:
+                    sample = sample_process(proc.pid, start, log_progress)
+                except (OSError, ValueError, IndexError):
+                    # The process exited between poll() and the sample, or /proc isn't what we expect
+                    wait_interval(proc, interval)
+                    continue
+
+                print("%.1f,%d,%d,%d,%.2f,%s" % (sample.elapsed, sample.rss, sample.vms, sample.swap, sample.cpu,
+                      "" if sample.progress is None else "%.4f" % sample.progress), file = f)
+                f.flush()
+                peak = Sample(sample.elapsed, max(peak.rss, sample.rss), max(peak.vms, sample.vms),
+                              max(peak.swap, sample.swap), sample.cpu, sample.progress)
+
+                if time.monotonic() - last_report >= REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    progress_s = "?" if sample.progress is None else "%d%%" % (sample.progress * 100)
+                    print("SIRANE in %s: %s (ETA %s), RSS %d MiB, swap %d MiB, CPU %.0f%%" % (
+                        cwd, progress_s, format_eta(sample.elapsed, sample.progress), sample.rss // 1024,
+                        sample.swap // 1024, 100 * sample.cpu / max(sample.elapsed, 1e-9)), file = sys.stderr)
+
+                if memory_ceiling is not None and (sample.rss + sample.swap) > memory_ceiling * 1024:
+                    raise MonitorLimitExceeded("used more than %s MiB of memory (RSS %d MiB, swap %d MiB)" % (
+                        memory_ceiling, sample.rss // 1024, sample.swap // 1024))
+
+                wait_interval(proc, interval)
+        except MonitorLimitExceeded as e:
+            print("Stopping SIRANE in %s: it %s" % (cwd, e), file = sys.stderr)
+            killed = True
+            stop_process(proc)
+
+    print("SIRANE in %s exited with code %d after %.0fs, peak RSS %d MiB, peak swap %d MiB" % (
+        cwd, proc.returncode, time.monotonic() - start, peak.rss // 1024, peak.swap // 1024), file = sys.stderr)
+    return Watched(proc.returncode, peak, killed)
+
+
+def record_metrics(watched):
+    """Record the peak memory of the Watched $watched, and whether it was killed, in the current metrics stage"""
+    metrics.peak('peak_rss_bytes', watched.peak.rss * 1024)
+    metrics.peak('peak_vms_bytes', watched.peak.vms * 1024)
+    metrics.peak('peak_swap_bytes', watched.peak.swap * 1024)
+    if watched.killed:
+        metrics.count('killed')
+
+
+if __name__ == "__main__":
+    # Print the peak memory of a memory profile written by watch()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("profile", nargs = "?", default = os.path.join("sirane", PROFILE_FILENAME))
+    args = parser.parse_args()
+
+    peak = {}
+    with open(args.profile) as f:
+        header = next(f).strip().split(",")
+        for line in f:
+            for key, value in zip(header, line.strip().split(",")):
+                if key.endswith("_kib"):
+                    peak[key] = max(peak.get(key, 0), int(value))
+    for key in PROFILE_HEADER:
+        if key in peak:
+            print("peak %s: %d MiB" % (key[:-len("_kib")], peak[key] // 1024))
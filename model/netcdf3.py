@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import sys
+import struct
+import argparse
+
+"""
+Minimal reader for netcdf files in the classic and 64-bit offset formats (netcdf 3),
+which is the format of the netcdf files downloaded from Copernicus.
+
+It only reads the header, and then the values that are asked for, so it is fast on large files.
+cf. <https://docs.unidata.ucar.edu/netcdf-c/current/file_format_specifications.html>
+
+Usage:
+    with Dataset(filename) as nc:
+        time = nc.variables['time']
+        hours = time.read()
+        value = nc.variables['no2_conc'].read_at((0, 0, 12, 34))
+"""
+
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+
+# nc_type -> (struct format, size in bytes)
+NC_TYPES = {
+    1: ('b', 1), # NC_BYTE
+    2: ('c', 1), # NC_CHAR
+    3: ('h', 2), # NC_SHORT
+    4: ('i', 4), # NC_INT
+    5: ('f', 4), # NC_FLOAT
+    6: ('d', 8), # NC_DOUBLE
+}
+
+HDF5_MAGIC = b"\x89HDF"
+
+
+class NetcdfFormatError(Exception):
+    """Raised when the file isn't a netcdf 3 file, or is malformed"""
+    pass
+
+
+def padding(size):
+    """Number of padding bytes to align $size to 4 bytes"""
+    return (4 - size % 4) % 4
+
+
+class Variable:
+    """
+    A netcdf variable.
+
+    - name is the variable's name
+    - dimensions is the list of the dimension names
+    - shape is the list of the dimension lengths (the record dimension has the number of records)
+    - attributes is a dictionary of attribute names mapping to their values
+    """
+    def __init__(self, dataset, name, dimensions, shape, attributes, nc_type, begin, is_record):
+        self.dataset = dataset
+        self.name = name
+        self.dimensions = dimensions
+        self.shape = shape
+        self.attributes = attributes
+        self.nc_type = nc_type
+        self.begin = begin
+        self.is_record = is_record
+
+        self.format, self.itemsize = NC_TYPES[nc_type]
+
+        # Number of elements in a record (or in the whole variable if it isn't a record variable)
+        self.record_length = 1
+        for length in (shape[1:] if is_record else shape):
+            self.record_length *= length
+
+    def __len__(self):
+        length = 1
+        for x in self.shape:
+            length *= x
+        return length
+
+    def offset(self, index):
+        """Returns the file offset of the element at $index (a tuple of ints, one for each dimension)"""
+        if len(index) != len(self.shape):
+            raise IndexError("%s has %d dimensions" % (self.name, len(self.shape)))
+
+        flat = 0
+        dims = self.shape[1:] if self.is_record else self.shape
+        record_index = index[1:] if self.is_record else index
+        for i, length in zip(record_index, dims):
+            if not 0 <= i < length:
+                raise IndexError("Index %s out of range for %s" % (index, self.name))
+            flat = flat * length + i
+
+        offset = self.begin + flat * self.itemsize
+        if self.is_record:
+            if not 0 <= index[0] < self.shape[0]:
+                raise IndexError("Index %s out of range for %s" % (index, self.name))
+            offset += index[0] * self.dataset.record_size
+        return offset
+
+    def unpack(self, values):
+        """Apply the scale_factor and add_offset attributes (if any) to the list of $values"""
+        scale = self.attributes.get('scale_factor', [1])[0]
+        add = self.attributes.get('add_offset', [0])[0]
+        if scale == 1 and add == 0:
+            return values
+        return [ x * scale + add for x in values ]
+
+    def read_at(self, index, unpack = False):
+        """Returns the element at $index (a tuple of ints, one for each dimension)"""
+        f = self.dataset.file
+        f.seek(self.offset(index))
+        value = struct.unpack(">" + self.format, f.read(self.itemsize))[0]
+        return self.unpack([value])[0] if unpack else value
+
+    def read(self, unpack = False):
+        """Returns all the elements of the variable as a flat list, in row-major order"""
+        f = self.dataset.file
+        fmt = ">%d%s" % (self.record_length, self.format)
+        size = self.record_length * self.itemsize
+
+        if self.is_record:
+            values = []
+            for record in range(self.shape[0]):
+                f.seek(self.begin + record * self.dataset.record_size)
+                values.extend(struct.unpack(fmt, f.read(size)))
+        else:
+            f.seek(self.begin)
+            values = list(struct.unpack(fmt, f.read(size)))
+
+        if self.nc_type == 2:
+            values = [ b"".join(values).decode(errors = 'replace') ]
+        return self.unpack(values) if unpack else values
+
+    def read_series(self, index, unpack = False):
+        """
+        Returns the list of the elements along the first dimension at the fixed $index of the other dimensions,
+        eg. the time series of a (time, level, latitude, longitude) variable at a single point
+        """
+        return [ self.read_at((i, *index), unpack) for i in range(self.shape[0]) ]
+
+
+class Dataset:
+    """
+    A netcdf 3 file, opened for reading.
+
+    - dimensions is a dictionary of dimension names mapping to their lengths
+    - attributes is a dictionary of the global attributes
+    - variables is a dictionary of variable names mapping to Variable objects
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.read_header()
+        except:
+            self.file.close()
+            raise
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # === Header parsing ===
+
+    def read_header(self):
+        f = self.file
+        magic = f.read(4)
+        if magic[:3] != b"CDF" or magic[3] not in (1, 2):
+            if magic == HDF5_MAGIC:
+                raise NetcdfFormatError("netcdf 4 (HDF5) files are not supported")
+            raise NetcdfFormatError("Not a netcdf 3 file")
+        self.offset_size = 8 if magic[3] == 2 else 4
+
+        self.numrecs = self.read_int()
+
+        # Dimensions
+        self.dimension_list = [] # (name, length)
+        for _ in self.read_list_header(NC_DIMENSION):
+            name = self.read_name()
+            length = self.read_int()
+            self.dimension_list.append((name, length))
+        self.dimensions = dict(self.dimension_list)
+
+        self.attributes = self.read_attributes()
+
+        # Variables
+        self.variables = {}
+        record_vars = []
+        for _ in self.read_list_header(NC_VARIABLE):
+            name = self.read_name()
+            dimids = [ self.read_int() for _ in range(self.read_int()) ]
+            attributes = self.read_attributes()
+            nc_type = self.read_int()
+            vsize = self.read_int()
+            begin = self.read_offset()
+
+            if nc_type not in NC_TYPES:
+                raise NetcdfFormatError("Unknown type %d for variable %s" % (nc_type, name))
+
+            dimensions = [ self.dimension_list[i][0] for i in dimids ]
+            shape = [ self.dimension_list[i][1] for i in dimids ]
+            is_record = bool(shape) and shape[0] == 0
+            if is_record:
+                shape[0] = self.numrecs
+                record_vars.append(vsize)
+
+            self.variables[name] = Variable(self, name, dimensions, shape, attributes, nc_type, begin, is_record)
+
+        # The records of all the record variables are interleaved. The padding is omitted when
+        # there is a single record variable.
+        if len(record_vars) == 1:
+            var = next(v for v in self.variables.values() if v.is_record)
+            self.record_size = var.record_length * var.itemsize
+        else:
+            self.record_size = sum(record_vars)
+
+    def read_int(self):
+        return struct.unpack(">i", self.file.read(4))[0]
+
+    def read_offset(self):
+        if self.offset_size == 8:
+            return struct.unpack(">q", self.file.read(8))[0]
+        return struct.unpack(">i", self.file.read(4))[0]
+
+    def read_name(self):
+        length = self.read_int()
+        name = self.file.read(length + padding(length))[:length]
+        return name.decode()
+
+    def read_list_header(self, tag):
+        """Read the header of a list, and returns a range over its elements"""
+        list_tag = self.read_int()
+        count = self.read_int()
+        if list_tag == 0 and count == 0:
+            return range(0) # ABSENT
+        if list_tag != tag:
+            raise NetcdfFormatError("Expected tag %d, got %d" % (tag, list_tag))
+        return range(count)
+
+    def read_attributes(self):
+        attributes = {}
+        for _ in self.read_list_header(NC_ATTRIBUTE):
+            name = self.read_name()
+            nc_type = self.read_int()
+            count = self.read_int()
+            if nc_type not in NC_TYPES:
+                raise NetcdfFormatError("Unknown type %d for attribute %s" % (nc_type, name))
+            fmt, itemsize = NC_TYPES[nc_type]
+            size = count * itemsize
+            raw = self.file.read(size + padding(size))[:size]
+            if nc_type == 2:
+                attributes[name] = raw.decode(errors = 'replace').rstrip("\0")
+            else:
+                attributes[name] = list(struct.unpack(">%d%s" % (count, fmt), raw))
+        return attributes
+
+
+if __name__ == "__main__":
+    # Print the header of a netcdf file, similar to `ncdump -h`
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file")
+    args = parser.parse_args()
+
+    with Dataset(args.file) as nc:
+        print("dimensions:")
+        for name, length in nc.dimension_list:
+            print("\t%s = %s ;" % (name, length if length else "UNLIMITED // (%d currently)" % nc.numrecs))
+        print("variables:")
+        for var in nc.variables.values():
+            print("\t%s(%s) type %d ;" % (var.name, ", ".join(var.dimensions), var.nc_type))
+            for k, v in var.attributes.items():
+                print("\t\t%s:%s = %s ;" % (var.name, k, v))
+        print("global attributes:")
+        for k, v in nc.attributes.items():
+            print("\t:%s = %s ;" % (k, v))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+import hashlib
+import argparse
+import configparser
+
+from workdir import SIRANE_EXECUTABLE, PRIVATE_DIRS, PRIVATE_FILES
+from mapcache import DEFAULT_CACHE_DIR
+import metrics
+
+"""
+Cache of SIRANE's outputs, keyed by a hash of its inputs.
+
+When a run is made again with the same input files as a previous run, SIRANE would produce the same outputs again.
+The digest of a run is the sha256 of every file in its INPUT directory and of the SIRANE executable. After
+a successful run, the files it created or modified are hardlinked into the cache directory `runs/<digest>/`.
+When a later run has the same digest, the cached outputs are hardlinked into its directory instead of running SIRANE.
+
+Only reruns of the same hours can hit the cache: Donnees.dat, the meteo and background concentration files
+contain the simulation dates, and so do SIRANE's outputs, so the runs of two different hours never share
+their outputs, even when the traffic didn't change. The cache is meant for the runs which are made again
+for the same hours, eg. a replay (see capture.py), a backfill or a daemon run retried after a failure.
+
+The size of the cache is bounded: the least recently used entries are deleted first.
+"""
+
+DIGESTS_FILENAME = "input_digests.json"
+CHUNK_SIZE = 1024 * 1024
+MIB = 1024 * 1024
+
+
+def run_cache_dir(cache_dir = None):
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    return os.path.join(cache_dir, "runs")
+
+
+def file_digest(filename):
+    """Returns the sha256 of the content of $filename, as a hex string"""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_digests(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_digests(filename, digests):
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp_filename, filename)
+
+
+def input_files(run_dir):
+    """Returns the sorted list of the input files of the run in $run_dir, relative to $run_dir"""
+    files = [SIRANE_EXECUTABLE]
+    input_dir = os.path.join(run_dir, "INPUT")
+    for dirpath, dirnames, filenames in os.walk(input_dir, followlinks = True):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(dirpath, filename), run_dir))
+    files.sort()
+    return files
+
+
+def update_digests(filename, digests):
+    """
+    Merge the $digests of the files of a run into the digests file $filename, and forget the files which
+    no longer exist. The file is locked while it is updated, so that concurrent runs don't lose their digests.
+    """
+    with open(filename + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = dict( (path, x) for path, x in read_digests(filename).items() if os.path.exists(path) )
+        merged.update(digests)
+        write_digests(filename, merged)
+
+
+def input_digest(run_dir, cache_dir = None):
+    """
+    Returns the digest of the inputs of the run in $run_dir (see input_files).
+
+    The digests of the files are remembered along with their size and modification time (see update_digests),
+    so that the large static inputs (network, executable) are only hashed again when they change.
+    """
+    directory = run_cache_dir(cache_dir)
+    os.makedirs(directory, exist_ok = True)
+    digests_filename = os.path.join(directory, DIGESTS_FILENAME)
+    digests = read_digests(digests_filename)
+    known = {}
+
+    h = hashlib.sha256()
+    for relpath in input_files(run_dir):
+        path = os.path.realpath(os.path.join(run_dir, relpath))
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+        cached = digests.get(path)
+        if cached is not None and cached[:2] == key:
+            digest = cached[2]
+        else:
+            digest = file_digest(path)
+        known[path] = key + [digest]
+        h.update(("%s\t%s\n" % (relpath, digest)).encode())
+
+    update_digests(digests_filename, known)
+    return h.hexdigest()
+
+
+def output_snapshot(run_dir):
+    """
+    Returns a dictionary of the files which may be outputs of the run in $run_dir (every file except the
+    inputs and model.py's own files), relative to $run_dir, mapping to their (size, modification time)
+    """
+    snapshot = {}
+    for dirpath, dirnames, filenames in os.walk(run_dir):
+        if dirpath == run_dir:
+            dirnames[:] = [ x for x in dirnames if x != "INPUT" and x not in PRIVATE_DIRS ]
+            filenames = [ x for x in filenames if x != SIRANE_EXECUTABLE and x not in PRIVATE_FILES ]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            st = os.lstat(path)
+            snapshot[os.path.relpath(path, run_dir)] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+def changed_outputs(before, after):
+    """Returns the list of files of the snapshot $after which are new or modified since the snapshot $before"""
+    return sorted(x for x, key in after.items() if before.get(x) != key)
+
+
+def detach_outputs(run_dir):
+    """
+    Replace the hardlinked output files in $run_dir with private copies.
+
+    SIRANE may write to its output files in place, which would also modify the cached copy of a file
+    restored from (or stored into) the cache. This must be called before running SIRANE.
+    """
+    for relpath in output_snapshot(run_dir):
+        path = os.path.join(run_dir, relpath)
+        if os.lstat(path).st_nlink > 1:
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, path)
+
+
+def link_file(source, destination):
+    """Hardlink $source to $destination (replacing it), or copy it if it's on another file system"""
+    # NB renaming a file over another link to the same file does nothing, and would leave the temporary file
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    tmp_destination = "%s.%d.tmp" % (destination, os.getpid())
+    try:
+        os.link(source, tmp_destination)
+    except OSError:
+        shutil.copy2(source, tmp_destination)
+    os.replace(tmp_destination, destination)
+
+
+def restore_outputs(digest, run_dir, cache_dir = None):
+    """
+    Hardlink the cached outputs of the run with $digest into $run_dir.
+    Returns the list of restored files, or None if the run isn't in the cache.
+    """
+    entry = os.path.join(run_cache_dir(cache_dir), digest)
+    if not os.path.isdir(entry):
+        return None
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(entry):
+        for filename in filenames:
+            relpath = os.path.relpath(os.path.join(dirpath, filename), entry)
+            destination = os.path.join(run_dir, relpath)
+            os.makedirs(os.path.dirname(destination), exist_ok = True)
+            link_file(os.path.join(dirpath, filename), destination)
+            files.append(relpath)
+
+    # The modification time of the entry is its last use, for the LRU eviction
+    os.utime(entry)
+    return files
+
+
+def store_outputs(digest, run_dir, files, cache_dir = None, max_size = None):
+    """
+    Hardlink the output $files (relative to $run_dir) of the run with $digest into the cache,
+    then evict the least recently used entries so that the cache is no larger than $max_size MiB.
+    """
+    directory = run_cache_dir(cache_dir)
+    entry = os.path.join(directory, digest)
+    tmp_entry = "%s.%d.tmp" % (entry, os.getpid())
+    shutil.rmtree(tmp_entry, ignore_errors = True)
+
+    for relpath in files:
+        destination = os.path.join(tmp_entry, relpath)
+        os.makedirs(os.path.dirname(destination), exist_ok = True)
+        link_file(os.path.join(run_dir, relpath), destination)
+    os.makedirs(tmp_entry, exist_ok = True)
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Another run with the same inputs stored its outputs first
+        shutil.rmtree(tmp_entry, ignore_errors = True)
+
+    if max_size is not None:
+        evict(cache_dir, max_size)
+
+
+def entry_size(entry):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(entry):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def evict(cache_dir = None, max_size = 0):
+    """Delete the least recently used entries of the cache until it is no larger than $max_size MiB"""
+    directory = run_cache_dir(cache_dir)
+    entries = []
+    for x in os.scandir(directory):
+        if x.is_dir() and not x.name.endswith(".tmp"):
+            entries.append((x.stat().st_mtime_ns, x.path, entry_size(x.path)))
+
+    # Most recently used first
+    entries.sort(reverse = True)
+    total = 0
+    for mtime, path, size in entries:
+        total += size
+        if total > max_size * MIB:
+            print("Evicting %s from the run cache" % path, file = sys.stderr)
+            shutil.rmtree(path, ignore_errors = True)
+
+
+def run_cached(run_dir, launch, cache_dir = None, max_size = None):
+    """
+    Run the model in $run_dir with &launch() (which returns SIRANE's return code), unless its outputs are in the cache.
+    The outputs of a successful run are stored into the cache, which is limited to $max_size MiB.
+    Returns SIRANE's return code (0 when the outputs were restored from the cache).
+    """
+    digest = input_digest(run_dir, cache_dir)
+    files = restore_outputs(digest, run_dir, cache_dir)
+    metrics.count('cache_hit', 1 if files is not None else 0)
+    if files is not None:
+        print("Reused the outputs of a previous run with the same inputs (%s)" % digest)
+        return 0
+
+    detach_outputs(run_dir)
+    before = output_snapshot(run_dir)
+    returncode = launch()
+    if returncode == 0:
+        store_outputs(digest, run_dir, changed_outputs(before, output_snapshot(run_dir)), cache_dir, max_size)
+    return returncode
+
+
+if __name__ == "__main__":
+    # Print the digest of the inputs of a run directory, and whether its outputs are in the cache
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_dir", nargs = "?", default = "sirane")
+    parser.add_argument("--config")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config if args.config is not None else "config.ini")
+    cache_dir = config.get('GENERAL', 'cache_dir', fallback = DEFAULT_CACHE_DIR)
+
+    digest = input_digest(args.run_dir, cache_dir)
+    cached = os.path.isdir(os.path.join(run_cache_dir(cache_dir), digest))
+    print("%s %s" % (digest, "cached" if cached else "not cached"))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import subprocess
+import argparse
+import configparser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from workdir import SIRANE_EXECUTABLE
+import monitor
+
+"""
+Run several SIRANE instances at once, each in its own work directory (see workdir.py).
+
+SIRANE is single threaded and uses a lot of memory, so the number of concurrent instances is limited
+by the number of CPUs and by the available memory. Each instance can be given a memory budget
+(its address space is limited with setrlimit), so that a run which needs more memory than expected
+fails on its own instead of making the whole machine swap.
+
+Each instance is watched by monitor.py, which can also stop it after a timeout or above a memory ceiling.
+"""
+
+MIB = 1024 * 1024
+STDOUT_FILENAME = "stdout.txt"
+
+# Settings of the SIRANE instances, from the [model] section of the configuration file (see read_pool_config)
+# - workers is the maximum number of instances at once
+# - memory_limit is the address space limit of each instance, in MiB
+# - timeout is the maximum run time of each instance, in seconds
+# - memory_ceiling is the maximum RSS + swap of each instance, in MiB
+# - monitor_interval is the number of seconds between two samples of each instance
+PoolSettings = namedtuple('PoolSettings', ['workers', 'memory_limit', 'timeout', 'memory_ceiling', 'monitor_interval'])
+DEFAULT_POOL_SETTINGS = PoolSettings(None, None, None, None, monitor.DEFAULT_INTERVAL)
+
+
+def limit_memory(memory_limit):
+    """
+    Returns a function which limits the address space of the calling process to $memory_limit MiB,
+    to be used as the preexec_fn of a subprocess (or None if there is no limit).
+    """
+    if memory_limit is None:
+        return None
+
+    import resource
+    limit = int(memory_limit * MIB)
+
+    def preexec():
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    return preexec
+
+
+def run_sirane(cwd = "sirane", settings = None, stdout = None):
+    """
+    Run SIRANE in the directory $cwd using the "default" input files configuration layout,
+    and wait for it while monitoring it (see monitor.py).
+
+    $settings is the PoolSettings of the instance (memory limit, timeout, …).
+    $stdout is the filename to which SIRANE's output is written (None to inherit our stdout).
+    Returns the monitor.Watched of the run (SIRANE's return code, negative if it was killed, and its peak memory).
+    """
+    if settings is None:
+        settings = DEFAULT_POOL_SETTINGS
+
+    # Flush stdout and stderr before launching the model so that it displays
+    # buffered output before the subprocess's output
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    cmd = ["./" + SIRANE_EXECUTABLE, "INPUT/Donnees.dat", "Log.txt"]
+    f = None if stdout is None else open(stdout, 'w')
+    try:
+        proc = subprocess.Popen(cmd, cwd = cwd, preexec_fn = limit_memory(settings.memory_limit),
+                                stdout = f, stderr = None if f is None else subprocess.STDOUT)
+        return monitor.watch(proc, cwd, timeout = settings.timeout, memory_ceiling = settings.memory_ceiling,
+                             interval = settings.monitor_interval)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def available_memory():
+    """Returns the memory available for new processes in MiB (MemAvailable in /proc/meminfo), or None if unknown"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def default_workers(memory_limit = None, memory_ceiling = None):
+    """
+    Returns the number of SIRANE instances which can run at once: one per CPU, and no more than
+    fit in the available memory when each of them uses up to $memory_limit (or else $memory_ceiling) MiB.
+
+    Without a memory budget, a single instance: SIRANE can use several GiB, so one instance per CPU
+    could make the machine run out of memory.
+    """
+    budget = memory_limit if memory_limit is not None else memory_ceiling
+    if budget is None:
+        return 1
+    workers = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, int(memory // budget))
+    return max(1, workers)
+
+
+def run_pool(workdirs, settings = None):
+    """
+    Run SIRANE in each of the $workdirs, with the PoolSettings $settings: at most settings.workers instances
+    at once (see default_workers() when None), each limited to settings.memory_limit MiB.
+
+    The output of each instance is written to `stdout.txt` in its work directory, and the peak memory of the instances
+    is recorded in the current metrics stage.
+    Returns the list of SIRANE's return codes, in the order of $workdirs.
+    """
+    if settings is None:
+        settings = DEFAULT_POOL_SETTINGS
+    workers = settings.workers
+    if workers is None:
+        workers = default_workers(settings.memory_limit, settings.memory_ceiling)
+
+    def run(workdir):
+        print("Launching model in %s" % workdir, file = sys.stderr)
+        return run_sirane(workdir, settings, stdout = os.path.join(workdir, STDOUT_FILENAME))
+
+    # SIRANE runs in its own process, the threads only wait for it
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        runs = list(executor.map(run, workdirs))
+
+    # The metrics stage is the one of this thread, not of the pool's threads
+    for watched in runs:
+        monitor.record_metrics(watched)
+    return [ watched.returncode for watched in runs ]
+
+
+def read_pool_config(configfile):
+    """Returns the PoolSettings from the [model] section of the configuration file"""
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    return PoolSettings(
+        workers = config.getint('model', 'sirane_workers', fallback = None),
+        memory_limit = config.getfloat('model', 'sirane_memory_limit', fallback = None),
+        timeout = config.getfloat('model', 'sirane_timeout', fallback = None),
+        memory_ceiling = config.getfloat('model', 'sirane_memory_ceiling', fallback = None),
+        monitor_interval = config.getfloat('model', 'monitor_interval', fallback = monitor.DEFAULT_INTERVAL),
+    )
+
+
+if __name__ == "__main__":
+    # Run SIRANE in work directories prepared beforehand (eg. with `model.py --isolated --skip-launch`)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("workdirs", nargs = "+")
+    parser.add_argument("--config")
+    parser.add_argument("--workers", type = int, help = "Maximum number of SIRANE instances at once")
+    parser.add_argument("--memory-limit", type = float, help = "Memory limit of each SIRANE instance, in MiB")
+    args = parser.parse_args()
+
+    settings = read_pool_config(args.config if args.config is not None else "config.ini")
+    if args.workers is not None:
+        settings = settings._replace(workers = args.workers)
+    if args.memory_limit is not None:
+        settings = settings._replace(memory_limit = args.memory_limit)
+
+    returncodes = run_pool(args.workdirs, settings)
+    sys.exit(0 if all(x == 0 for x in returncodes) else 1)
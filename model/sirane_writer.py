@@ -0,0 +1,62 @@
+import itertools
+
+import metrics
+
+"""
+Writers for SIRANE's tab separated input files.
+
+The output is the same as `print(*values, sep = "\t", file = file)` for the header and for each row,
+but the whole file is formatted in memory and written with a single call to file.write().
+"""
+
+
+def format_columns(header, columns):
+    """
+    Format a table given as a list of columns, and return it as a string.
+
+    $header is the list of column names.
+    $columns is a list of iterables of the same length, one for each column. The values are converted with str(),
+    so it is faster to pass iterables that already contain strings (eg. `itertools.repeat("0", n)`).
+    """
+    columns = [ map(str, column) for column in columns ]
+    lines = [ "\t".join(header) ]
+    lines.extend(map("\t".join, zip(*columns)))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def format_rows(header, rows):
+    """
+    Format a table given as a list of rows, and return it as a string.
+    This is more convenient than format_columns for small tables.
+    """
+    lines = [ "\t".join(header) ]
+    lines.extend("\t".join(map(str, row)) for row in rows)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def write_table(file, table):
+    """Write the formatted $table to file, and count it in the current stage (see metrics.py)"""
+    file.write(table)
+    # NB SIRANE's input files are ASCII, so the number of characters is the number of bytes
+    metrics.count('bytes_written', len(table))
+    metrics.count('rows_written', table.count("\n") - 1)
+
+
+def write_columns(file, header, columns):
+    """Write the table given as a list of columns to file, see format_columns"""
+    write_table(file, format_columns(header, columns))
+
+
+def write_rows(file, header, rows):
+    """Write the table given as a list of rows to file, see format_rows"""
+    write_table(file, format_rows(header, rows))
+
+
+def constant_column(value, count):
+    """
+    Returns a column of $count times the string representation of $value.
+    NB the column is an iterator, so it can't be used twice in the same table
+    """
+    return itertools.repeat(str(value), count)
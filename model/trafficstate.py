@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import argparse
+from datetime import datetime, timezone
+
+from mapcache import source_key, DEFAULT_CACHE_DIR
+
+"""
+Last known traffic of each traffic id, to fill the gaps of the feeds (see `traffic_ttl` in `docs/config.md`).
+
+When a sensor has no speed or rate in a feed (see emission.SkipEmissionComputation), or is missing from it,
+its last valid speed and rate are used instead, if they are less than `traffic_ttl` minutes old.
+Otherwise the segments of the sensor would have no emissions for that hour.
+
+The store is a single file, memory-mapped, indexed by AggregationMatrix column (ie. traffic id, see emission.py),
+so a lookup is an array access without reading anything else:
+
+    HEADER_FORMAT   magic, number of columns, sha256 of the segment map files key (see mapcache.source_key)
+    speeds          1 double per column, in km/h
+    rates           1 double per column, in vehicles/h
+    times           1 double per column, the time of the data (seconds since the epoch), 0 if there is none
+
+The store is created again (empty) when the segment map files or the network lengths file change,
+as the columns aren't the same anymore.
+"""
+
+DEFAULT_STORE_FILENAME = "traffic_state.bin"
+
+MAGIC = b"CAPTRAF1"
+HEADER_FORMAT = "<8sq32s"
+HEADER_SIZE = 64
+
+
+def sources_digest(sources):
+    """Returns the digest of the key of the $sources files, which identifies the columns of the store"""
+    return hashlib.sha256(json.dumps(source_key(sources)).encode()).digest()
+
+
+class TrafficState:
+    """
+    The store of the last valid speed and rate of each column, see the module's documentation.
+    Use it as a context manager, or call close().
+    """
+
+    def __init__(self, filename, column_count, sources):
+        self.filename = filename
+        self.column_count = column_count
+        digest = sources_digest(sources)
+        size = HEADER_SIZE + 3 * 8 * column_count
+
+        if not self.is_valid(digest, size):
+            self.create(digest, size)
+
+        self.file = open(filename, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        values = memoryview(self.mm)[HEADER_SIZE:]
+        self.values = values.cast('d')
+        values.release()
+        self.speeds = self.values[:column_count]
+        self.rates = self.values[column_count:2 * column_count]
+        self.times = self.values[2 * column_count:]
+
+    def is_valid(self, digest, size):
+        try:
+            with open(self.filename, 'rb') as f:
+                header = f.read(HEADER_SIZE)
+                f.seek(0, os.SEEK_END)
+                if f.tell() != size or len(header) != HEADER_SIZE:
+                    return False
+        except OSError:
+            return False
+        magic, column_count, file_digest = struct.unpack_from(HEADER_FORMAT, header)
+        return magic == MAGIC and column_count == self.column_count and file_digest == digest
+
+    def create(self, digest, size):
+        print("Creating the traffic state store %s" % self.filename, file = sys.stderr)
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok = True)
+        tmp_filename = "%s.%d.tmp" % (self.filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, self.column_count, digest).ljust(HEADER_SIZE, b"\0"))
+            f.truncate(size)
+        os.replace(tmp_filename, self.filename)
+
+    def remember(self, column, speed, rate, time):
+        """Store the valid $speed and $rate of $column at $time (seconds since the epoch)"""
+        self.speeds[column] = speed
+        self.rates[column] = rate
+        self.times[column] = time
+
+    def lookup(self, column, time, ttl):
+        """Returns the last (speed, rate) of $column if it's at most $ttl seconds older than $time, else None"""
+        last = self.times[column]
+        if last <= 0 or abs(time - last) > ttl:
+            return None
+        return self.speeds[column], self.rates[column]
+
+    def close(self):
+        for view in (self.speeds, self.rates, self.times, self.values):
+            view.release()
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def store_filename(cache_dir = None):
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    return os.path.join(cache_dir, DEFAULT_STORE_FILENAME)
+
+
+if __name__ == "__main__":
+    # Print the age of the last known traffic of the columns of the store
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache-dir", default = DEFAULT_CACHE_DIR)
+    args = parser.parse_args()
+
+    filename = store_filename(args.cache_dir)
+    with open(filename, 'rb') as f:
+        magic, column_count, _digest = struct.unpack_from(HEADER_FORMAT, f.read(HEADER_SIZE))
+        f.seek(HEADER_SIZE + 2 * 8 * column_count)
+        times = struct.unpack("=%dd" % column_count, f.read(8 * column_count))
+
+    now = datetime.now(timezone.utc).timestamp()
+    known = [ now - t for t in times if t > 0 ]
+    print("%d columns, %d with a known traffic" % (column_count, len(known)))
+    if known:
+        print("Age of the last known traffic: %.0f to %.0f minutes" % (min(known) / 60, max(known) / 60))
@@ -2,9 +2,100 @@
 
 import argparse
 import csv
+import sys
+from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 
-import requests
+import metrics
+from fetch import get as http_get
+
+
+DOWNLOAD_URL = "https://data.nantesmetropole.fr/explore/dataset/244400404_fluidite-axes-routiers-nantes-metropole/download/"
+
+# Names of the fields we need for the emissions, used to only download those columns,
+# and their labels, used to find them in the csv header
+FIELDS = ["cha_id", "mf1_hd", "mf1_debit", "mf1_vit"]
+LABELS = ["Identifiant", "Horodatage", "Débit", "Vitesse"]
+
+
+"""
+TrafficRecord is a row of the traffic data with only the columns needed for the emissions.
+- id is the traffic segment id (string)
+- time is the data's time (string, eg. `2021-03-05T12:44:00+01:00`)
+- rate is the vehicle rate in 1/h (int)
+- speed is the speed in km/h (int)
+Missing rates and speeds are -1, as in the full csv file.
+"""
+TrafficRecord = namedtuple('TrafficRecord', ['id', 'time', 'rate', 'speed'])
+
+
+def parse_time(timestamp):
+    """Parse the data's time from the Horodatage column into a datetime"""
+    # Manually split the timezone offset because I'm not sure it's handled properly
+    dt, offset = timestamp.split("+")
+
+    tz_val = datetime.strptime(offset, "%H:%M")
+    delta = timedelta(hours = tz_val.hour, minutes = tz_val.minute)
+    tz = timezone(delta)
+
+    return datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S").replace(tzinfo = tz)
+
+
+def parse_int(value):
+    """Parse a rate or a speed, missing values are -1"""
+    if value == "":
+        return -1
+    return int(value)
+
+
+def iter_records(lines):
+    """
+    Parse the lines of the csv file (without line endings, with header) and yield TrafficRecords.
+    The columns are found with their labels in the header, so that their order and any other column doesn't matter.
+    """
+    reader = csv.reader(lines, delimiter = ";")
+    headers = next(reader)
+    headers[0] = headers[0].lstrip("\ufeff") # Byte order mark
+    i_id, i_time, i_rate, i_speed = [ headers.index(x) for x in LABELS ]
+
+    for row in reader:
+        if not row:
+            continue
+        yield TrafficRecord(row[i_id], row[i_time], parse_int(row[i_rate]), parse_int(row[i_speed]))
+
+
+def fetch():
+    """
+    Download Nantes Metropole traffic data, only with the columns needed for the emissions,
+    and parse it as it is downloaded.
+
+    Returns a tuple of (list of TrafficRecord, data's creation time)
+    """
+    params = {
+        'format': "csv",
+        'timezone': "Europe/Berlin",
+        'lang': "fr",
+        'use_labels_for_header': "true",
+        'csv_separator': ";",
+        'fields': ",".join(FIELDS),
+    }
+
+    r = http_get(DOWNLOAD_URL, params = params, stream = True, source = 'nm')
+    if r.status_code == 400:
+        # The field names are not right anymore, download every column instead
+        print("Could not select the traffic data fields, downloading the full file", file = sys.stderr)
+        r.close()
+        del params['fields']
+        r = http_get(DOWNLOAD_URL, params = params, stream = True, source = 'nm')
+
+    with r:
+        r.raise_for_status()
+        r.encoding = "utf-8"
+        records = list(iter_records(r.iter_lines(decode_unicode = True)))
+        metrics.count('bytes_downloaded', metrics.response_size(r))
+        metrics.count('rows', len(records))
+
+    return records, parse_time(records[0].time)
 
 
 def main(outputfile = None):
@@ -14,37 +105,27 @@ def main(outputfile = None):
     Returns the data's creation time
     """
 
+    # Create file URL
+    fileformat = "csv"
     if outputfile is None:
         outputfile = "trafic.%s" % fileformat
 
-    # Create file URL
-    fileformat = "csv"
-    api_url = "https://data.nantesmetropole.fr/explore/dataset/244400404_fluidite-axes-routiers-nantes-metropole/download/?format=%s&timezone=Europe/Berlin&lang=fr&use_labels_for_header=true&csv_separator=%%3B" % fileformat
+    api_url = DOWNLOAD_URL + "?format=%s&timezone=Europe/Berlin&lang=fr&use_labels_for_header=true&csv_separator=%%3B" % fileformat
     
     # Download it
-    r = requests.get(api_url)
+    r = http_get(api_url, source = 'nm')
     r.raise_for_status()
 
     # Write it to the file
     with open(outputfile, 'wb') as f:
         f.write(r.content)
 
-    # Reopen the file to read the data's time
-    with open(outputfile) as f:
-        reader = csv.reader(f, delimiter = ";")
-        lines = iter(reader)
-        next(lines) # skip first line (headers)
-        row = next(lines)
-
-    # Manually split the timezone offset because I'm not sure it's handled properly
-    dt, offset = row[3].split("+")
-
-    tz_val = datetime.strptime(offset, "%H:%M")
-    delta = timedelta(hours = tz_val.hour, minutes = tz_val.minute)
-    tz = timezone(delta)
+    # Reopen the file to read the data's time. Its columns are found like in fetch(), as a replayed
+    # payload may only have the columns of fetch()
+    with open(outputfile, encoding = "utf-8", newline = "") as f:
+        record = next(iter_records(f))
 
-    timestamp = datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S").replace(tzinfo = tz)
-    return timestamp
+    return parse_time(record.time)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+import argparse
+
+"""
+Isolated work directories for SIRANE runs.
+
+By default, model.py writes its inputs into the shared `sirane/INPUT` tree and runs SIRANE in `sirane/`,
+so two runs at the same time overwrite each other's inputs. A work directory is a private copy of
+`sirane/` in which SIRANE can run on its own:
+- the static inputs (network, Donnees.dat template, …) and the SIRANE executable are symbolic links
+  to the files in `sirane/`, so creating a work directory is cheap
+- the dynamic inputs (DYNAMIC_INPUTS) are written by each run into its own work directory,
+  see install_input()
+- the other directories of `sirane/` (eg. the output directory) are created empty
+
+The work directories of model.py are pruned before each run, so that they don't fill the disk: only the
+`workdir_keep` most recent ones are kept (see prune_workdirs). A run holds a lock on its work directory
+while it uses it (see hold_workdir), so a work directory still in use (eg. a long backfill chunk) is never deleted.
+The work directories which aren't held by model.py (eg. created with `./workdir.py`) are never pruned.
+"""
+
+SIRANE_DIR = "sirane"
+SIRANE_EXECUTABLE = "sirane-rev128-etudiants-Linux64"
+DEFAULT_WORKDIR_ROOT = "sirane/runs"
+DEFAULT_WORKDIR_KEEP = 48
+
+# Marks the work directories which are pruned, and locked by the runs which use them
+LOCK_FILENAME = ".workdir.lock"
+
+# Input files written by model.py for each run, relative to the INPUT directory
+DYNAMIC_INPUTS = [
+    "Donnees.dat",
+    "METEO/Meteo.dat",
+    "FOND/Concentration_Fond.dat",
+    "EMISSIONS/EMIS_LIN/emis_lin.dat",
+    "EMISSIONS/Emissions_Lin_Surf.dat",
+]
+
+# Directories of sirane/ used by model.py itself, which are not part of a work directory
+PRIVATE_DIRS = ["dl_data", "cache", "traffic_data", "runs", "capture"]
+# Files written by model.py next to SIRANE's outputs (SIRANE's output and memory profile, run log)
+PRIVATE_FILES = ["stdout.txt", "memory_profile.csv", "run_log.jsonl"]
+
+
+def contains_dynamic_input(relpath):
+    """Whether the path $relpath (relative to the INPUT directory) is or contains a dynamic input"""
+    if relpath == "":
+        return True
+    return any(x == relpath or x.startswith(relpath + "/") for x in DYNAMIC_INPUTS)
+
+
+def link_tree(source, destination, relpath = ""):
+    """
+    Mirror the INPUT directory $source into $destination with symbolic links.
+
+    Directories without any dynamic input are linked as a whole, the others are created
+    and their entries linked one by one, so that a dynamic input can be replaced without
+    touching the shared file.
+    """
+    os.makedirs(destination, exist_ok = True)
+    for entry in os.scandir(source):
+        entry_relpath = entry.name if relpath == "" else "%s/%s" % (relpath, entry.name)
+        target = os.path.join(destination, entry.name)
+        if entry.is_dir() and contains_dynamic_input(entry_relpath):
+            link_tree(entry.path, target, entry_relpath)
+        else:
+            os.symlink(os.path.abspath(entry.path), target)
+
+
+def copy_dirs(source, destination):
+    """Create the directory tree of $source (without any file) in $destination"""
+    for dirpath, dirnames, filenames in os.walk(source):
+        relpath = os.path.relpath(dirpath, source)
+        os.makedirs(os.path.join(destination, relpath), exist_ok = True)
+
+
+def create_workdir(root = None, prefix = "", sirane_dir = SIRANE_DIR):
+    """
+    Create a new work directory in the directory $root, and return its path.
+
+    The name of the work directory starts with $prefix (eg. the run's timestamp), and is made unique
+    so that concurrent runs never share a work directory.
+    """
+    if root is None:
+        root = DEFAULT_WORKDIR_ROOT
+    os.makedirs(root, exist_ok = True)
+    workdir = tempfile.mkdtemp(prefix = prefix, dir = root)
+    # mkdtemp creates the directory as private, but the outputs are read by other users (MintServ)
+    os.chmod(workdir, 0o755)
+
+    for entry in os.scandir(sirane_dir):
+        target = os.path.join(workdir, entry.name)
+        if entry.name == "INPUT":
+            link_tree(entry.path, target)
+        elif entry.name == SIRANE_EXECUTABLE:
+            os.symlink(os.path.abspath(entry.path), target)
+        elif entry.is_dir() and entry.name not in PRIVATE_DIRS \
+                and os.path.abspath(entry.path) != os.path.abspath(root):
+            copy_dirs(entry.path, target)
+
+    return workdir
+
+
+# Lock files of the work directories held by this process
+_held = {}
+
+
+def hold_workdir(workdir):
+    """
+    Mark the work directory $workdir as prunable, and lock it until release_workdir() (or the end of the process),
+    so that prune_workdirs() doesn't delete it in the meantime
+    """
+    f = open(os.path.join(workdir, LOCK_FILENAME), 'w')
+    fcntl.flock(f, fcntl.LOCK_SH)
+    _held[workdir] = f
+
+
+def release_workdir(workdir):
+    """Release the lock of hold_workdir() on $workdir, which can then be pruned"""
+    f = _held.pop(workdir, None)
+    if f is not None:
+        f.close()
+
+
+def prune_workdirs(root = None, keep = None):
+    """
+    Delete the work directories held at some point by hold_workdir() in the directory $root,
+    except the $keep most recent ones, and the ones which are still held (by any process).
+    $keep = 0 disables the pruning. Returns the list of the deleted work directories.
+    """
+    if root is None:
+        root = DEFAULT_WORKDIR_ROOT
+    if keep is None:
+        keep = DEFAULT_WORKDIR_KEEP
+    if keep <= 0:
+        return []
+
+    workdirs = []
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        lock_filename = os.path.join(entry.path, LOCK_FILENAME)
+        if entry.is_dir(follow_symlinks = False) and os.path.exists(lock_filename):
+            # The lock file is created with the work directory, and never written to
+            workdirs.append((os.path.getmtime(lock_filename), entry.path))
+    workdirs.sort(reverse = True)
+
+    deleted = []
+    for _mtime, workdir in workdirs[keep:]:
+        with open(os.path.join(workdir, LOCK_FILENAME)) as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still in use
+                continue
+            try:
+                # NB the links to the shared files are deleted, not the files
+                shutil.rmtree(workdir)
+                deleted.append(workdir)
+            except OSError as e:
+                print("Could not delete the work directory %s: %s" % (workdir, e), file = sys.stderr)
+    return deleted
+
+
+def install_input(source, workdir, relpath):
+    """
+    Move the file $source to the input $relpath (relative to the INPUT directory) of the work directory $workdir.
+
+    If the input is a link to a shared file, only the link is replaced: the shared file is never written to.
+    This also works with the shared `sirane` directory itself, where it's the same as shutil.move().
+    """
+    destination = os.path.join(workdir, "INPUT", relpath)
+    if os.path.islink(destination):
+        os.unlink(destination)
+    shutil.move(source, destination)
+
+
+def link_input(source, workdir, relpath):
+    """
+    Hardlink the file $source (which is left in place) to the input $relpath of the work directory $workdir,
+    or copy it if it's on another file system.
+
+    Like install_input(), a link to a shared file is replaced, not written to. $source may be replaced
+    afterwards (with os.replace) without changing the input.
+    """
+    destination = os.path.join(workdir, "INPUT", relpath)
+    # NB renaming a file over another link to the same file does nothing, and would leave the temporary file
+    if os.path.exists(destination) and not os.path.islink(destination) and os.path.samefile(source, destination):
+        return
+    tmp_destination = "%s.%d.tmp" % (destination, os.getpid())
+    try:
+        os.link(source, tmp_destination)
+    except OSError:
+        shutil.copy2(source, tmp_destination)
+    os.replace(tmp_destination, destination)
+
+
+if __name__ == "__main__":
+    # Create an empty work directory, eg. to prepare a scenario by hand before running it with runpool.py
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", help = "Directory in which to create the work directory (default %s)" % DEFAULT_WORKDIR_ROOT)
+    parser.add_argument("--prefix", default = "")
+    args = parser.parse_args()
+
+    print(create_workdir(root = args.root, prefix = args.prefix))
@@ -0,0 +1,12 @@
+import os
+import sys
+
+"""
+The model's modules import each other as top-level modules (they're run from `model/`),
+and the tests reuse the stand-ins of the benchmarks.
+"""
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "model"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
@@ -0,0 +1,152 @@
+import io
+import os
+import tempfile
+import unittest
+
+import emission
+
+"""
+The emission computation of emission.py
+"""
+
+
+def baseline_compute_emission(speed, rate):
+    """The emission function of the first version of emission.py, one datapoint at a time"""
+    V    = [       10,       30,       60,       90,       11,      130 ] # km/h
+    NOx  = [     0.55,     0.38,     0.28,     0.30,     0.42,     0.58 ] # g/km
+    PM10 = [ 0.005886, 0.004578, 0.001730, 0.004578, 0.006540, 0.007848 ] # g/km
+    PM25 = [ 0.003114, 0.002422,  0.00173, 0.002422,  0.00346, 0.004152 ] # g/km
+
+    i_last = len(V) - 1
+    if speed < V[0]:
+        i_left, i_right = 0, 0
+    elif speed > V[i_last]:
+        i_left, i_right = i_last, i_last
+    else:
+        i = 1
+        while not speed <= V[i]:
+            i += 1
+        i_left, i_right = i-1, i
+
+    if i_left != i_right:
+        t = (speed - V[i_left]) / (V[i_right] - V[i_left])
+    else:
+        t = 1
+    def interpolate(points):
+        return t * points[i_left] + (1-t) * points[i_right]
+
+    return interpolate(NOx) * rate / 3600, interpolate(PM10) * rate / 3600, interpolate(PM25) * rate / 3600
+
+
+class ComputeEmissionsTest(unittest.TestCase):
+
+    def assertParity(self, speeds, rates):
+        batch = emission.compute_emissions(speeds, rates)
+        self.assertEqual(len(batch), len(speeds))
+        for speed, rate, emissions in zip(speeds, rates, batch):
+            expected = baseline_compute_emission(speed, rate)
+            for value, x in zip(emissions, expected):
+                self.assertAlmostEqual(value, x, delta = abs(x) * 1e-12, msg = "speed %s, rate %s" % (speed, rate))
+            self.assertEqual(emission.compute_emission(speed, rate), emissions)
+
+    def test_graph_points(self):
+        # Including the 11 km/h point, which is never the right end of an interval
+        speeds = [10, 11, 30, 60, 90, 130]
+        self.assertParity(speeds, [1000] * len(speeds))
+
+    def test_out_of_range(self):
+        speeds = [-5, 0, 9.99, 130.01, 250]
+        self.assertParity(speeds, [700] * len(speeds))
+
+    def test_interpolation(self):
+        # The baseline weights the left point by t, ie. it interpolates from the wrong end of each interval
+        speeds = [ 10 + x * 0.37 for x in range(350) ] + [ 95, 100.5, 110, 125 ]
+        rates = [ (x * 37) % 1500 for x in range(len(speeds)) ]
+        self.assertParity(speeds, rates)
+
+    def test_reversed_weights(self):
+        # At 20 km/h, halfway between 10 and 30, both ends weigh the same; at 15 km/h, 30 km/h weighs more
+        e_NOx = emission.compute_emission(15, 3600)[0]
+        self.assertAlmostEqual(e_NOx, 0.25 * 0.55 + 0.75 * 0.38)
+
+    def test_empty(self):
+        self.assertEqual(emission.compute_emissions([], []), [])
+
+
+def write_csv(filename, lines):
+    with open(filename, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+class AggregateEmissionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        # Ids which SIRANE can't have: not a number, zero-padded, negative, with spaces, out of range
+        write_csv(self.path("lengths.csv"),
+                  ["id,length", "0,100", "1,250", "2,80", "3,1000", "abc,40", "007,60", "-1,70", " 2,90", "9,30"])
+        write_csv(self.path("nm.csv"),
+                  ["network_id,traffic_id", "0,A", "1,A", "abc,A", "007,B", "1,B", "-1,B", " 2,C", "2,C", "5,C"])
+        write_csv(self.path("d2.csv"),
+                  ["network_id,traffic_id", "1,X", "3,X", "9,Y", "007,Y", "3,Z"])
+        self.nm_data = [("A", 50, 600), ("B", 11, 1200), ("C", 95, 300), ("B", 130, 50), ("D", 40, 40)]
+        self.d2_data = [("X", 30, 900), ("Y", 70, 100), ("Z", 5, 10)]
+        self.segment_count = 5
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def extract_parameters(self, row):
+        return row[1], row[2]
+
+    def emislin(self, data):
+        output = io.StringIO()
+        emission.write_emislin(data, self.segment_count, file = output)
+        return [ line.split() for line in output.getvalue().splitlines() ]
+
+    def assertSameEmisLin(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        self.assertEqual(actual[0], expected[0]) # Headers
+        for line, expected_line in zip(actual[1:], expected[1:]):
+            self.assertEqual(line[0], expected_line[0])
+            for value, x in zip(line[1:], expected_line[1:]):
+                self.assertAlmostEqual(float(value), float(x), delta = abs(float(x)) * 1e-12)
+
+    def test_baseline_parity(self):
+        network_lengths = emission.read_network_lengths(self.path("lengths.csv"))
+        nm_map = emission.read_mapfile(self.path("nm.csv"))
+        d2_map = emission.read_mapfile(self.path("d2.csv"))
+        get_traffic_id = lambda row: row[0]
+
+        # Baseline: one insert_emission per traffic source, keyed by the network id strings
+        baseline = {}
+        for segment_map, traffic_data in [(nm_map, self.nm_data), (d2_map, self.d2_data)]:
+            find_segments = emission.create_find_segments(segment_map, network_lengths, get_traffic_id)
+            emission.insert_emission(baseline, traffic_data, find_segments, self.extract_parameters)
+
+        matrix, network_count = emission.compile_mapfiles(self.path("nm.csv"), self.path("d2.csv"),
+                                                          self.path("lengths.csv"))
+        self.assertEqual(network_count, len(network_lengths))
+        column_emissions = emission.new_column_emissions(matrix)
+        for columns, traffic_data in zip(matrix.columns, [self.nm_data, self.d2_data]):
+            emission.insert_column_emissions(column_emissions, columns, traffic_data,
+                                             get_traffic_id, self.extract_parameters)
+        data = emission.aggregate_emissions(matrix, column_emissions)
+
+        # The segments written by write_emislin have the same emissions, and nothing else is aggregated
+        self.assertEqual(sorted(data), ["0", "1", "2", "3", "9"])
+        for network_id, emissions in data.items():
+            for value, x in zip(emissions, baseline[network_id]):
+                self.assertAlmostEqual(value, x, delta = abs(x) * 1e-12)
+        self.assertSameEmisLin(self.emislin(data), self.emislin(baseline))
+
+    def test_network_row(self):
+        self.assertEqual(emission.network_row("0"), 0)
+        self.assertEqual(emission.network_row("42"), 42)
+        for network_id in ["abc", "007", "-1", " 2", "2 ", "+2", "1.0", ""]:
+            self.assertIsNone(emission.network_row(network_id), network_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+import configparser
+
+import emission
+import emission_factors
+
+"""
+The emission factors per vehicle category of emission_factors.py, and their configuration in emission.py
+"""
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "docs", "samples")
+SPECIES = ["NOx", "PM10", "PM25"]
+
+
+class EmissionFactorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, lines):
+        filename = os.path.join(self.tmp.name, name)
+        with open(filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return filename
+
+    def assertEmissions(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for emissions, expected_emissions in zip(actual, expected):
+            for value, x in zip(emissions, expected_emissions):
+                self.assertAlmostEqual(value, x, delta = abs(x) * 1e-12)
+
+    def test_samples(self):
+        factors = emission_factors.load_factors(os.path.join(SAMPLES_DIR, "emission_factors.csv"),
+                                                os.path.join(SAMPLES_DIR, "vehicle_mix.csv"), SPECIES)
+        self.assertEqual(factors.species, SPECIES)
+        self.assertEqual(factors.max_speed, 130)
+
+        # The factors of the file at its speeds, and of its first and last speeds below and above them
+        speeds = [0, 5, 10, 30, 60, 90, 110, 130, 200]
+        e_NOx = [0.55, 0.55, 0.55, 0.38, 0.28, 0.3, 0.42, 0.58, 0.58]
+        e_PM25 = [0.003114, 0.003114, 0.003114, 0.002422, 0.00173, 0.002422, 0.00346, 0.004152, 0.004152]
+        emissions = emission_factors.compute_emissions(factors, speeds, [3600] * len(speeds))
+        self.assertEmissions([ (x[0], x[2]) for x in emissions ], list(zip(e_NOx, e_PM25)))
+
+        # Below the lowest point and above the highest, the same as the emission graph
+        for speed, rate in [(0, 100), (7, 1500), (150, 800)]:
+            self.assertEmissions(emission_factors.compute_emissions(factors, [speed], [rate]),
+                                 [emission.compute_emission(speed, rate)])
+
+        # In between, the factors are interpolated from the closest points
+        (e_NOx, _e_PM10, _e_PM25), = emission_factors.compute_emissions(factors, [15], [3600])
+        self.assertAlmostEqual(e_NOx, 0.75 * 0.55 + 0.25 * 0.38)
+        (e_NOx, _e_PM10, _e_PM25), = emission_factors.compute_emissions(factors, [100], [3600])
+        self.assertAlmostEqual(e_NOx, (0.3 + 0.42) / 2)
+
+    def test_vehicle_mix(self):
+        factor_file = self.write("factors.csv", [
+            "category,species,speed,factor",
+            "car,NOx,10,0.4", "car,NOx,50,0.2",
+            "hgv,NOx,30,2.0",
+            "car,PM10,10,0.01",
+        ])
+        mix_file = self.write("mix.csv", ["category,share", "car,45", "hgv,20", "car,15"])
+        factors = emission_factors.load_factors(factor_file, mix_file, ["NOx", "PM10"])
+
+        # 75% of cars and 25% of heavy goods vehicles, which don't emit PM10
+        emissions = emission_factors.compute_emissions(factors, [0, 30, 50, 80], [3600, 3600, 7200, 0])
+        self.assertEmissions(emissions, [
+            (0.75 * 0.4 + 0.25 * 2.0, 0.75 * 0.01),
+            (0.75 * 0.3 + 0.25 * 2.0, 0.75 * 0.01),
+            ((0.75 * 0.2 + 0.25 * 2.0) * 2, 0.75 * 0.01 * 2),
+            (0, 0),
+        ])
+        self.assertEqual(emission_factors.compute_emissions(factors, [], []), [])
+
+    def test_invalid_files(self):
+        factor_file = self.write("factors.csv", ["category,species,speed,factor", "car,NOx,10,0.4"])
+        mix_file = self.write("mix.csv", ["category,share", "car,1"])
+        with self.assertRaises(ValueError):
+            emission_factors.load_factors(factor_file, self.write("bus.csv", ["category,share", "bus,1"]), ["NOx"])
+        with self.assertRaises(ValueError):
+            emission_factors.load_factors(factor_file, self.write("empty.csv", ["category,share"]), ["NOx"])
+        with self.assertRaises(ValueError):
+            emission_factors.load_factors(factor_file, mix_file, ["NOx", "PM10"])
+        duplicate_file = self.write("duplicate.csv", ["category,species,speed,factor", "car,NOx,10,0.4", "car,NOx,10,0.5"])
+        with self.assertRaises(ValueError):
+            emission_factors.load_factors(duplicate_file, mix_file, ["NOx"])
+
+    def test_load_compute(self):
+        config = configparser.ConfigParser()
+        config.read_dict({'emission': {}})
+        self.assertIsNone(emission.load_compute(config))
+
+        config['emission']['emission_factors'] = os.path.join(SAMPLES_DIR, "emission_factors.csv")
+        with self.assertRaisesRegex(ValueError, "vehicle_mix"):
+            emission.load_compute(config)
+
+        config['emission']['vehicle_mix'] = os.path.join(SAMPLES_DIR, "vehicle_mix.csv")
+        compute = emission.load_compute(config)
+        self.assertEmissions(compute([60, 100], [1000, 3600]), [(0.28 * 1000 / 3600, 0.00173 * 1000 / 3600, 0.00173 * 1000 / 3600),
+                                                               ((0.3 + 0.42) / 2, (0.004578 + 0.00654) / 2, (0.002422 + 0.00346) / 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import time
+import threading
+import unittest
+
+import fetch
+
+"""
+The deadline of the requests of fetch.py
+"""
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def tearDown(self):
+        fetch.set_deadline(None)
+
+    def test_per_thread(self):
+        # A stage left running after the run keeps its deadline when the run removes its own
+        started, cleared = threading.Event(), threading.Event()
+        errors = []
+
+        def stage():
+            fetch.set_deadline(0.1)
+            started.set()
+            cleared.wait()
+            time.sleep(0.2)
+            try:
+                fetch.get("http://127.0.0.1:9/")
+            except Exception as e:
+                errors.append(e)
+
+        fetch.set_deadline(60)
+        thread = threading.Thread(target = stage)
+        thread.start()
+        started.wait()
+        self.assertGreater(fetch.remaining_time(), 1)
+        fetch.set_deadline(None)
+        cleared.set()
+        thread.join()
+
+        self.assertIsNone(fetch.remaining_time())
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], fetch.FetchDeadlineExceeded)
+
+    def test_not_inherited(self):
+        fetch.set_deadline(60)
+        remaining = []
+        thread = threading.Thread(target = lambda: remaining.append(fetch.remaining_time()))
+        thread.start()
+        thread.join()
+        self.assertEqual(remaining, [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import re
+import csv
+import tempfile
+from datetime import datetime, timedelta, timezone
+import unittest
+
+import standin
+import synthetic
+import metrics
+import capture
+import trafic_nm
+import datex2
+
+"""
+The traffic fetchers, against the stand-in HTTP server of the benchmarks (see benchmarks/standin.py)
+"""
+
+SCALE = 1000
+
+
+class FetchersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.urls = (trafic_nm.DOWNLOAD_URL, datex2.NANTES_URL)
+        self.standin = standin.StandIn().__enter__()
+        self.standin.set_scale(SCALE)
+        self.standin.redirect()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        trafic_nm.DOWNLOAD_URL, datex2.NANTES_URL = self.urls
+        self.standin.__exit__(None, None, None)
+        self.tmp.cleanup()
+
+    def test_trafic_nm_fetch(self):
+        records, dt = trafic_nm.fetch()
+        self.assertEqual(len(records), SCALE // 10)
+        self.assertIsNotNone(dt.tzinfo)
+
+    def test_trafic_nm_main(self):
+        outputfile = os.path.join(self.tmp.name, "trafic.csv")
+        _records, dt = trafic_nm.fetch()
+        self.assertEqual(trafic_nm.main(outputfile), dt)
+
+    def test_trafic_nm_replay(self):
+        # The recorded payload of fetch() only has its columns, which main() must find too
+        capture_dir = os.path.join(self.tmp.name, "capture")
+        self.addCleanup(capture.configure)
+        capture.configure(capture_dir, record = True)
+        _records, dt = trafic_nm.fetch()
+
+        capture.configure(capture_dir, replay = datetime.now(timezone.utc) + timedelta(minutes = 1))
+        outputfile = os.path.join(self.tmp.name, "trafic.csv")
+        self.assertEqual(trafic_nm.main(outputfile), dt)
+
+    def test_datex2_fetch(self):
+        configfile = os.path.join(self.tmp.name, "config.ini")
+        with open(configfile, 'w') as f:
+            f.write("[GENERAL]\ncache_dir = %s\n[tipitrafic]\nusername = user\npassword = password\n" % self.tmp.name)
+
+        data, dt = datex2.fetch(configfile)
+        self.assertEqual(len(data), SCALE // 100)
+        self.assertIsNotNone(dt.tzinfo)
+        # The second run guesses the latest file from the index cache
+        data, _dt = datex2.fetch(configfile)
+        self.assertEqual(len(data), SCALE // 100)
+
+    def stale_guess(self):
+        """Fetch the latest DATEX2 file after a stale guess, and returns its name"""
+        index_cache = os.path.join(self.tmp.name, "tipi_index.json")
+        auth = ("user", "password")
+        r, latest = datex2.get_latest_file(auth, index_cache = index_cache)
+        r.close()
+
+        # As if the files were published a period later when we walked the index:
+        # the guess is the previous file, which exists but isn't the latest
+        cache = datex2.read_index_cache(index_cache)
+        entry = cache['files'][datex2.DATA_TR_REGEX]
+        _prefix, file_time = datex2.parse_file_time(entry['file'])
+        previous = file_time - timedelta(seconds = synthetic.TIPI_PERIOD)
+        entry['folder'], entry['file'] = previous.strftime(datex2.FOLDER_FORMAT), synthetic.tipi_filename(previous)
+        entry['lag'] -= synthetic.TIPI_PERIOD
+        # The period isn't known from the index when the folder only has one file (the first one of the hour)
+        entry['period'] = synthetic.TIPI_PERIOD
+        datex2.write_index_cache(index_cache, cache)
+
+        run = metrics.start_run()
+        with metrics.stage('datex2'):
+            r, last_file = datex2.get_latest_file(auth, index_cache = index_cache)
+            r.close()
+        self.assertEqual(last_file, latest)
+        self.assertEqual(run.stages[-1]['counters'].get('guess_misses'), 1)
+        return latest
+
+    def test_datex2_stale_guess(self):
+        self.stale_guess()
+
+    def test_datex2_record_used_file(self):
+        # The stale guess isn't recorded, so the replay is the latest file
+        capture_dir = os.path.join(self.tmp.name, "capture")
+        self.addCleanup(capture.configure)
+        capture.configure(capture_dir, record = True)
+        latest = self.stale_guess()
+        now = datetime.now(timezone.utc)
+        keys = [ e['key'] for day in (now - timedelta(days = 1), now) for e in capture.iter_entries(day)
+                 if e['source'] == 'tipi_datatr' ]
+        self.assertEqual([ os.path.basename(key) for key in keys ], [latest, latest])
+
+        capture.configure(capture_dir, replay = now + timedelta(minutes = 1))
+        r, last_file = datex2.get_latest_file(("user", "password"))
+        r.close()
+        self.assertEqual(last_file, latest)
+
+    def test_datex2_main(self):
+        # The values are written as they are in the file
+        for path, (content_type, payload) in list(self.standin.payloads.items()):
+            if path.endswith(".xml"):
+                payload = re.sub(rb"<percentage>\d+</percentage>", b"<percentage>12.50</percentage>", payload, count = 1)
+                self.standin.payloads[path] = (content_type, payload)
+        xml_file = os.path.join(self.tmp.name, "datatr.xml")
+        with open(xml_file, 'wb') as f:
+            f.write(payload)
+
+        configfile = os.path.join(self.tmp.name, "config.ini")
+        with open(configfile, 'w') as f:
+            f.write("[GENERAL]\ncache_dir = %s\n[tipitrafic]\nusername = user\npassword = password\n" % self.tmp.name)
+        outputfile = os.path.join(self.tmp.name, "datex2.csv")
+        datex2.main(configfile, outputfile)
+
+        with open(outputfile, newline = "") as f:
+            rows = list(csv.reader(f))
+        expected = [ [ "" if x is None else x for x in row ] for row in datex2.parse_xml_file(xml_file) ]
+        self.assertEqual(rows, expected)
+        self.assertEqual(rows[1][3], "12.50")
+
+
+if __name__ == "__main__":
+    unittest.main()
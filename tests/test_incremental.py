@@ -0,0 +1,98 @@
+import io
+import os
+import tempfile
+import unittest
+from array import array
+
+import metrics
+import incremental
+from emission import AggregationMatrix, FetchedEmissions, aggregate_emissions, write_emislin
+
+"""
+The incremental updates of the EmisLin file of incremental.py
+"""
+
+SEGMENT_COUNT = 50
+COLUMN_COUNT = 20
+
+
+def parse_emislin(text):
+    """Returns the header and the rows of an EmisLin file, as SIRANE reads them (whitespace separated numbers)"""
+    lines = text.splitlines()
+    return lines[0].split(), [ [ float(x) for x in line.split() ] for line in lines[1:] ]
+
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "map.csv")
+        with open(self.source, 'w') as f:
+            f.write("map")
+        # Each segment gets 2 columns, the last segments none
+        indptr, indices, weights = array('l', [0]), array('l'), array('d')
+        for row in range(SEGMENT_COUNT - 5):
+            indices.extend([row % COLUMN_COUNT, (row * 7 + 3) % COLUMN_COUNT])
+            weights.extend([0.1 + row / 1000, 0.0123])
+            indptr.append(len(indices))
+        columns = dict(("t%d" % column, column) for column in range(COLUMN_COUNT))
+        self.matrix = AggregationMatrix(SEGMENT_COUNT - 5, indptr, indices, weights, [columns, {}])
+        self.run = metrics.start_run()
+
+    def tearDown(self):
+        metrics.finish_run()
+        self.tmp.cleanup()
+
+    def column_emissions(self, seed):
+        present = bytearray(1 if (column + seed) % 5 else 0 for column in range(COLUMN_COUNT))
+        return (array('d', [ column / 3 + seed * (column % 2) for column in range(COLUMN_COUNT) ]),
+                array('d', [ 1e-7 * column for column in range(COLUMN_COUNT) ]),
+                array('d', [ 2 / 7 + seed for _ in range(COLUMN_COUNT) ]),
+                present)
+
+    def update(self, column_emissions, outputfile):
+        fetched = FetchedEmissions(self.matrix, SEGMENT_COUNT, column_emissions, None, None)
+        with metrics.stage('emission.write'):
+            incremental.update_emislin(fetched, [self.source], cache_dir = self.tmp.name, outputfile = outputfile)
+        with open(outputfile) as f:
+            return f.read()
+
+    def expected(self, column_emissions):
+        f = io.StringIO()
+        write_emislin(aggregate_emissions(self.matrix, column_emissions), SEGMENT_COUNT, file = f)
+        return f.getvalue()
+
+    def test_same_values(self):
+        outputfile = os.path.join(self.tmp.name, "emis_lin.dat")
+        for seed in (0, 0, 1, 2, 2, 3):
+            column_emissions = self.column_emissions(seed)
+            self.assertEqual(parse_emislin(self.update(column_emissions, outputfile)),
+                             parse_emislin(self.expected(column_emissions)))
+
+    def test_in_place(self):
+        # The output replaces the last one, as the INPUT file of SIRANE's directory
+        outputfile = os.path.join(self.tmp.name, "emis_lin.dat")
+        for seed in (0, 1, 2, 3):
+            self.update(self.column_emissions(seed), outputfile)
+        counters = [ x['counters'] for x in self.run.stages ]
+        size = os.path.getsize(outputfile)
+        # The whole file, then a copy for the other generation, then only rows
+        self.assertEqual(counters[0]['bytes_written'], size)
+        self.assertGreater(counters[1]['bytes_written'], size)
+        self.assertLess(counters[2]['bytes_written'], size)
+        self.assertLess(counters[3]['bytes_written'], size)
+
+    def test_inputs_kept(self):
+        # Each output is kept, as in the work directories of `model.py --isolated`
+        outputs = []
+        for seed in (0, 1, 2, 3):
+            outputfile = os.path.join(self.tmp.name, "emis_lin_%d.dat" % seed)
+            self.update(self.column_emissions(seed), outputfile)
+            outputs.append(outputfile)
+        for seed, outputfile in enumerate(outputs):
+            with open(outputfile) as f:
+                self.assertEqual(parse_emislin(f.read()), parse_emislin(self.expected(self.column_emissions(seed))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import json
+import random
+import tempfile
+import unittest
+
+import emission
+import mapbuilder
+
+"""
+The spatial matching of the traffic sections to the network segments of mapbuilder.py
+"""
+
+# A street along y = 0 in 3 segments, a cross street, and a parallel street 50 m away (Lambert-93 meters)
+NETWORK = {
+    "0": [[(0, 0), (100, 0)]],
+    "1": [[(100, 0), (200, 0)]],
+    "2": [[(200, 0), (300, 0)]],
+    "3": [[(150, -100), (150, 100)]],
+    "4": [[(0, 50), (300, 50)]],
+}
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+
+class MapBuilderTest(unittest.TestCase):
+
+    def test_str_tree(self):
+        rng = random.Random(42)
+        entries = []
+        for i in range(1000):
+            x, y = rng.uniform(0, 1000), rng.uniform(0, 1000)
+            entries.append(((x, y, x + rng.uniform(0, 20), y + rng.uniform(0, 20)), i))
+        tree = mapbuilder.STRTree(entries, capacity = 4)
+        for _ in range(100):
+            x, y = rng.uniform(0, 1000), rng.uniform(0, 1000)
+            bbox = (x, y, x + rng.uniform(0, 100), y + rng.uniform(0, 100))
+            expected = sorted(item for b, item in entries if intersects(b, bbox))
+            self.assertEqual(sorted(tree.query(bbox)), expected)
+        self.assertEqual(mapbuilder.STRTree([]).query((0, 0, 1, 1)), [])
+
+    def test_match(self):
+        tree = mapbuilder.index_network(NETWORK)
+        lengths = mapbuilder.network_lengths(NETWORK)
+        self.assertEqual(lengths["4"], 300)
+
+        # A is 3 m beside the street, from x = -10 to 210: the segment 2 is only covered on 10 m, the cross street
+        # has another heading, and the parallel street is beyond the buffer. B is on the cross street
+        sections = {
+            "A": [[(-10, 3), (120, 3), (210, 3)]],
+            "B": [[(150, -90), (151, 90)]],
+            "C": [[(1000, 1000), (1100, 1000)]],
+        }
+        rows = mapbuilder.match(tree, lengths, sections)
+        self.assertEqual(sorted((network_id, traffic_id) for network_id, traffic_id, _length in rows),
+                         [("0", "A"), ("1", "A"), ("3", "B")])
+        for network_id, _traffic_id, length in rows:
+            self.assertAlmostEqual(length, lengths[network_id], delta = 5)
+
+        # With a smaller overlap, the segment 2 is matched too, and with a larger buffer, the parallel street
+        rows = mapbuilder.match(tree, lengths, {"A": sections["A"]}, min_overlap = 0.05)
+        self.assertIn("2", [ network_id for network_id, _t, _l in rows ])
+        rows = mapbuilder.match(tree, lengths, {"A": sections["A"]}, buffer = 60)
+        self.assertIn("4", [ network_id for network_id, _t, _l in rows ])
+
+    def test_lambert93(self):
+        x, y = mapbuilder.lambert93(3, 46.5)
+        self.assertAlmostEqual(x, 700000, places = 3)
+        self.assertAlmostEqual(y, 6600000, places = 3)
+
+        geometries = {"A": [[(-1.55, 47.21), (-1.54, 47.21)]]}
+        mapbuilder.project(geometries, 'auto')
+        (x1, y1), (x2, y2) = geometries["A"][0]
+        self.assertAlmostEqual(x2 - x1, 756, delta = 5)
+        self.assertEqual(mapbuilder.project(dict(NETWORK), 'auto'), NETWORK)
+
+    def test_files(self):
+        # The files written from the csv inputs are read by emission.py
+        with tempfile.TemporaryDirectory() as tmp:
+            network_file = os.path.join(tmp, "network.csv")
+            with open(network_file, 'w') as f:
+                f.write("id,x1,y1,x2,y2\n")
+                for network_id, [[(x1, y1), (x2, y2)]] in sorted(NETWORK.items()):
+                    f.write("%s,%s,%s,%s,%s\n" % (network_id, x1, y1, x2, y2))
+            nm_file = os.path.join(tmp, "nm.csv")
+            with open(nm_file, 'w', encoding = "utf-8") as f:
+                geometry = json.dumps({'type': "LineString", 'coordinates': [[-10, 3], [210, 3]]})
+                f.write("\ufeffIdentifiant;Géométrie\n") # With a byte order mark
+                f.write('A;"%s"\n' % geometry.replace('"', '""'))
+                f.write("B;\n")
+
+            network = mapbuilder.read_geometries(network_file, "id")
+            self.assertEqual(network, NETWORK)
+            sections = mapbuilder.read_nm_csv(nm_file)
+            self.assertEqual(sections, {"A": [[(-10, 3), (210, 3)]]})
+
+            lengths = mapbuilder.network_lengths(network)
+            lengths_file = os.path.join(tmp, "lengths.csv")
+            mapbuilder.write_network_lengths(lengths, lengths_file)
+            map_file = os.path.join(tmp, "map.csv")
+            rows = mapbuilder.match(mapbuilder.index_network(network), lengths, sections)
+            mapbuilder.write_segment_map(rows, map_file)
+
+            self.assertEqual(emission.read_network_lengths(lengths_file), lengths)
+            self.assertEqual(emission.read_mapfile(map_file), {"A": ["0", "1"]})
+            matrix, network_count = emission.compile_mapfiles(map_file, map_file, lengths_file)
+            self.assertEqual(network_count, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
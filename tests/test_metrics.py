@@ -0,0 +1,51 @@
+import unittest
+
+import metrics
+
+"""
+The OpenMetrics export of metrics.py
+"""
+
+
+class OpenMetricsTest(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.finish_run()
+
+    def test_repeated_stages(self):
+        run = metrics.start_run()
+        for chunk in range(3):
+            with metrics.stage('backfill.inputs'):
+                metrics.count('rows', 10)
+                metrics.peak('peak_rss_bytes', 100 * (chunk + 1) % 250)
+        try:
+            with metrics.stage('backfill.inputs'):
+                raise ValueError("missing hour")
+        except ValueError:
+            pass
+        with metrics.stage('launch'):
+            pass
+
+        text = metrics.format_openmetrics(run, "ok")
+        samples = [ line for line in text.splitlines() if not line.startswith("#") ]
+        series = [ line.rsplit(" ", 1)[0] for line in samples ]
+        self.assertEqual(len(series), len(set(series)))
+
+        values = dict(line.rsplit(" ", 1) for line in samples)
+        self.assertEqual(values['captation_stage_runs{stage="backfill.inputs"}'], "4.0")
+        self.assertEqual(values['captation_stage_rows{stage="backfill.inputs"}'], "30.0")
+        self.assertEqual(values['captation_stage_peak_rss_bytes{stage="backfill.inputs"}'], "200.0")
+        self.assertEqual(values['captation_stage_success{stage="backfill.inputs"}'], "0.0")
+        self.assertEqual(values['captation_stage_success{stage="launch"}'], "1.0")
+        self.assertEqual(text.splitlines()[-1], "# EOF")
+
+    def test_peak(self):
+        run = metrics.start_run()
+        with metrics.stage('launch'):
+            metrics.peak('peak_rss_bytes', 300)
+            metrics.peak('peak_rss_bytes', 200)
+        self.assertEqual(run.stages[0]['counters'], {'peak_rss_bytes': 300})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import tempfile
+import unittest
+from array import array
+from datetime import datetime
+
+import emission
+import modulation
+
+"""
+The fitting of the linear modulation factors of modulation.py
+"""
+
+# Traffic ids mapping to their network segments, and the road class of each segment
+SEGMENT_MAP = {'A': ["0", "1"], 'B': ["2"], 'C': ["3", "4"], 'D': ["5"]}
+NETWORK_LENGTHS = dict( (str(i), 100.0 * (i + 1)) for i in range(6) )
+ROAD_CLASSES = {"0": 0, "1": 0, "2": 1, "3": 1, "4": 2, "5": 2}
+
+
+def column_emissions(values, present):
+    """ColumnEmissions of the (NOx, PM10, PM25) $values of each column"""
+    return (array('d', [ v[0] for v in values ]), array('d', [ v[1] for v in values ]),
+            array('d', [ v[2] for v in values ]), bytearray(present))
+
+
+class ModulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = emission.compile_aggregation([SEGMENT_MAP], NETWORK_LENGTHS)
+        self.class_weights = modulation.compile_class_weights(self.matrix, ROAD_CLASSES)
+        self.columns = self.matrix.columns[0]
+
+    def test_class_weights(self):
+        weights = self.class_weights
+        self.assertEqual(weights.class_count, 3)
+        # C is on a segment of class 1 and one of class 2
+        c = self.columns['C']
+        entries = list(zip(weights.classes[weights.indptr[c]:weights.indptr[c + 1]],
+                           weights.weights[weights.indptr[c]:weights.indptr[c + 1]]))
+        self.assertEqual(entries, [(1, 0.4), (2, 0.5)])
+        a = self.columns['A']
+        self.assertEqual(list(weights.classes[weights.indptr[a]:weights.indptr[a + 1]]), [0])
+        self.assertAlmostEqual(weights.weights[weights.indptr[a]], 0.3)
+
+    def test_fit_factors(self):
+        base = [(1.0, 0.1, 0.05), (2.0, 0.2, 0.1), (3.0, 0.3, 0.15), (4.0, 0.4, 0.2)]
+        # Each class scales by its own factor, and C (classes 1 and 2) by both
+        scales = {'A': 2.0, 'B': 0.5, 'C': 0.5, 'D': 0.5}
+        current = [None] * 4
+        for traffic_id, column in self.columns.items():
+            current[column] = tuple(x * scales[traffic_id] for x in base[column])
+        base_emissions = column_emissions(base, [1, 1, 1, 1])
+        current_emissions = column_emissions(current, [1, 1, 1, 1])
+
+        factors = modulation.fit_factors(self.class_weights, current_emissions, base_emissions)
+        self.assertEqual(len(factors), 3)
+        for road_class, scale in [(0, 2.0), (1, 0.5), (2, 0.5)]:
+            for x in factors[road_class]:
+                self.assertAlmostEqual(x, scale)
+
+        # The base EmisLin modulated by the factors of each class is the current one
+        base_data = emission.aggregate_emissions(self.matrix, base_emissions)
+        current_data = emission.aggregate_emissions(self.matrix, current_emissions)
+        for segment_id, emissions in current_data.items():
+            factor = factors[ROAD_CLASSES[segment_id]]
+            for value, b, f in zip(emissions, base_data[segment_id], factor):
+                self.assertAlmostEqual(value, b * f)
+
+    def test_fit_factors_missing(self):
+        # The traffic ids without data in both are ignored, and a class without any has factors of 1
+        base = [(1.0, 0.1, 0.05)] * 4
+        current = [(3.0, 0.3, 0.15)] * 4
+        present = [0] * 4
+        present[self.columns['A']] = 1
+        present[self.columns['B']] = 1
+        base_present = [1] * 4
+        base_present[self.columns['B']] = 0
+        factors = modulation.fit_factors(self.class_weights, column_emissions(current, present),
+                                         column_emissions(base, base_present))
+        for x in factors[0]:
+            self.assertAlmostEqual(x, 3.0)
+        self.assertEqual(factors[1], (1, 1, 1))
+        self.assertEqual(factors[2], (1, 1, 1))
+
+        self.assertEqual(modulation.coverage(column_emissions(current, present), column_emissions(base, base_present)), 0.5)
+
+    def test_evol_factors(self):
+        factors = [(2.0, 0.5, 0.25), (1, 1, 1)]
+        # In the order of the species NO, NO2, PM10, PM25 and O3, rounded
+        self.assertEqual(modulation.evol_factors(factors),
+                         [(2.0, 2.0, 0.5, 0.25, 2.0), (1, 1, 1, 1, 1)])
+        self.assertEqual(modulation.evol_factors([(1 / 3, 1, 1)], scale = 0.5),
+                         [(0.166667, 0.166667, 0.5, 0.5, 0.166667)])
+
+    def test_day_type(self):
+        self.assertEqual(modulation.day_type(datetime(2021, 3, 5)), 'weekday')
+        self.assertEqual(modulation.day_type(datetime(2021, 3, 6)), 'saturday')
+        self.assertEqual(modulation.day_type(datetime(2021, 3, 7)), 'sunday')
+
+    def test_base_round_trip(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            self.assertIsNone(modulation.read_base(base_dir, 'weekday'))
+
+            values = column_emissions([(1.0, 0.1, 0.05)] * 4, [1, 1, 0, 1])
+            fetched = emission.FetchedEmissions(self.matrix, 6, values, None, None)
+            time = datetime(2021, 3, 5, 14)
+            written = modulation.write_base(base_dir, 'weekday', time, fetched)
+            base = modulation.read_base(base_dir, 'weekday')
+            self.assertEqual(base, written)
+            self.assertEqual(base.time, time)
+            self.assertEqual(base.segment_count, 6)
+            self.assertTrue(os.path.exists(base.emis_lin))
+
+            options = {'base_max_age': 7, 'min_coverage': 0.95}
+            self.assertIsNone(modulation.rebase_reason(base, fetched, datetime(2021, 3, 8, 14), options))
+            self.assertIsNotNone(modulation.rebase_reason(base, fetched, datetime(2021, 3, 15, 14), options))
+            self.assertIsNotNone(modulation.rebase_reason(None, fetched, time, options))
+
+
+if __name__ == "__main__":
+    unittest.main()
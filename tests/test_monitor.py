@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+import subprocess
+
+import metrics
+import monitor
+import runpool
+
+"""
+The progress and the sampling loop of monitor.py
+"""
+
+# Excerpt of SIRANE's Log.txt: the dates of the other lines aren't time steps
+LOG_EXCERPT = b"""SIRANE rev128
+Lecture des donnees
+Calcul du 05/03/2021 11:00
+Pas de temps 12/24 : 05/03/2021 11:00:00
+Calcul du 05/03/2021 12:00
+Pas de temps 13/24 : 05/03/2021 12:00:00
+Calcul du 05/03/2021 13:00
+"""
+
+
+class LogProgressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "Log.txt")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, data):
+        with open(self.filename, 'ab') as f:
+            f.write(data)
+
+    def test_time_steps(self):
+        progress = monitor.LogProgress(self.filename, 0)
+        self.write(LOG_EXCERPT)
+        self.assertEqual(progress.update(), 13 / 24)
+        self.assertEqual(monitor.format_eta(130, progress.progress), "2 min")
+
+    def test_dates_are_not_steps(self):
+        progress = monitor.LogProgress(self.filename, 0)
+        self.write(b"Calcul du 05/03/2021 11:00\n")
+        self.assertIsNone(progress.update())
+        self.write(b"Pas de temps 1/24 : 05/03/2021 00:00:00\nCalcul du 05/03/2021 01:00\n")
+        self.assertEqual(progress.update(), 1 / 24)
+
+    def test_ratio_above_one(self):
+        progress = monitor.LogProgress(self.filename, 0)
+        self.write(b"Pas de temps 25/24\nPas de temps 3/0\n")
+        self.assertIsNone(progress.update())
+
+    def test_partial_line(self):
+        progress = monitor.LogProgress(self.filename, 0)
+        self.write(b"Pas de temps 2/24 : 05/03/2021 01:00:00\nPas de temps 3/2")
+        self.assertEqual(progress.update(), 2 / 24)
+        self.write(b"4 : 05/03/2021 02:00:00\n")
+        self.assertEqual(progress.update(), 3 / 24)
+
+
+class WatchTest(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.isdir("/proc/self"), "needs procfs")
+    def test_sampling_errors_wait(self):
+        calls = []
+
+        def failing_sample(pid, start, log_progress):
+            calls.append(pid)
+            raise ValueError("unexpected /proc format")
+
+        original = monitor.sample_process
+        monitor.sample_process = failing_sample
+        try:
+            with tempfile.TemporaryDirectory() as cwd:
+                proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(1)"])
+                watched = monitor.watch(proc, cwd, interval = 0.2)
+        finally:
+            monitor.sample_process = original
+
+        self.assertEqual(watched.returncode, 0)
+        # About one sample per interval, not a busy loop
+        self.assertLess(len(calls), 15)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self"), "needs procfs")
+    def test_timeout_without_samples(self):
+        def failing_sample(pid, start, log_progress):
+            raise OSError("unreadable /proc")
+
+        original = monitor.sample_process
+        monitor.sample_process = failing_sample
+        try:
+            with tempfile.TemporaryDirectory() as cwd:
+                proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+                start = time.monotonic()
+                watched = monitor.watch(proc, cwd, timeout = 0.5, interval = 0.1)
+        finally:
+            monitor.sample_process = original
+
+        self.assertTrue(watched.killed)
+        self.assertLess(watched.returncode, 0)
+        self.assertLess(time.monotonic() - start, 10)
+
+
+class RunPoolTest(unittest.TestCase):
+
+    @unittest.skipUnless(os.path.isdir("/proc/self"), "needs procfs")
+    def test_peaks_recorded(self):
+        # The pool's threads have no metrics stage, the peaks are recorded in the caller's
+        settings = runpool.DEFAULT_POOL_SETTINGS._replace(workers = 2, monitor_interval = 0.1)
+        with tempfile.TemporaryDirectory() as tmp:
+            workdirs = []
+            for name in ("a", "b"):
+                workdir = os.path.join(tmp, name)
+                os.mkdir(workdir)
+                executable = os.path.join(workdir, runpool.SIRANE_EXECUTABLE)
+                with open(executable, 'w') as f:
+                    f.write("#!/bin/sh\nsleep 0.5\n")
+                os.chmod(executable, 0o755)
+                workdirs.append(workdir)
+
+            run = metrics.start_run()
+            try:
+                with metrics.stage('backfill.launch'):
+                    returncodes = runpool.run_pool(workdirs, settings)
+            finally:
+                metrics.finish_run()
+
+        self.assertEqual(returncodes, [0, 0])
+        self.assertGreater(run.stages[0]['counters'].get('peak_rss_bytes', 0), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
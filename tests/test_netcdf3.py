@@ -0,0 +1,109 @@
+import os
+import stat
+import tempfile
+import unittest
+from array import array
+from datetime import datetime
+
+import standin
+import synthetic
+import netcdf3
+
+standin.install_cdsapi()
+import fond
+
+"""
+The netcdf 3 reader, and the in-process extraction of the CAMS data of fond.py against the java program's output
+"""
+
+LATS = [47.3, 47.2]
+LONS = [-1.6, -1.5]
+# no2_conc(time, level, latitude, longitude) at 2 hours, which aren't exact in float32
+NO2 = [12.3, 12.7, 13.1, 13.9,
+       14.3, 14.7, 15.1, 15.9]
+
+# What the java program prints for the cell (1, 0), with Float.toString()
+JAR_OUTPUT = """FORECAST time from 20210212
+hours 0.0 1.0
+no2 13.1 15.1
+o3 41.1 43.1
+pm10 21.1 23.1
+pm25 16.1 18.1
+"""
+
+
+def write_cams(filename):
+    def series(base):
+        return [array('f', [ base - 12 + x for x in NO2 ])]
+
+    variables = [
+        ("time", ["time"], {'long_name': "FORECAST time from 20210212", 'units': "hours"}, [array('f', [0, 1])]),
+        ("level", ["level"], {'units': "m"}, [array('f', [0])]),
+        ("latitude", ["latitude"], {'units': "degrees_north"}, [array('f', LATS)]),
+        ("longitude", ["longitude"], {'units': "degrees_east"}, [array('f', LONS)]),
+    ]
+    for name, base in [("no2_conc", 12), ("o3_conc", 40), ("pm10_conc", 20), ("pm2p5_conc", 15)]:
+        variables.append((name, ["time", "level", "latitude", "longitude"], {'units': "µg/m3"}, series(base)))
+    synthetic.write_netcdf(filename, [("time", 2), ("level", 1), ("latitude", 2), ("longitude", 2)], variables)
+
+
+class NetcdfTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "cams.nc")
+        write_cams(self.filename)
+
+    def test_dataset(self):
+        with netcdf3.Dataset(self.filename) as nc:
+            self.assertEqual(nc.dimensions, {'time': 2, 'level': 1, 'latitude': 2, 'longitude': 2})
+            time = nc.variables['time']
+            self.assertEqual(time.attributes['long_name'], "FORECAST time from 20210212")
+            self.assertEqual(time.read(), [0, 1])
+
+            no2 = nc.variables['no2_conc']
+            self.assertEqual(no2.shape, [2, 1, 2, 2])
+            self.assertEqual(len(no2), 8)
+            self.assertEqual(no2.read(), [ fond.to_float32(x) for x in NO2 ])
+            self.assertEqual(no2.read_at((1, 0, 0, 1)), fond.to_float32(14.7))
+            self.assertEqual(no2.read_series((0, 1, 0)), [ fond.to_float32(13.1), fond.to_float32(15.1) ])
+            with self.assertRaises(IndexError):
+                no2.read_at((2, 0, 0, 0))
+
+    def test_not_netcdf3(self):
+        with open(self.filename, 'wb') as f:
+            f.write(netcdf3.HDF5_MAGIC + b"\r\n\x1a\n")
+        with self.assertRaises(netcdf3.NetcdfFormatError):
+            netcdf3.Dataset(self.filename)
+
+    def test_java_parity(self):
+        # A stand-in for java which prints the output of the java program
+        output = os.path.join(self.tmp.name, "jar_output.txt")
+        with open(output, 'w') as f:
+            f.write(JAR_OUTPUT)
+        java = os.path.join(self.tmp.name, "java")
+        with open(java, 'w') as f:
+            f.write("#!/bin/sh\ncat %s\n" % output)
+        os.chmod(java, os.stat(java).st_mode | stat.S_IXUSR)
+
+        lat, lon = 47.21, -1.58
+        expected = fond.extract_cams_data_java(java, "fond_extract_data-all.jar", self.filename, lat, lon)
+        data = fond.extract_cams_data(self.filename, lat, lon)
+        self.assertEqual(data, expected)
+        self.assertEqual(data[0], [datetime(2021, 2, 12, 0), 13.1, 41.1, 21.1, 16.1])
+
+    def test_bilinear(self):
+        # At the center of the 4 cells, the mean of the 4 values
+        data = fond.extract_cams_data(self.filename, 47.25, -1.55, interpolation = 'bilinear')
+        self.assertEqual([ row[0] for row in data ], [datetime(2021, 2, 12, 0), datetime(2021, 2, 12, 1)])
+        for row, values in zip(data, [NO2[:4], NO2[4:]]):
+            self.assertAlmostEqual(row[1], sum(values) / 4, places = 5)
+
+        # At a cell, its value
+        data = fond.extract_cams_data(self.filename, 47.3, -1.5, interpolation = 'bilinear')
+        self.assertAlmostEqual(data[1][1], 14.7, places = 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
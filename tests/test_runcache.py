@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+import runcache
+from workdir import SIRANE_EXECUTABLE
+
+"""
+The run cache of runcache.py
+"""
+
+
+class RunCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.launches = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_dir(self, name, start = "05/03/2021 11:00:00"):
+        run_dir = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.join(run_dir, "INPUT"))
+        with open(os.path.join(run_dir, SIRANE_EXECUTABLE), 'w') as f:
+            f.write("sirane")
+        with open(os.path.join(run_dir, "INPUT", "Donnees.dat"), 'w') as f:
+            f.write("Date de debut = %s\n" % start)
+        return run_dir
+
+    def launch(self, run_dir):
+        def launch():
+            self.launches.append(run_dir)
+            os.makedirs(os.path.join(run_dir, "RESULT"), exist_ok = True)
+            with open(os.path.join(run_dir, "RESULT", "Conc.dat"), 'w') as f:
+                f.write("result of %s" % run_dir)
+            return 0
+        return runcache.run_cached(run_dir, launch, self.cache_dir)
+
+    def test_same_hour(self):
+        first, rerun = self.run_dir("first"), self.run_dir("rerun")
+        self.assertEqual(self.launch(first), 0)
+        self.assertEqual(self.launch(rerun), 0)
+        self.assertEqual(self.launches, [first])
+        with open(os.path.join(rerun, "RESULT", "Conc.dat")) as f:
+            self.assertEqual(f.read(), "result of %s" % first)
+
+    def test_other_hour(self):
+        first, next_hour = self.run_dir("first"), self.run_dir("next", start = "05/03/2021 12:00:00")
+        self.launch(first)
+        self.launch(next_hour)
+        self.assertEqual(self.launches, [first, next_hour])
+
+    def test_digests_of_every_run(self):
+        # The digests of a run don't replace the ones of the other runs
+        first, second = self.run_dir("first"), self.run_dir("second", start = "05/03/2021 12:00:00")
+        runcache.input_digest(first, self.cache_dir)
+        runcache.input_digest(second, self.cache_dir)
+        digests = runcache.read_digests(os.path.join(runcache.run_cache_dir(self.cache_dir), runcache.DIGESTS_FILENAME))
+        for run_dir in (first, second):
+            self.assertIn(os.path.realpath(os.path.join(run_dir, "INPUT", "Donnees.dat")), digests)
+
+        # The files which were deleted are forgotten
+        os.unlink(os.path.join(first, "INPUT", "Donnees.dat"))
+        runcache.input_digest(second, self.cache_dir)
+        digests = runcache.read_digests(os.path.join(runcache.run_cache_dir(self.cache_dir), runcache.DIGESTS_FILENAME))
+        self.assertNotIn(os.path.realpath(os.path.join(first, "INPUT", "Donnees.dat")), digests)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import unittest
+
+import runpool
+
+"""
+The default number of SIRANE instances of runpool.py
+"""
+
+
+class DefaultWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.available_memory = runpool.available_memory
+        runpool.available_memory = lambda: 20000
+
+    def tearDown(self):
+        runpool.available_memory = self.available_memory
+
+    def test_no_budget(self):
+        self.assertEqual(runpool.default_workers(), 1)
+
+    def test_memory_budget(self):
+        cpus = os.cpu_count() or 1
+        self.assertEqual(runpool.default_workers(memory_limit = 6000), min(cpus, 3))
+        self.assertEqual(runpool.default_workers(memory_ceiling = 9000), min(cpus, 2))
+        self.assertEqual(runpool.default_workers(memory_limit = 30000), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+
+import emission
+from trafficstate import TrafficState
+
+"""
+The memory-mapped last known traffic of trafficstate.py, and the gap filling of emission.py which uses it
+"""
+
+COLUMN_COUNT = 4
+TIME = 1614952800 # 2021-03-05T14:00Z
+TTL = 3600
+
+
+def extract_parameters(row):
+    if row[1] is None:
+        raise emission.SkipEmissionComputation()
+    return row[1], row[2]
+
+
+class TrafficStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.filename = os.path.join(self.tmp.name, "cache", "traffic_state.bin")
+        self.source = os.path.join(self.tmp.name, "mapfile.csv")
+        with open(self.source, 'w') as f:
+            f.write("network_id,traffic_id\n0,A\n")
+
+    def test_round_trip(self):
+        with TrafficState(self.filename, COLUMN_COUNT, [self.source]) as state:
+            self.assertIsNone(state.lookup(1, TIME, TTL))
+            state.remember(1, 50, 600, TIME)
+            state.remember(3, 30.5, 1200, TIME - 1800)
+
+        # Reopened, the values are the ones of the previous run
+        with TrafficState(self.filename, COLUMN_COUNT, [self.source]) as state:
+            self.assertEqual(state.lookup(1, TIME + 600, TTL), (50, 600))
+            self.assertEqual(state.lookup(3, TIME, TTL), (30.5, 1200))
+            self.assertIsNone(state.lookup(0, TIME, TTL))
+            self.assertIsNone(state.lookup(2, TIME, TTL))
+
+    def test_ttl(self):
+        with TrafficState(self.filename, COLUMN_COUNT, [self.source]) as state:
+            state.remember(0, 50, 600, TIME)
+            self.assertEqual(state.lookup(0, TIME + TTL, TTL), (50, 600))
+            self.assertIsNone(state.lookup(0, TIME + TTL + 1, TTL))
+            self.assertIsNone(state.lookup(0, TIME + 60, 0))
+
+    def test_reset(self):
+        with TrafficState(self.filename, COLUMN_COUNT, [self.source]) as state:
+            state.remember(0, 50, 600, TIME)
+
+        # Other columns
+        with TrafficState(self.filename, COLUMN_COUNT + 1, [self.source]) as state:
+            self.assertIsNone(state.lookup(0, TIME, TTL))
+            state.remember(0, 50, 600, TIME)
+
+        # The segment map changed
+        with open(self.source, 'a') as f:
+            f.write("1,B\n")
+        with TrafficState(self.filename, COLUMN_COUNT + 1, [self.source]) as state:
+            self.assertIsNone(state.lookup(0, TIME, TTL))
+
+    def test_fill_gaps(self):
+        matrix = emission.compile_aggregation([{'A': ["0"], 'B': ["1"], 'C': ["2"], 'D': ["3"]}],
+                                              dict( (str(i), 1000.0) for i in range(4) ))
+        columns = matrix.columns[0]
+        with TrafficState(self.filename, COLUMN_COUNT, [self.source]) as state:
+            # The first hour has all the data
+            column_emissions = emission.new_column_emissions(matrix)
+            data = [("A", 50, 600), ("B", 30, 1200), ("C", 90, 300), ("D", 70, 100)]
+            used, unmatched, filled = emission.insert_column_emissions(column_emissions, columns, data, lambda row: row[0],
+                                                                       extract_parameters, state, TIME, TTL)
+            self.assertEqual((used, unmatched, filled), (4, 0, 0))
+            first = emission.aggregate_emissions(matrix, column_emissions)
+
+            # Half an hour later, B has no speed, and C and D are missing
+            column_emissions = emission.new_column_emissions(matrix)
+            data = [("A", 50, 600), ("B", None, None)]
+            used, unmatched, filled = emission.insert_column_emissions(column_emissions, columns, data, lambda row: row[0],
+                                                                       extract_parameters, state, TIME + 1800, TTL)
+            self.assertEqual((used, unmatched, filled), (2, 0, 1))
+            self.assertEqual(emission.fill_missing_columns(column_emissions, columns, state, TIME + 1800, TTL), 2)
+            self.assertEqual(emission.aggregate_emissions(matrix, column_emissions), first)
+
+            # After the TTL, nothing is filled
+            column_emissions = emission.new_column_emissions(matrix)
+            self.assertEqual(emission.fill_missing_columns(column_emissions, columns, state, TIME + 2 * TTL, TTL), 0)
+            self.assertEqual(emission.aggregate_emissions(matrix, column_emissions), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
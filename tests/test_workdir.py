@@ -0,0 +1,60 @@
+import os
+import time
+import tempfile
+import unittest
+
+import workdir
+
+"""
+The pruning of the work directories of workdir.py
+"""
+
+
+class PruneWorkdirsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sirane_dir = os.path.join(self.tmp.name, "sirane")
+        self.root = os.path.join(self.sirane_dir, "runs")
+        os.makedirs(os.path.join(self.sirane_dir, "INPUT", "METEO"))
+        self.shared = os.path.join(self.sirane_dir, "INPUT", "reseau.dat")
+        with open(self.shared, 'w') as f:
+            f.write("shared")
+
+    def tearDown(self):
+        for name in list(workdir._held):
+            workdir.release_workdir(name)
+        self.tmp.cleanup()
+
+    def create(self, hold = True):
+        path = workdir.create_workdir(root = self.root, sirane_dir = self.sirane_dir)
+        if hold:
+            workdir.hold_workdir(path)
+            # Distinct creation times
+            t = time.time() - 100 + len(os.listdir(self.root))
+            os.utime(os.path.join(path, workdir.LOCK_FILENAME), (t, t))
+        return path
+
+    def test_prune(self):
+        oldest, old, recent, newest = [ self.create() for _ in range(4) ]
+        manual = self.create(hold = False)
+        for path in (old, recent, newest):
+            workdir.release_workdir(path)
+
+        # The oldest is still in use, the manual one isn't a run's
+        deleted = workdir.prune_workdirs(self.root, keep = 2)
+        self.assertEqual(deleted, [old])
+        for path in (oldest, recent, newest, manual):
+            self.assertTrue(os.path.isdir(path))
+        self.assertTrue(os.path.exists(self.shared))
+
+        workdir.release_workdir(oldest)
+        self.assertEqual(workdir.prune_workdirs(self.root, keep = 2), [oldest])
+        self.assertEqual(workdir.prune_workdirs(self.root, keep = 0), [])
+
+    def test_no_root(self):
+        self.assertEqual(workdir.prune_workdirs(os.path.join(self.tmp.name, "missing"), keep = 1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()